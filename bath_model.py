@@ -0,0 +1,151 @@
+'''
+
+@description: 	first order model of the temperature bath, learned from the read_temp history and kept in
+				bath_model.json between runs, used to overshoot the bath setpoint so it reaches a new temp
+				sooner. the bath is modelled as dT/dt = (setpoint - T) / tau with separate time constants
+				for cooling and heating, fitted by least squares through the origin
+
+'''
+
+import json
+import math
+import os
+import threading
+
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bath_model.json')
+
+# time constants used until enough history has been seen, in seconds
+DEFAULT_TAU = {'cooling': 600.0, 'heating': 900.0}
+
+# readings this many seconds apart make one observation of dT/dt, closer ones are too noisy at 0.01 C
+MIN_OBSERVATION_S = 30.0
+# observations closer than this to the setpoint are mostly noise
+MIN_ERROR = 0.3
+# observations needed in a direction before its learned tau replaces the default
+MIN_OBSERVATIONS = 10
+# weight kept by the history of earlier runs each time the model is loaded, so the model follows a bath
+	# that changes (e.g. after a coolant change) instead of averaging over its whole life
+HISTORY_DECAY = 0.5
+
+class Bath_Model(object):
+	def __init__(self, path=MODEL_PATH):
+		self.path 		= path # None keeps the model in memory only
+		# per direction least squares sums of error^2 and error * dT/dt, and the observation count
+		self.sums 		= dict((direction, {'ee': 0.0, 'ed': 0.0, 'count': 0}) for direction in DEFAULT_TAU)
+		self.anchor 	= None # (time, temp, setpoint) of the reading observations are measured from
+		# observations come from the device worker while the model is read for predictions and saved from
+			# other threads
+		self.lock 		= threading.RLock()
+
+	def tau(self, direction):
+		with self.lock:
+			sums = self.sums[direction]
+			if sums['count'] < MIN_OBSERVATIONS or sums['ed'] <= 0:
+				return(DEFAULT_TAU[direction])
+			return(sums['ee'] / sums['ed'])
+
+	# adds a reading of the bath, taken while it was running towards setpoint
+	def observe(self, timestamp, temp, setpoint):
+		with self.lock:
+			self._observe(timestamp, temp, setpoint)
+
+	def _observe(self, timestamp, temp, setpoint):
+		if self.anchor is None or self.anchor[2] != setpoint or timestamp < self.anchor[0]:
+			self.anchor = (timestamp, temp, setpoint)
+			return
+		anchor_time, anchor_temp, anchor_setpoint = self.anchor
+		elapsed = timestamp - anchor_time
+		if elapsed < MIN_OBSERVATION_S:
+			return
+		error = setpoint - (temp + anchor_temp) / 2.0
+		if abs(error) >= MIN_ERROR:
+			sums = self.sums['heating' if error > 0 else 'cooling']
+			sums['ee'] += error * error
+			sums['ed'] += error * (temp - anchor_temp) / elapsed
+			sums['count'] += 1
+		self.anchor = (timestamp, temp, setpoint)
+
+	# the reading the model expects after seconds at setpoint
+	def predict_temp(self, temp, setpoint, seconds):
+		tau = self.tau('heating' if setpoint > temp else 'cooling')
+		return(setpoint + (temp - setpoint) * math.exp(-seconds / tau))
+
+	# seconds to go from temp to target with the bath at setpoint, None if it would never get there
+	def time_to_reach(self, temp, target, setpoint):
+		if temp == target:
+			return(0.0)
+		if (setpoint - target) * (target - temp) <= 0 or setpoint == target:
+			return(None)
+		tau = self.tau('heating' if setpoint > temp else 'cooling')
+		return(tau * math.log((temp - setpoint) / (target - setpoint)))
+
+	def load(self):
+		if self.path is None or not os.path.exists(self.path):
+			return(self)
+		with open(self.path) as model_file:
+			saved = json.load(model_file)
+		with self.lock:
+			for direction in DEFAULT_TAU:
+				if direction in saved.get('sums', {}):
+					self.sums[direction] = dict((key, value * HISTORY_DECAY) for key, value in saved['sums'][direction].items())
+		return(self)
+
+	# written to a temporary file first so a crash never leaves a half written model
+	def save(self):
+		if self.path is None:
+			return
+		with self.lock:
+			saved = {
+				'cooling_tau_s': self.tau('cooling'),
+				'heating_tau_s': self.tau('heating'),
+				'sums': dict((direction, dict(sums)) for direction, sums in self.sums.items()),
+			}
+		temporary = self.path + ".tmp"
+		with open(temporary, 'w') as model_file:
+			json.dump(saved, model_file, indent=2, sort_keys=True)
+		if os.name == 'nt' and os.path.exists(self.path):
+			os.remove(self.path) # os.rename doesn't replace files on Windows
+		os.rename(temporary, self.path)
+
+# plans setpoint overshoots for the bath within safe limits. moving to a new temp the bath is first sent
+	# max_overshoot past it, and back to the target once the reading is within switch_margin of the target
+class Overshoot_Controller(object):
+	def __init__(self, model, min_setpoint=0.5, max_setpoint=35.0, max_overshoot=4.0, min_change=1.0, switch_margin=0.1):
+		self.model 			= model
+		self.min_setpoint 	= min_setpoint 	# C, limits of the setpoint ever sent to the bath (kept above freezing)
+		self.max_setpoint 	= max_setpoint
+		self.max_overshoot 	= max_overshoot # C past the target
+		self.min_change 	= min_change 	# C, smaller changes are sent as they are
+		self.switch_margin 	= switch_margin # C short of the target, covers the lag the first order model misses
+
+	# the setpoint to send for a change from temp to target
+	def setpoint_for(self, temp, target):
+		if temp is None or abs(target - temp) < self.min_change:
+			return(target)
+		direction = 1.0 if target > temp else -1.0
+		setpoint = round(min(max(target + direction * self.max_overshoot, self.min_setpoint), self.max_setpoint), 2)
+		if (setpoint - target) * direction <= 0:
+			return(target) # the target is at a limit, there is no room to overshoot
+		return(setpoint)
+
+	# True once the bath overshooting towards target should be sent the target itself
+	def should_switch(self, temp, target, setpoint):
+		if setpoint == target:
+			return(False)
+		if setpoint > target:
+			return(temp >= target - self.switch_margin)
+		return(temp <= target + self.switch_margin)
+
+	# predicted seconds to reach target within tolerance, directly and with the overshoot
+	def predicted_times(self, temp, target, tolerance=0.05):
+		if temp is None or abs(target - temp) <= tolerance:
+			return((0.0, 0.0))
+		direction = 1.0 if target > temp else -1.0
+		direct = self.model.time_to_reach(temp, target - direction * tolerance, target)
+		setpoint = self.setpoint_for(temp, target)
+		if setpoint == target:
+			return((direct, direct))
+		overshoot = self.model.time_to_reach(temp, target - direction * self.switch_margin, setpoint) or 0.0
+		# after the switch the bath closes the remaining switch_margin at the target setpoint
+		settle = self.model.time_to_reach(target - direction * self.switch_margin, target - direction * tolerance, target) or 0.0
+		return((direct, overshoot + settle))
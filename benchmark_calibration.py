@@ -0,0 +1,213 @@
+'''
+
+@description: 	time-compressed benchmark of the calibration state machine. runs calibrate_master
+				through every valve and temperature against the simulated devices and reports how
+				wall time splits between sleeps, serial I/O, and control logic, per-command latency
+				histograms, per-tick overhead of calibrate_slave, and total serial bytes, as JSON
+
+				usage: python benchmark_calibration.py [--time-scale 10000] [--output results.json]
+
+'''
+
+import argparse
+import json
+import logging
+import re
+import time
+
+import calibrate_isms
+import calibrate_headless
+import isms_simulator
+from serial_framing import clock
+
+# latency histogram bucket upper edges, in seconds
+histogram_edges = [1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 1e-1, 3e-1, 1.0, 3.0]
+
+# collects timings of a list of samples and summarizes them with a histogram
+class Timing(object):
+	def __init__(self):
+		self.samples = []
+
+	def add(self, seconds):
+		self.samples.append(seconds)
+
+	def total(self):
+		return(sum(self.samples))
+
+	def summary(self):
+		samples = sorted(self.samples)
+		if not samples:
+			return({'count': 0})
+		histogram = [0] * (len(histogram_edges) + 1)
+		for sample in samples:
+			bucket = 0
+			while bucket < len(histogram_edges) and sample > histogram_edges[bucket]:
+				bucket += 1
+			histogram[bucket] += 1
+		return({
+			'count': 		len(samples),
+			'total_s': 		sum(samples),
+			'mean_s': 		sum(samples) / len(samples),
+			'p50_s': 		samples[len(samples) // 2],
+			'p95_s': 		samples[min(int(len(samples) * 0.95), len(samples) - 1)],
+			'max_s': 		samples[-1],
+			'histogram': 	[["<= %g s" % edge, count] for edge, count in zip(histogram_edges, histogram)] + [["> %g s" % histogram_edges[-1], histogram[-1]]],
+		})
+
+# "W SP 6\r\n" -> "W SP", "FI2000" -> "FI", MFC frames have their crc and terminator removed. calboard
+	# commands are fixed names and are left alone
+def command_name(controller, data):
+	if isinstance(controller, calibrate_isms.MFC_Controller_Parent):
+		data = data[:-3]
+	data = data.strip()
+	if isinstance(controller, calibrate_isms.CalBoard_Controller):
+		return(data)
+	if " " in data:
+		return(re.sub(r"( -?[\d.]+)+$", "", data))
+	return(re.sub(r"-?[\d.]+$", "", data))
+
+# the calibrate_slave phase a tick starts in, from the state flags
+def tick_phase(state):
+	if state.ready_for_pres_change:
+		return("pressure_change")
+	elif state.ready_for_temp_change:
+		return("temp_change")
+	elif state.waiting_for_temp and state.equilibration_counter > 0:
+		return("equilibration")
+	elif state.waiting_for_temp:
+		return("waiting_for_temp")
+	return("waiting_for_sample")
+
+# wraps the device I/O, sleeps, and calibrate_slave ticks with timers for one benchmark run
+class Instrumentation(object):
+	def __init__(self):
+		self.commands 		= {}
+		self.io 			= Timing()
+		self.sleeps 		= Timing()
+		self.idle 			= Timing()
+		self.ticks 			= Timing()
+		self.phase_wall 	= {}
+		self.phase_device 	= {}
+		self.last_tick 		= None
+
+	def install(self):
+		self.originals = (calibrate_isms.Controller_Parent.exchange, calibrate_isms.Controller_Parent.exchange_binary,
+			calibrate_isms.device_sleep, calibrate_isms.calibrate_slave, calibrate_headless.device_sleep)
+		exchange, exchange_binary, device_sleep, calibrate_slave, idle_sleep = self.originals
+		instrumentation = self
+
+		def timed(controller, data, send, *args):
+			start = time.time()
+			try:
+				return(send(controller, data, *args))
+			finally:
+				elapsed = time.time() - start
+				instrumentation.io.add(elapsed)
+				name = type(controller).__name__ + " " + command_name(controller, data)
+				instrumentation.commands.setdefault(name, Timing()).add(elapsed)
+
+		def timed_exchange(controller, data, count=1):
+			return(timed(controller, data, exchange, count))
+
+		def timed_exchange_binary(controller, data, sync, size):
+			return(timed(controller, data, exchange_binary, sync, size))
+
+		def timed_sleep(seconds):
+			start = time.time()
+			device_sleep(seconds)
+			instrumentation.sleeps.add(time.time() - start)
+
+		def timed_idle(seconds):
+			start = time.time()
+			idle_sleep(seconds)
+			instrumentation.idle.add(time.time() - start)
+
+		def timed_calibrate_slave(app, bc, vc, pc, cc, state):
+			phase = tick_phase(state)
+			now = clock()
+			# device time between ticks is attributed to the phase of the earlier tick
+			if instrumentation.last_tick is not None:
+				last_phase, last_time = instrumentation.last_tick
+				instrumentation.phase_device[last_phase] = instrumentation.phase_device.get(last_phase, 0.0) + now - last_time
+			instrumentation.last_tick = (phase, now)
+			start = time.time()
+			try:
+				return(calibrate_slave(app, bc, vc, pc, cc, state))
+			finally:
+				elapsed = time.time() - start
+				instrumentation.ticks.add(elapsed)
+				instrumentation.phase_wall[phase] = instrumentation.phase_wall.get(phase, 0.0) + elapsed
+
+		calibrate_isms.Controller_Parent.exchange = timed_exchange
+		calibrate_isms.Controller_Parent.exchange_binary = timed_exchange_binary
+		calibrate_isms.device_sleep = timed_sleep
+		calibrate_isms.calibrate_slave = timed_calibrate_slave
+		calibrate_headless.device_sleep = timed_idle
+
+	def uninstall(self):
+		(calibrate_isms.Controller_Parent.exchange, calibrate_isms.Controller_Parent.exchange_binary,
+			calibrate_isms.device_sleep, calibrate_isms.calibrate_slave, calibrate_headless.device_sleep) = self.originals
+
+def run_benchmark(time_scale=10000.0, sample_time=60.0, noise=0.0, recipe=None, predictive_bath=False):
+	instrumentation = Instrumentation()
+	instrumentation.install()
+	start = time.time()
+	start_clock = clock()
+	try:
+		app, rig = isms_simulator.run_calibration(time_scale, sample_time, noise=noise, recipe=recipe,
+			predictive_bath=predictive_bath)
+	finally:
+		instrumentation.uninstall()
+	wall = time.time() - start
+
+	io = instrumentation.io.total()
+	sleeps = instrumentation.sleeps.total()
+	idle = instrumentation.idle.total()
+	phases = set(instrumentation.phase_wall) | set(instrumentation.phase_device)
+	return({
+		'time_scale': 			time_scale,
+		'completed': 			app.status.get() == "Calibration complete!",
+		'device_time_s': 		rig.last_update - start_clock,
+		'wall_time_s': 			wall,
+		'wall_time_breakdown_s': {
+			'sleep': 			sleeps,
+			'io': 				io,
+			'idle_between_ticks': idle,
+			'logic': 			wall - sleeps - io - idle,
+		},
+		'serial_bytes': 		rig.bytes_transferred(),
+		'calibrate_slave_ticks': instrumentation.ticks.summary(),
+		'phases': 				dict((phase, {
+			'device_time_s': 	instrumentation.phase_device.get(phase, 0.0),
+			'wall_time_s': 		instrumentation.phase_wall.get(phase, 0.0),
+		}) for phase in phases),
+		'commands': 			dict((name, timing.summary()) for name, timing in instrumentation.commands.items()),
+	})
+
+def main():
+	parser = argparse.ArgumentParser(description="Time-compressed benchmark of the calibration state machine.")
+	parser.add_argument('--time-scale', type=float, default=10000.0, help="device time compression factor")
+	parser.add_argument('--sample-time', type=float, default=60.0, help="simulated seconds the operator takes per sample")
+	parser.add_argument('--noise', type=float, default=0.0, help="standard deviation of simulated reading noise")
+	parser.add_argument('--recipe', help="calibration recipe to run, the full matrix by default")
+	parser.add_argument('--predictive-bath', action='store_true', help="overshoot the bath setpoint using the learned bath model")
+	parser.add_argument('--output', default="benchmark_results.json", help="file the JSON results are written to")
+	parser.add_argument('--verbose', action='store_true', help="keep the debug log on the console")
+	args = parser.parse_args()
+
+	if not args.verbose:
+		calibrate_isms.handler2.setLevel(logging.WARNING)
+
+	results = run_benchmark(args.time_scale, args.sample_time, args.noise, args.recipe, args.predictive_bath)
+	with open(args.output, 'w') as output:
+		json.dump(results, output, indent=2, sort_keys=True)
+
+	breakdown = results['wall_time_breakdown_s']
+	print("Device time %.2f h replayed in %.2f s wall time" % (results['device_time_s'] / 3600.0, results['wall_time_s']))
+	print("  sleep %.3f s, io %.3f s, idle %.3f s, logic %.3f s" % (breakdown['sleep'], breakdown['io'],
+		breakdown['idle_between_ticks'], breakdown['logic']))
+	print("  %d calibrate_slave ticks, %d serial bytes" % (results['calibrate_slave_ticks']['count'], results['serial_bytes']))
+	print("Results written to " + args.output)
+
+if __name__ == '__main__':
+	main()
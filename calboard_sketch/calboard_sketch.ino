@@ -20,6 +20,13 @@ int pressHigh = A8;
 int pressLow = A10;
 int pressHighLow = A12;
 
+// "burst <n>" reply: sync byte, n, mean*16/min/max of each transducer as little endian 16 bit values, checksum
+const byte burstSync = 0xB5;
+const int burstFrameSize = 21;
+
+// reported in the "?" reply, version 2 reads newline terminated commands
+const int protocolVersion = 2;
+
 void setup() {
   Serial.begin(9600); // set the baud rate
   pinMode(LED_BUILTIN, OUTPUT);
@@ -63,10 +70,52 @@ void setup() {
   digitalWrite(pressPwr3, HIGH);
 }
 
+// takes n readings of each transducer and sends their mean (in 1/16 counts), min and max as one binary
+// frame, the checksum is the sum of every byte after the sync byte
+void sendBurst(int n) {
+  int pins[3] = {pressHigh, pressLow, pressHighLow};
+  unsigned long sums[3] = {0, 0, 0};
+  unsigned int mins[3] = {1023, 1023, 1023};
+  unsigned int maxs[3] = {0, 0, 0};
+
+  digitalWrite(pressPwr1, HIGH);
+  digitalWrite(pressPwr2, HIGH);
+  digitalWrite(pressPwr3, HIGH);
+  delay(100);
+  for (int i = 0; i < n; i++) {
+    for (int s = 0; s < 3; s++) {
+      unsigned int val = analogRead(pins[s]);
+      sums[s] += val;
+      if (val < mins[s]) mins[s] = val;
+      if (val > maxs[s]) maxs[s] = val;
+    }
+  }
+
+  byte frame[burstFrameSize];
+  frame[0] = burstSync;
+  frame[1] = n;
+  for (int s = 0; s < 3; s++) {
+    unsigned int values[3] = {(unsigned int)(sums[s] * 16 / n), mins[s], maxs[s]};
+    for (int v = 0; v < 3; v++) {
+      frame[2 + s * 6 + v * 2] = values[v] & 0xFF;
+      frame[3 + s * 6 + v * 2] = values[v] >> 8;
+    }
+  }
+  byte checksum = 0;
+  for (int i = 1; i < burstFrameSize - 1; i++) {
+    checksum += frame[i];
+  }
+  frame[burstFrameSize - 1] = checksum;
+  Serial.write(frame, burstFrameSize);
+}
+
 void loop() {
   String input;
   if (Serial.available()) { // only run through loop if data has been sent
-    input = Serial.readString(); // read the incoming data
+    // read the incoming command up to its newline, commands from older controllers without one still
+    // arrive once Serial's one second timeout runs out
+    input = Serial.readStringUntil('\n');
+    input.trim();
     if (input == "normal_operation_v9") {
       // Normal operation while running the mass spec
       digitalWrite(LED_BUILTIN, LOW);
@@ -193,6 +242,16 @@ void loop() {
         
         Serial.println(pressValues);
     }
+    else if (input.startsWith("burst ")) {
+      // n oversampled pressure readings in one binary frame, see sendBurst
+      int n = input.substring(6).toInt();
+      if (n >= 1 && n <= 255) {
+        sendBurst(n);
+      }
+      else {
+        Serial.println("F001");
+      }
+    }
     else if (input == "flushOn") {
       //turn on the pin that triggers the SSR
       digitalWrite(flushPin, HIGH);
@@ -206,8 +265,9 @@ void loop() {
       Serial.println("flushOff");
     }
     else if (input == "?") {
-      // Notifying controller that we're in a healthy state
-      Serial.println("1");
+      // Notifying controller that we're in a healthy state and which protocol version we speak
+      Serial.print("1 v");
+      Serial.println(protocolVersion);
     }
     else {
       Serial.println("F001");
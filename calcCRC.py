@@ -1,32 +1,71 @@
 import binascii
+import random
+import timeit
+
+# CRC-16 (polynomial 0x1021, initial value 0xffff) used by the SmartTrak MFC serial protocol
+
+def _build_crc_table():
+    # precompute the 8 shift/xor rounds for every possible high byte so each character of a
+        # command costs one table lookup instead of an 8 iteration loop
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for j in range(0,8):
+            if((crc&0x8000)==0x8000):
+                crc=((crc<<1)^0x1021)&0xffff
+            else:
+                crc=(crc<<1)&0xffff
+        table.append(crc)
+    return(table)
+
+def _build_byte_table():
+    # There are some crc byte values that are not allowed, 0x00 and 0x0d, and they are incremented
+        # by one. Each byte of the crc is fixed independently so the fixup is folded into a table
+        # that maps the byte value straight to the character that goes on the wire
+    table = []
+    for byte in range(256):
+        if byte == 0x0d or byte == 0x00:
+            byte += 1
+        table.append(chr(byte))
+    return(table)
+
+CRC_TABLE = _build_crc_table()
+CRC_BYTES = _build_byte_table()
 
 def calcCRC(cmnd):
     # cmnd is a byte array containing the command ASCII string; example: cmnd="Sinv2.000"
-    # an unsigned 32 bit integer is returned to the calling program
-    # only the lower 16 bits contain the crc
+    # the two crc bytes are returned as a string, high byte first
+    crc = 0xffff
+    for character in cmnd:
+        crc = ((crc<<8)&0xffff) ^ CRC_TABLE[(crc>>8) ^ ord(character)]
+    return(CRC_BYTES[crc>>8] + CRC_BYTES[crc&0xff])
+
+def frame_command(cmnd):
+    # complete MFC frame: the command, its two crc bytes, and the carriage return terminator
+    return(cmnd + calcCRC(cmnd) + '\x0d')
+
+def frame_commands(cmnds):
+    # frames a whole sequence of commands at once, returned in the same order
+    return([frame_command(cmnd) for cmnd in cmnds])
 
+def calcCRC_bitwise(cmnd):
+    # original bit-by-bit implementation, kept as the reference for the benchmark below
     crc = 0xffff # initialize crc to hex value 0xffff
-    
+
     for character in cmnd: # this for loop starts with ASCCII 'S' and loops through to the last ASCII '0'
         hex_char = (int(ord(character)))
-        #hex_char = character
         crc=crc^(hex_char*0x0100) # the ASCII value is times by 0x0100 first then XORED to the current crc value
-        #for(j=0; j<8; j++) # the crc is hashed 8 times with this for loop
-        j = 0
         for j in range(0,8):
-            # if the 15th bit is set (tested by ANDING with hex 0x8000 and testing for 0x8000 result) 
-            # then crc is shifted left one bit (same as times 2) XORED with hex 0x1021 and ANDED to 
-            # hex 0xffff to limit the crc to lower 16 bits. If the 15th bit is not set then the crc 
+            # if the 15th bit is set (tested by ANDING with hex 0x8000 and testing for 0x8000 result)
+            # then crc is shifted left one bit (same as times 2) XORED with hex 0x1021 and ANDED to
+            # hex 0xffff to limit the crc to lower 16 bits. If the 15th bit is not set then the crc
             # is shifted left one bit and ANDED with hex 0xffff to limit the crc to lower 16 bits.
             if((crc&0x8000)==0x8000):
                 crc=((crc<<1)^0x1021)&0xffff
             else:
                 crc=(crc<<1)&0xffff
-            # end of j loop
-        # end of i loop
-    # There are some crc values that are not allowed, 0x00 and 0x0d
 
-    # These are byte values so the high byte and the low byte of the crc must be checked and incremented if 
+    # These are byte values so the high byte and the low byte of the crc must be checked and incremented if
         # the bytes are either 0x00 0r 0x0d
     if((crc&0xff00)==0x0d00):
         crc +=0x0100
@@ -44,11 +83,27 @@ def calcCRC(cmnd):
         crc_hex_string_final = crc_hex_string
     first_byte = crc_hex_string_final[2:4]
     second_byte = crc_hex_string_final[4:6]
-    final = binascii.unhexlify(first_byte + second_byte)
+    return(binascii.unhexlify(first_byte + second_byte))
+
+def benchmark(iterations=20000):
+    # compares the table driven crc against the original bit-by-bit version on typical MFC commands
+    cmnds = ["Sinv2.000", "?Srnm", "?Flow", "!Gasi8", "Sinv150.000", "!Sinv1000.000"]
+
+    # make sure both implementations agree before timing anything
+    rng = random.Random(0)
+    samples = cmnds + ["".join(chr(rng.randint(32, 126)) for i in range(rng.randint(1, 16))) for j in range(5000)]
+    for cmnd in samples:
+        if calcCRC(cmnd) != calcCRC_bitwise(cmnd):
+            raise ValueError("CRC mismatch for " + repr(cmnd))
 
-    #return(final)
-    return(final)
+    bitwise_time = timeit.timeit(lambda: [calcCRC_bitwise(cmnd) for cmnd in cmnds], number=iterations)
+    table_time = timeit.timeit(lambda: [calcCRC(cmnd) for cmnd in cmnds], number=iterations)
+    batch_time = timeit.timeit(lambda: frame_commands(cmnds), number=iterations)
+    calls = iterations * len(cmnds)
+    print("bitwise crc:   %.2f us per command" % (bitwise_time / calls * 1e6))
+    print("table crc:     %.2f us per command" % (table_time / calls * 1e6))
+    print("batch framing: %.2f us per command" % (batch_time / calls * 1e6))
+    print("speedup:       %.1fx" % (bitwise_time / table_time))
 
-    # If the string Sinv2.000 is sent through this routine the crc = 0x8f55
-    # The complete command "Sinv2.000" will look like this in hex: 
-        # 0x53 0x69 0x6E 0x76 0x32 0x2e 0x30 0x30 0x30 0x8f 0x55 0x0d
\ No newline at end of file
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,268 @@
+'''
+
+@description: 	runs a calibration without Tkinter, e.g. on the shipboard Linux box: the health check,
+				the setup (until the readiness checks pass), and the calibration of a recipe, with the
+				progress logged to the console and the calibration log instead of shown in the GUI
+
+				usage: python calibrate_headless.py [recipe.json] --mfc1-flow 100 --mfc2-flow 50
+					[--gas-index 3] [--gas-outlet v9] [--predictive-bath] [--skip-setup] [--sample-time 300]
+				       python calibrate_headless.py --resume [--skip-setup] [--sample-time 300]
+
+				--resume picks an interrupted calibration up from its last sample with the recipe and
+				settings it was started with (see calibration_checkpoint.py)
+
+				the operator finishes each sample with kill -USR1 <pid> (or it finishes by itself after
+				--sample-time seconds), kill -USR2 <pid> pauses and resumes the calibration, and Ctrl-C
+				or kill <pid> stops the bath and pump and releases the pressure before exiting
+
+'''
+
+import argparse
+import heapq
+import os
+import signal
+import sys
+
+import calibrate_isms
+import calibration_checkpoint
+import calibration_recipe
+from calibrate_isms import logger
+from serial_framing import clock, device_sleep
+
+# holds a setting or readout the Application keeps in a Tk variable
+class Setting(object):
+	def __init__(self, value=None):
+		self.value = value
+
+	def get(self):
+		return(self.value)
+
+	def set(self, value):
+		self.value = value
+
+# runs worker jobs immediately on the calling thread, there is no GUI to keep responsive
+class Inline_Worker(object):
+	def __init__(self, app):
+		self.app = app
+
+	def submit(self, func, args=(), callback=None):
+		try:
+			result = func(*args)
+		except Exception as e:
+			# logged by the app's set_error
+			self.app.post(calibrate_isms.worker_job_failed, self.app, e)
+			return
+		if callback is not None:
+			self.app.post(callback, result)
+
+	def stop(self):
+		pass
+
+# the parts of the calibration Application used by calibrate_master, calibrate_slave, and the health and
+	# setup checks, with after() timers run in order on the device clock. samples are finished by
+	# sample_complete, or after sample_time seconds if it is given. the rig, recording, bath model,
+	# checkpoint, and telemetry are calibrate_isms's single rig ones unless given, see calibrate_rigs
+class Headless_App(calibrate_isms.Status_Sink, object):
+	def __init__(self, gas_outlet="v9", sample_time=None, rig=None, recorder=None, bath_model=None, checkpoint_path=None,
+			telemetry_path=None):
+		self.status 			= Setting("Awaiting instruction.")
+		self.details 			= Setting("")
+		self.errors 			= Setting("")
+		self.current_valve 		= Setting(0)
+		self.temp_readout 		= Setting(0.0)
+		self.goal_temp 			= Setting(0.0)
+		self.high_press_readout = Setting(0.0)
+		self.low_press_readout 	= Setting(0.0)
+		self.hplc_press_readout = Setting(0.0)
+		self.time_string 		= Setting(0)
+		self.gas_outlet 		= Setting(gas_outlet)
+		self.recipe_path 		= Setting(calibration_recipe.DEFAULT_RECIPE)
+		self.predictive_bath 	= Setting(False)
+		self.mfc1_flow 			= Setting(0)
+		self.mfc2_flow 			= Setting(0)
+		self.gas_index 			= -1
+		self.system_healthy 	= False
+		self.calibrating 		= False
+		self.paused 			= False
+		self.currently_sampling = False
+		self.refilling_fr 		= False
+		self.sample_time 		= sample_time
+		self.sample_pending 	= False
+		self.timers 			= []
+		self.timer_count 		= 0
+		self.stopping 			= False
+		self.sample_prompt 		= "Take the sample, then run kill -USR1 " + str(os.getpid()) + " to carry on."
+		self.recorder 			= recorder or calibrate_isms.recorder
+		self.bath_model 		= bath_model or calibrate_isms.learned_bath
+		self.checkpoint_path 	= checkpoint_path or calibrate_isms.checkpoint_path
+		self.telemetry_path 	= telemetry_path or 'telemetry_' + calibrate_isms.showtime + '.isms'
+		self.devices 			= calibrate_isms.Device_Registry(self, rig)
+		self.worker 			= Inline_Worker(self)
+		self.telemetry 			= None # started once the health check has opened the devices
+
+	def post(self, func, *args):
+		func(*args)
+
+	# calibrate_slave repeats its details every tick, so only changes are logged
+	def report(self, setting, msg, log):
+		if setting.get() != msg:
+			setting.set(msg)
+			log(msg)
+
+	def set_status(self, msg):
+		self.report(self.status, msg, logger.info)
+
+	def set_details(self, msg):
+		self.report(self.details, msg, logger.debug)
+
+	def set_error(self, msg):
+		self.report(self.errors, msg, logger.error)
+
+	def update_valve(self, valve_number):
+		self.current_valve.set(valve_number)
+
+	def update_temp(self, current_temp):
+		self.temp_readout.set(current_temp)
+
+	def update_goal_temp(self, the_set_temp):
+		self.goal_temp.set(the_set_temp)
+
+	def update_pressures(self, high_press, low_press, hplc_pressure):
+		self.high_press_readout.set(high_press)
+		self.low_press_readout.set(low_press)
+		self.hplc_press_readout.set(hplc_pressure)
+
+	def begin_timer(self, start_time):
+		pass
+
+	def after(self, ms, func):
+		self.timer_count += 1
+		heapq.heappush(self.timers, (clock() + ms / 1000.0, self.timer_count, func))
+
+	def sample_complete(self):
+		self.currently_sampling = False
+		self.sample_pending = False
+
+	def toggle_pause(self):
+		if self.calibrating:
+			self.paused = not self.paused
+			self.set_status("Calibration paused." if self.paused else "Calibration resumed.")
+
+	# makes run return before its next timer, from another thread or a signal handler
+	def stop(self):
+		self.stopping = True
+
+	# runs timers in order on the device clock until there are none left or the app is stopped
+	def run(self):
+		while self.timers and not self.stopping:
+			due, count, func = heapq.heappop(self.timers)
+			# a signal from the operator ends the sleep early, and stop is checked at least every second
+			while clock() < due and not self.stopping:
+				device_sleep(min(due - clock(), 1.0))
+			if self.stopping:
+				break
+			func()
+			if self.currently_sampling and not self.sample_pending:
+				self.sample_pending = True
+				if self.sample_time is not None:
+					self.after(self.sample_time * 1000, self.sample_complete)
+				else:
+					logger.info(self.sample_prompt)
+
+# runs the health check, the setup, and the calibration of app.recipe_path (or the rest of the
+	# checkpoint's calibration), returns True if the calibration completed
+def run_headless(app, skip_setup=False, checkpoint=None):
+	if not calibrate_isms.system_health_check(app):
+		logger.error("Precheck failed, not calibrating.")
+		return(False)
+	app.system_healthy = True
+	app.telemetry = calibrate_isms.Telemetry_Sampler(app, app.telemetry_path)
+	app.telemetry.start()
+
+	settings = {'gas_index': app.gas_index, 'mfc1_setpoint': app.mfc1_flow.get(), 'mfc2_setpoint': app.mfc2_flow.get()}
+	if not skip_setup:
+		app.set_status("Cooling + Pressurization Ongoing")
+		controllers = calibrate_isms.calibration_setup(app, app.gas_outlet.get(), settings, app.predictive_bath.get())
+		state = calibrate_isms.start_setup_checks(app, controllers, settings)
+		app.run()
+		if state.outcome != "ready":
+			logger.error("Setup did not complete, not calibrating.")
+			return(False)
+
+	if not calibrate_isms.calibrate_master(app, checkpoint=checkpoint):
+		return(False)
+	app.run()
+	return(app.status.get() == "Calibration complete!")
+
+def install_signal_handlers(app):
+	if hasattr(signal, 'SIGUSR1'):
+		signal.signal(signal.SIGUSR1, lambda signum, frame: app.sample_complete())
+		signal.signal(signal.SIGUSR2, lambda signum, frame: app.toggle_pause())
+	# kill <pid> shuts down the same way as Ctrl-C
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+def main():
+	parser = argparse.ArgumentParser(description="Runs the health check, setup, and calibration of a recipe without the GUI.")
+	parser.add_argument('recipe', nargs='?', default=calibration_recipe.DEFAULT_RECIPE,
+		help="calibration recipe (default recipes/full_matrix.json)")
+	parser.add_argument('--mfc1-flow', type=float, help="gas flow for MFC one (nitrogen)")
+	parser.add_argument('--mfc2-flow', type=float, help="gas flow for MFC two (sample gas)")
+	parser.add_argument('--gas-index', type=int, default=8, choices=range(1, 11),
+		help="MFC two gas index, 3 CO2, 6 H, 7 CH4, 8 N (default), 10 O")
+	parser.add_argument('--gas-outlet', default="v9", choices=["v8", "v9"], help="gas outlet solenoid (default v9)")
+	parser.add_argument('--predictive-bath', action='store_true', help="overshoot the bath setpoint using the learned bath model")
+	parser.add_argument('--skip-setup', action='store_true', help="calibrate right away, the rig is already cooled and pressurized")
+	parser.add_argument('--sample-time', type=float, default=None,
+		help="seconds after which a sample finishes by itself instead of waiting for kill -USR1")
+	parser.add_argument('--resume', action='store_true',
+		help="resume the interrupted calibration, its recipe and settings replace the ones given here")
+	args = parser.parse_args()
+
+	checkpoint = None
+	if args.resume:
+		checkpoint = calibration_checkpoint.load(calibrate_isms.checkpoint_path)
+		if checkpoint is None:
+			raise SystemExit("There is no interrupted calibration to resume.")
+		logger.info("Resuming the calibration at " + calibration_checkpoint.describe(checkpoint) + ".")
+		saved = checkpoint['settings']
+		args.recipe, args.gas_index, args.gas_outlet = saved['recipe_path'], saved['gas_index'], saved['gas_outlet']
+		args.mfc1_flow, args.mfc2_flow, args.predictive_bath = saved['mfc1_setpoint'], saved['mfc2_setpoint'], saved['predictive_bath']
+	elif args.mfc1_flow is None or args.mfc2_flow is None:
+		parser.error("--mfc1-flow and --mfc2-flow are required unless resuming")
+	else:
+		# a bad recipe is reported before any device is touched
+		try:
+			calibration_recipe.load_plan(args.recipe)
+		except (IOError, ValueError) as e:
+			raise SystemExit("Could not load recipe " + args.recipe + ": " + str(e))
+
+	app = Headless_App(args.gas_outlet, args.sample_time)
+	app.recipe_path.set(args.recipe)
+	app.gas_index = args.gas_index
+	app.mfc1_flow.set(args.mfc1_flow)
+	app.mfc2_flow.set(args.mfc2_flow)
+	app.predictive_bath.set(args.predictive_bath)
+	install_signal_handlers(app)
+
+	completed = False
+	try:
+		completed = run_headless(app, args.skip_setup, checkpoint)
+	except (Exception, KeyboardInterrupt, SystemExit):
+		logger.warn("Calibration interrupted, shutting down the bath and pump.")
+		try:
+			calibrate_isms.safe_shutdown(app.devices)
+		except Exception as e:
+			logger.error(str(type(e).__name__) + " occured. Arguments:" + str(e.args))
+			logger.warn("Not able to kill one or more serial devices.")
+		raise
+	finally:
+		if app.telemetry is not None:
+			app.telemetry.stop()
+			app.telemetry.join(10)
+		app.devices.close_all()
+		app.recorder.close()
+		calibrate_isms.save_bath_model(app.bath_model)
+	sys.exit(0 if completed else 1)
+
+if __name__ == '__main__':
+	main()
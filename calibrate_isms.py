@@ -8,14 +8,33 @@ Created on Mar, 03 2017
 
 '''
 
-import Tkinter as tk
-import ttk
+try:
+	import Tkinter as tk
+	import ttk
+	import tkMessageBox
+except ImportError:
+	# the calibration itself runs without Tk, see calibrate_headless.py
+	tk = ttk = tkMessageBox = None
 import serial
 import time
-from collections import deque
 import logging
 import math
-from calcCRC import calcCRC
+import os
+import struct
+import threading
+import Queue
+from calcCRC import frame_command
+from serial_framing import read_frame, read_binary_frame, open_port, device_sleep, clock, run_concurrently, BATH_TERMINATOR, VALVE_TERMINATOR, PUMP_TERMINATOR, CALBOARD_TERMINATOR, MFC_TERMINATOR
+import serial_framing
+import data_recorder
+import pressure_conversion
+import calibration_recipe
+import calibration_planner
+import stability_detector
+import bath_model
+import calibration_checkpoint
+import rig_config
+import port_discovery
 
 # logging configuration (using default python logging module)
 logger = logging.getLogger(__name__)
@@ -36,6 +55,26 @@ data_handler.setFormatter(formatter)
 data_logger.addHandler(data_handler)
 data_logger.setLevel(logging.INFO)
 
+# typed records of every calibration event, loaded for analysis with data_recorder.load_run
+recorder = data_recorder.Data_Recorder('data_calibration_' + showtime + '.isms')
+
+# per transducer calibration of the calboard pressure readings, the defaults are used without a config
+transducer_config = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'transducers.json')
+if os.path.exists(transducer_config):
+	pressure_converter = pressure_conversion.load_converter(transducer_config)
+else:
+	pressure_converter = pressure_conversion.default_converter()
+
+# first order model of the bath learned from every run, used by predictive bath control
+learned_bath = bath_model.Bath_Model()
+try:
+	learned_bath.load()
+except (IOError, ValueError) as e:
+	logger.warn("Could not load the bath model, starting from the defaults: " + str(e))
+
+# where the running calibration is checkpointed so it can be resumed, None turns checkpointing off
+checkpoint_path = calibration_checkpoint.CHECKPOINT_PATH
+
 #################################
 ### Serial Device Controllers ###
 #################################
@@ -43,7 +82,15 @@ data_logger.setLevel(logging.INFO)
 # [bath controller, valve controller, hplc controller, calboard controller, mfc controller_one, mfc controller two]
 #serial_list = ['/dev/tty.usbserial-A800dars', '/dev/tty.usbserial', '/dev/tty.usbmodem14131', '/dev/tty.usbmodem14111', '/dev/tty.usbserial228', '/dev/tty.usbserial235']
 serial_list = ['COM29', 'COM34', 'COM33', 'COM28', 'COM32', 'COM35']
-serial_check_list = [None] * len(serial_list)
+
+# the rig in serial_list, used unless a Device_Registry is given another one (see calibrate_rigs.py). the
+	# MFC serial numbers are the ?Srnm replies of the new Smart Trak 100 (one) and the old Smart Trak 2 (two).
+	# the health check finds its devices with port_discovery, serial_list is only where it starts looking
+default_rig = rig_config.Rig('default', dict(zip(rig_config.DEVICE_NAMES, serial_list)),
+	{'mfc1': 'Srnm210704\x8c\x92\r', 'mfc2': 'Srnm1380145\x93\r'}, "v9", discover=True)
+
+# where the ports port_discovery finds are cached, None probes every time
+port_map_path = port_discovery.CACHE_PATH
 
 # abstract class that controller's inherit from. these are the object oriented code to command and
 	# communicate with all serial devices
@@ -63,15 +110,72 @@ class Controller_Parent(object):
 	def kill(self):
 		pass
 
+	# used by the Device_Registry to decide whether a shared controller can be handed out again
+	def is_connected(self):
+		ser = getattr(self, 'ser', None)
+		return(ser is not None and ser.isOpen())
+
+	# closing the port after a communication failure makes the Device_Registry reopen it on next use
+	def disconnect(self):
+		if self.is_connected():
+			self.ser.close()
+
+	# writes a command and reads the reply up to the controller's terminator, the serial timeout is only
+		# an upper bound. count is the number of terminators in the expected reply
+	# the controller's lock keeps the calibration worker and GUI actions from interleaving on one port
+	def exchange(self, data, count=1):
+		with self.lock:
+			try:
+				self.ser.write(data)
+				return(read_frame(self.ser, self.terminator, count))
+			except serial.SerialException:
+				self.disconnect()
+				raise
+
+	# like exchange, for commands answered with a fixed size binary frame starting with sync
+	def exchange_binary(self, data, sync, size):
+		with self.lock:
+			try:
+				self.ser.write(data)
+				return(read_binary_frame(self.ser, sync, size, self.terminator))
+			except serial.SerialException:
+				self.disconnect()
+				raise
+
+	# sends the (cmd, ack) steps back to back through cmd_controller, each only waiting for its reply's
+		# terminator, and stops at the first reply that isn't its ack. the port is held for the whole
+		# batch so no telemetry poll or GUI action lands in the middle of it. returns True if every step
+		# was acknowledged, the failing step is logged
+	def run_batch(self, steps):
+		with self.lock:
+			for index, (cmd, ack) in enumerate(steps):
+				ser_rsp = self.cmd_controller(cmd)
+				if ser_rsp != ack:
+					logger.error(type(self).__name__ + ": step " + str(index + 1) + " of " + str(len(steps)) + " (" +
+						repr(cmd) + ") got " + repr(ser_rsp) + " instead of " + repr(ack) + ", the rest were not sent.")
+					return(False)
+		return(True)
+
+# check_temp serves readings up to this many seconds old from the cache the Telemetry_Sampler keeps fresh
+	# instead of asking the bath again, keep it just above the sampler's temp_period
+TEMP_MAX_AGE_S = 2.5
+
 # temperature bath controller
 # this controller is more thorougly commented to clarify the setup of the controllers, repeated code in 
 	# following controllers is not commented
 class Bath_Controller(Controller_Parent):
-	def __init__(self, app):
+	def __init__(self, app, port):
 		# establish serial control with serial device
-		self.ser = serial.Serial(serial_list[0], 9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=1)
-		self.set_temp = None
+		self.ser = open_port(port, 9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=1)
+		self.terminator = BATH_TERMINATOR
+		self.lock = threading.RLock()
+		self.set_temp = None 		# temp the bath is asked to reach
+		self.command_temp = None 	# setpoint last sent to the bath, past set_temp while overshooting
+		self.overshoot = None 		# bath_model.Overshoot_Controller while predictive control is on
+		self.current_temp = None 	# last reading taken by check_temp, None until the first one
+		self.last_reading = None 	# (device clock, temp) of the last good read_temp, from any thread
 		self.app = app
+		self.model = app.bath_model # bath_model.Bath_Model learned from this bath's readings
 		logger.info("Starting Bath Controller.")
 		logger.debug("Connected over serial at " + str(self.ser.name))
 		
@@ -79,18 +183,10 @@ class Bath_Controller(Controller_Parent):
 		# this command stops the bath so only use upon startup, it is used because it give a consistent
 			# reply to ensure communication has been established
 		if (self.cmd_controller("W RR -1") == "$\r\n"):
-			self.continuous_temp_update() # Bath is healthy so get it updating temp readout
 			return(True)
 		else:
 			return(False)
 
-	def continuous_temp_update(self):
-		try:
-			self.app.update_temp(self.read_temp())
-		except:
-			return
-		self.app.after(5000, lambda: self.continuous_temp_update())
-
 	# this tells the bath to turn on and will attempt to heat or cool to current setpoint
 	def turn_on(self):
 		if(self.cmd_controller("W GO 1") == "$\r\n"):
@@ -105,8 +201,7 @@ class Bath_Controller(Controller_Parent):
 
 	# this is the command logic which is used internally by this class and is specific to all controllers
 	def cmd_controller(self, cmd):
-		self.ser.write(b"" + cmd + "\r\n")
-		ser_rsp = self.ser.read(100)
+		ser_rsp = self.exchange(b"" + cmd + "\r\n")
 		logger.debug("Output from Bath Controller cmd: " + repr(ser_rsp))
 		if (ser_rsp == "F001\r\n"):
 			logger.error("Error from Bath Controller: " + repr(ser_rsp))
@@ -122,12 +217,38 @@ class Bath_Controller(Controller_Parent):
 			logger.warn("Not able to read temperature.")
 			return(-999)
 		else:
-			return(float(ser_rsp.split(" ")[1]))
+			temp = float(ser_rsp.split(" ")[1])
+			self.last_reading = (clock(), temp)
+			return(temp)
+
+	# the last reading if it is at most max_age seconds old, e.g. the one the Telemetry_Sampler polled,
+		# otherwise a new one. returns (device clock, temp)
+	def latest_temp(self, max_age=TEMP_MAX_AGE_S):
+		reading = self.last_reading
+		if reading is not None and clock() - reading[0] <= max_age:
+			return(reading)
+		return((clock(), self.read_temp()))
+
+	# predictive control overshoots the setpoint of large temp changes, the learned bath model is used
+		# to get there sooner and check_temp sets the real setpoint once the bath is close
+	def set_predictive(self, enabled):
+		self.overshoot = bath_model.Overshoot_Controller(self.model) if enabled else None
+		logger.info("Predictive bath control " + ("on." if enabled else "off."))
 
 	def change_temp(self, temp):
-		ser_rsp = self.cmd_controller("W SP " + str(temp))
+		setpoint = temp
+		if self.overshoot is not None:
+			current_temp = self.read_temp()
+			if current_temp != -999:
+				setpoint = self.overshoot.setpoint_for(current_temp, temp)
+				if setpoint != temp:
+					direct, predicted = self.overshoot.predicted_times(current_temp, temp)
+					logger.info("Overshooting bath setpoint to " + str(setpoint) + " to reach " + str(temp) +
+						", predicted " + str(math.floor(predicted)) + " s instead of " + str(math.floor(direct or 0.0)) + " s")
+		ser_rsp = self.cmd_controller("W SP " + str(setpoint))
 		if ser_rsp == "$\r\n":
 			self.set_temp = temp
+			self.command_temp = setpoint
 			logger.debug("Setting goal temp to: " + str(self.set_temp))
 			self.app.update_goal_temp(self.set_temp)
 			self.turn_on()
@@ -135,11 +256,29 @@ class Bath_Controller(Controller_Parent):
 		else:
 			return False
 
-	def check_temp(self):
-		current_temp = self.read_temp()
+	# sends the bath the real target in place of an overshoot setpoint, e.g. once it is close or when the
+		# calibration is paused and nothing would end the overshoot in time
+	def end_overshoot(self):
+		if self.command_temp is None or self.command_temp == self.set_temp:
+			return(True)
+		if self.cmd_controller("W SP " + str(self.set_temp)) == "$\r\n":
+			self.command_temp = self.set_temp
+			return(True)
+		return(False)
+
+	# like the other bath commands that move the setpoint, only call this from the device worker thread as
+		# it feeds the bath's model and may end an overshoot
+	def check_temp(self, tolerance=0.05):
+		read_time, current_temp = self.latest_temp()
+		self.current_temp = current_temp # last reading, recorded with the calibration events
 		self.app.update_temp(current_temp)
-		# checking if temp is within .05 degrees of setpoint and if so reporting back True
-		if (current_temp < self.set_temp + .05) and (current_temp > self.set_temp - .05):
+		if current_temp != -999 and self.command_temp is not None:
+			self.model.observe(read_time, current_temp, self.command_temp)
+			if self.overshoot is not None and self.overshoot.should_switch(current_temp, self.set_temp, self.command_temp):
+				logger.info("Bath within " + str(self.overshoot.switch_margin) + " of " + str(self.set_temp) + ", ending overshoot.")
+				self.end_overshoot()
+		# checking if temp is within tolerance (.05 degrees by default) of setpoint and if so reporting back True
+		if (current_temp < self.set_temp + tolerance) and (current_temp > self.set_temp - tolerance):
 			logger.info("Temperature reached. Carry on.")
 			return(True)
 		else:
@@ -148,8 +287,10 @@ class Bath_Controller(Controller_Parent):
 
 # controller for the Valco 6 Port Multiposition Valve Controller
 class Valve_Controller(Controller_Parent):
-	def __init__(self, app):
-		self.ser = serial.Serial(serial_list[1], 9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=1)
+	def __init__(self, app, port):
+		self.ser = open_port(port, 9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=1)
+		self.terminator = VALVE_TERMINATOR
+		self.lock = threading.RLock()
 		logger.info("Starting Valve Controller")
 		logger.debug("Connected over serial at " + str(self.ser.name))
 		self.app = app
@@ -161,10 +302,18 @@ class Valve_Controller(Controller_Parent):
 		else:
 			return(False)
 
+	# number of reply lines for commands that don't answer with exactly one, "GO" is silent on success
+	reply_lines = {"VR": 2, "GO": 0}
+
+	# seconds a silent command is given to answer with an error before it is taken as accepted
+	silent_reply_s = 0.1
+
 	def cmd_controller(self, cmd):
-		self.ser.write(b"" + cmd + "\r\n")
-		time.sleep(1)
-		ser_rsp = self.ser.read(100)
+		count = self.reply_lines.get(cmd.split(" ")[0], 1)
+		with self.lock:
+			ser_rsp = self.exchange(b"" + cmd + "\r\n", count)
+			if count == 0:
+				ser_rsp = self.read_silent_reply(self.silent_reply_s)
 		logger.debug("Output from Valve Controller cmd: " + repr(ser_rsp))
 		if ("Bad command" in ser_rsp):
 			logger.error("Error from Valve Controller: " + repr(ser_rsp))
@@ -172,30 +321,78 @@ class Valve_Controller(Controller_Parent):
 		else:
 			return(ser_rsp)
 
+	# what a silent command sent back within timeout seconds (e.g. "Bad command"), empty if nothing came
+	def read_silent_reply(self, timeout):
+		with self.lock:
+			port_timeout = self.ser.timeout
+			self.ser.timeout = timeout
+			try:
+				return(read_frame(self.ser, self.terminator, 1, timeout))
+			except serial.SerialException:
+				self.disconnect()
+				raise
+			finally:
+				self.ser.timeout = port_timeout
+
 	def turn_on(self):
 		# device is on upon power-up
 		return(True)
 
-	# set the valve position from 1 to 6
-	def set_valve(self, valve_number):
-		if (valve_number > 0 and valve_number < 7):
+	# returns the current valve position from 1 to 6, or None if the reply couldn't be read
+	def read_position(self):
+		with self.lock:
+			# anything the actuator sent after the short wait for a "GO" reply is still waiting and would be
+				# read as the position
+			self.ser.reset_input_buffer()
 			current_position_response = self.cmd_controller("CP")
-			current_position = int(filter(str.isdigit, current_position_response))
-			if valve_number == current_position:
+		current_position = filter(str.isdigit, current_position_response)
+		if current_position_response == "bad cmd" or not current_position:
+			return(None)
+		return(int(current_position))
+
+	# polls the position with a short, growing backoff until the valve reports valve_number or the
+		# deadline (in seconds) passes, instead of sleeping a fixed time after every move
+	def wait_for_position(self, valve_number, deadline):
+		give_up = clock() + deadline
+		delay = self.poll_interval
+		while True:
+			if self.read_position() == valve_number:
 				return(True)
-			else:
-				ser_rsp = self.cmd_controller("GO " + str(valve_number))
-				if ser_rsp != "bad cmd":
-					logger.debug("Setting current valve to: " + str(valve_number))
-					self.app.current_valve.set(valve_number)
-					time.sleep(1)
+			remaining = give_up - clock()
+			if remaining <= 0:
+				return(False)
+			device_sleep(min(delay, remaining))
+			delay = min(delay * 2, self.max_poll_interval)
+
+	# polling settings for set_valve, in seconds
+	move_deadline 		= 5.0
+	poll_interval 		= 0.05
+	max_poll_interval 	= 0.5
+
+	# set the valve position from 1 to 6, returns once the valco confirms the new position
+	def set_valve(self, valve_number, deadline=None):
+		if deadline is None:
+			deadline = self.move_deadline
+		if (valve_number > 0 and valve_number < 7):
+			with self.lock:
+				if valve_number == self.read_position():
 					return(True)
+				else:
+					ser_rsp = self.cmd_controller("GO " + str(valve_number))
+					if ser_rsp != "bad cmd":
+						if self.wait_for_position(valve_number, deadline):
+							logger.debug("Setting current valve to: " + str(valve_number))
+							self.app.update_valve(valve_number)
+							return(True)
+						logger.error("Valve did not reach position " + str(valve_number) + " within " + str(deadline) + " seconds.")
 		return(False)
 
 # controller for the HPLC pump
 class Pump_Controller(Controller_Parent):
-	def __init__(self):
-		self.ser = serial.Serial(serial_list[2], 9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=1)
+	def __init__(self, port):
+		self.ser = open_port(port, 9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=1)
+		self.terminator = PUMP_TERMINATOR
+		self.lock = threading.RLock()
 		logger.info("Starting HPLC Pump Controller")
 		logger.debug("Connected over serial at " + str(self.ser.name))
 
@@ -207,8 +404,7 @@ class Pump_Controller(Controller_Parent):
 			return(False)
 
 	def cmd_controller(self, cmd):
-		self.ser.write(b"" + cmd)
-		ser_rsp = self.ser.read(100)
+		ser_rsp = self.exchange(b"" + cmd)
 		logger.debug("Output from Pump Controller cmd: " + repr(ser_rsp))
 		if ser_rsp == "Er/":
 			logger.error("Error from Pump Controller: " + repr(ser_rsp))
@@ -241,6 +437,13 @@ class Pump_Controller(Controller_Parent):
 		pressure = (pressure_rsp.split(",")[1])[:-1]
 		return(pressure_rsp)
 
+	# the pressure in psi from a read_pressure reply such as "OK,1000/", NaN if the reply is malformed
+	def parse_pressure(self, pressure_rsp):
+		try:
+			return(float(pressure_rsp.split(",")[1].rstrip("/")))
+		except (IndexError, ValueError):
+			return(float('nan'))
+
 	def set_pressure_limit(self, limit):
 		if(self.cmd_controller("UP" + str(limit)) == "OK/"):
 			return(True)
@@ -253,23 +456,52 @@ class Pump_Controller(Controller_Parent):
 		else:
 			return(False)       
 
+	# sets the pressure limit and flow rate and puts the pump into run state in one batch
+	def start_flow(self, limit, flow_rate):
+		return(self.run_batch([("UP" + str(limit), "OK/"), ("FI" + str(flow_rate), "OK/"), ("RU", "OK/")]))
+
 # controller for the arduino that controls the circuit board that controls the calibration board
 class CalBoard_Controller(Controller_Parent):
-	def __init__(self):
-		self.ser = serial.Serial(serial_list[3], 9600, timeout=3)
-		time.sleep(1)
+	def __init__(self, port):
+		self.ser = open_port(port, 9600, timeout=3)
+		self.terminator = CALBOARD_TERMINATOR
+		self.lock = threading.RLock()
+		self.supports_burst = None # unknown until the first burst command is answered
+		self.protocol_version = None # set by handshake before the first command, 0 if the handshake failed
+		self.line_end = ""
+		device_sleep(1)
 		logger.info("Starting Calibration Board Controller")
 		logger.debug("Connected over serial at " + str(self.ser.name))
 
 	def is_healthy(self):
-		if (self.cmd_controller("?") == '1\r\n'):
-			return(True)
-		else:
-			return(False)
+		return(self.handshake())
+
+	# sketches from version 2 read commands up to "\n" and answer "?\n" with "1 v<version>", so commands
+		# get a newline and are answered right away. version 1 sketches wait out Serial.readString()'s one
+		# second timeout and don't know "?\n", those get a bare "?" and commands without a newline
+	def handshake(self):
+		with self.lock:
+			ser_rsp = self.exchange(b"?\n")
+			if ser_rsp.startswith("1 v"):
+				self.protocol_version = int(ser_rsp[3:].strip())
+				self.line_end = "\n"
+			elif self.exchange(b"?") == "1\r\n":
+				self.protocol_version = 1
+				self.line_end = ""
+			else:
+				# commands go out the legacy way from now on instead of repeating both round trips before
+					# every one, a reconnect makes a new controller that tries again
+				logger.error("No handshake reply from Calibration Board: " + repr(ser_rsp))
+				self.protocol_version = 0
+				self.line_end = ""
+				return(False)
+		logger.info("Calibration Board sketch protocol version " + str(self.protocol_version))
+		return(True)
 
 	def cmd_controller(self, cmd):
-		self.ser.write(b"" + cmd)
-		ser_rsp = self.ser.readline()
+		if self.protocol_version is None:
+			self.handshake()
+		ser_rsp = self.exchange(b"" + cmd + self.line_end)
 		logger.debug("Output from Calibration Board Controller cmd: " + repr(ser_rsp))
 		if ser_rsp == "F001\r\n":
 			logger.error("Error from Calibration Board Controller: " + repr(ser_rsp))
@@ -291,7 +523,7 @@ class CalBoard_Controller(Controller_Parent):
 	def normal_operation(self, gas_outlet="v9"):
 		# Normal operation while running the mass spec with gas outlet v9
 		if self.cmd_controller("normal_operation_" + gas_outlet) == "normal_operation_" + gas_outlet + "\r\n":
-			time.sleep(1)
+			device_sleep(1)
 			return True
 		return False
 
@@ -334,35 +566,71 @@ class CalBoard_Controller(Controller_Parent):
 
 	def refill_fr(self):
 		self.seawater_in()  # state two for filling the fluid reservoir
-		time.sleep(1)       # allow time to change valves
+		device_sleep(1)       # allow time to change valves
 		self.flush_on()     # begin filling fluid reservoir
 
 	def stop_refill(self, gas_outlet="v9"):
                 if gas_outlet == "":
                         gas_outlet = "v9"
 		self.flush_off()    				# turn off pump
-		time.sleep(2)       				# allow time for pressure to die down from flush pump
+		device_sleep(2)       				# allow time for pressure to die down from flush pump
 		self.normal_operation(gas_outlet)   # change back to standard ISMS calibration operation state
-		time.sleep(1)      					# allow time to change valves
+		device_sleep(1)      					# allow time to change valves
 
 	def read_press(self):
 		#Command to get the pressure transducer values
 		# three values of the form "high_press, low_press, high_low_press" returned as a list of floats
+		return(self.read_press_with_counts()[0])
+
+	# the pressures with the raw counts they were converted from, taken in one reading so the recorded
+		# counts always match the recorded pressures. uses the mean of an oversampled burst where the
+		# sketch supports it, its counts are then the means rounded to whole counts
+	def read_press_with_counts(self):
+		if self.burst_samples and self.supports_burst is not False:
+			means = self.read_press_burst(self.burst_samples)
+			if means is not None:
+				return((pressure_converter.convert(means), [int(round(mean)) for mean in means]))
+		counts = self.read_press_counts()
+		return((pressure_converter.convert(counts), counts))
+
+	# readings averaged by read_press, 0 always uses the single reading "press" command
+	burst_samples = 16
+
+	# "burst <n>" frame: sync byte, n, then the mean * 16, minimum, and maximum counts of each transducer
+		# as little endian uint16s, then a checksum of every byte after the sync byte mod 256
+	burst_sync = "\xb5"
+	burst_format = "<BB9HB"
+	burst_size = struct.calcsize(burst_format)
+
+	# n oversampled readings of each transducer in one round trip, returned as the list of their (fractional)
+		# mean counts, or None if the sketch doesn't support it or the frame is bad. the frame's minimum and
+		# maximum counts are checksummed but not used
+	def read_press_burst(self, samples):
+		if self.protocol_version is None:
+			self.handshake()
+		frame = self.exchange_binary(b"" + "burst " + str(samples) + self.line_end, self.burst_sync, self.burst_size)
+		if not frame.startswith(self.burst_sync):
+			if frame == "F001\r\n":
+				logger.info("Calibration Board sketch does not support burst reads, using single reads.")
+				self.supports_burst = False
+			elif not frame:
+				# a sketch that ignores the command would cost every later read the full timeout
+				logger.warn("No reply to a burst read from the Calibration Board, using single reads.")
+				self.supports_burst = False
+			else:
+				logger.error("No burst reply from Calibration Board: " + repr(frame))
+			return(None)
+		if len(frame) != self.burst_size or sum(bytearray(frame[1:-1])) % 256 != ord(frame[-1]):
+			logger.error("Bad burst frame from Calibration Board: " + repr(frame))
+			return(None)
+		self.supports_burst = True
+		stats = struct.unpack(self.burst_format, frame)[2:-1]
+		return([mean / 16.0 for mean in stats[0::3]])
+
+	# the raw ADC counts of the three transducers, see pressure_conversion for converting them
+	def read_press_counts(self):
 		pressures 		= self.cmd_controller("press")
-		press_list 		= map(int, pressures.split(", "))
-		high_press 		= 2000.0 * (press_list[0]/1023.0) * 5.0 - 1000.0
-		low_press 		= 75.0   * (press_list[1]/1023.0) * 5.0 - 37.5
-		high_low_press 	= 750.0 * (press_list[2]/1023.0) * 5.0 - 375.0
-		#pressure 	= max pressure/(4.5V-.5V) * (voltage/max voltage) * 5V - offset (max pressure/(4.5V-.5V)*.5V)
-
-		converted_pressures = [high_press, low_press, high_low_press]
-		final_pressures = []
-		for pressure in converted_pressures:
-			if pressure < 0.00:
-				pressure = 0.00
-			pressure = float("{0:.2f}".format(pressure))
-			final_pressures.append(pressure)
-		return(final_pressures)
+		return(map(int, pressures.split(", ")))
 
 
 
@@ -370,6 +638,8 @@ class MFC_Controller_Parent(Controller_Parent):
 	def __init__(self):
 		self.serial_num = None
 		self.ser = None
+		self.terminator = MFC_TERMINATOR
+		self.lock = threading.RLock()
 
 	def is_healthy(self):
 		if (self.serial_num in self.cmd_controller("?Srnm")):
@@ -383,8 +653,16 @@ class MFC_Controller_Parent(Controller_Parent):
 	def set_streaming_state(self, mode):
 		self.cmd_controller('!Strm' + mode)
 
+	# the measured flow, None if the reply can't be parsed
 	def read_flow(self):
-		self.cmd_controller("?Flow")
+		rsp = self.cmd_controller("?Flow")
+		# the reply is Flow followed by the value, the two crc bytes, and the terminator
+		if not rsp.startswith("Flow"):
+			return(None)
+		try:
+			return(float(rsp[4:-3]))
+		except ValueError:
+			return(None)
 
 	def read_gas(self):
 		self.cmd_controller('?Gasi')
@@ -403,26 +681,26 @@ class MFC_Controller_Parent(Controller_Parent):
 		9 - NO
 		10 - O
 		"""
-		rsp = "Gasi" + str(gas_index) 
-		rsp = rsp + calcCRC(rsp) + '\x0d'
+		rsp = frame_command("Gasi" + str(gas_index))
 		if (self.cmd_controller("!Gasi" + str(gas_index)) == rsp):
 			return(True)
 		else:
 			return(False)
 
 	def set_setpoint(self, setpoint):
-		rsp = "Sinv" + ('%.3f' % setpoint)
-		rsp = rsp + calcCRC(rsp) + '\x0d'
+		rsp = frame_command("Sinv" + ('%.3f' % setpoint))
 		if (self.cmd_controller("!Sinv" + ('%.3f' % setpoint)) == rsp):
 			return(True)
 		else:
 			return(False)
 
+	# set_setpoint then set_gas in one batch
+	def set_setpoint_and_gas(self, setpoint, gas_index):
+		return(self.run_batch([("!Sinv" + ('%.3f' % setpoint), frame_command("Sinv" + ('%.3f' % setpoint))),
+			("!Gasi" + str(gas_index), frame_command("Gasi" + str(gas_index)))]))
+
 	def cmd_controller(self, cmd):
-		crc = calcCRC(cmd)
-		cmd = cmd + (crc) + '\x0d'
-		self.ser.write(cmd)
-		ser_rsp = self.ser.read(500)
+		ser_rsp = self.exchange(frame_command(cmd))
 		logger.debug("Output from MFC Controller cmd with repr(): " + repr(ser_rsp))
 		logger.debug("Output from MFC Controller cmd *without* repr(): " + ser_rsp)
 		return(ser_rsp)
@@ -437,26 +715,28 @@ class MFC_Controller_Parent(Controller_Parent):
 # mass flow controller one
 # this is typically the Nitrogen MFC
 class MFC_Controller_One(MFC_Controller_Parent):
-	def __init__(self, app):
-		# The serial_list index and serial number will change depending on device
-		self.ser = serial.Serial(serial_list[4], 9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=3)
-		time.sleep(1)
+	def __init__(self, app, port, serial_num):
+		# the port and serial number will change depending on device, see rig_config
+		self.ser = open_port(port, 9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=3)
+		self.terminator = MFC_TERMINATOR
+		self.lock = threading.RLock()
+		device_sleep(1)
 		logger.info("Starting MFC Controller One (Nitrogen)")
 		logger.debug("Connected over serial at " + str(self.ser.name))
-		# this is the serial num for the new Smart Trak 100
-		self.serial_num = 'Srnm210704\x8c\x92\r'
+		self.serial_num = serial_num
 		self.turn_on()
 
 # mass flow controller two
 # this is typically the calibration gas MFC
 class MFC_Controller_Two(MFC_Controller_Parent):
-	def __init__(self, app):
-		self.ser = serial.Serial(serial_list[5], 9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=3)
-		time.sleep(1)
+	def __init__(self, app, port, serial_num):
+		self.ser = open_port(port, 9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=3)
+		self.terminator = MFC_TERMINATOR
+		self.lock = threading.RLock()
+		device_sleep(1)
 		logger.info("Starting MFC Controller Two (Calibration Gas)")
 		logger.debug("Connected over serial at " + str(self.ser.name))
-		# this is the serial num for the old Smart Trak 2
-		self.serial_num = 'Srnm1380145\x93\r'
+		self.serial_num = serial_num
 		self.turn_on()
 
 # not currently in use, just a skeleton controller for commanding the future sampling setup
@@ -484,12 +764,329 @@ class Sampling_Controller(Controller_Parent):
 		else:
 			return(True)
 
+#######################
+### Device Registry ###
+#######################
+
+# registry of one rig's serial devices. each of the rig's ports is opened once and the same controller
+	# instance is handed to every caller instead of opening, sleeping, and closing the port on every GUI
+	# action (the calboard Arduino also resets every time its port is opened)
+class Device_Registry(object):
+	# names of the devices in the same order as serial_list
+	device_names = rig_config.DEVICE_NAMES
+	device_labels = {'bath': "Bath Controller", 'valve': "Valve Controller", 'pump': "HPLC Pump",
+		'calboard': "Calboard", 'mfc1': "MFC One", 'mfc2': "MFC Two"}
+
+	def __init__(self, app, rig=None):
+		self.app = app
+		self.rig = rig or default_rig
+		self.controllers = {}
+		# one lock per device so opening a slow device doesn't hold up the others
+		self.locks = dict((name, threading.RLock()) for name in self.device_names)
+
+	def create(self, name):
+		if name == 'bath':
+			return(Bath_Controller(self.app, self.rig.port(name)))
+		elif name == 'valve':
+			return(Valve_Controller(self.app, self.rig.port(name)))
+		elif name == 'pump':
+			return(Pump_Controller(self.rig.port(name)))
+		elif name == 'calboard':
+			return(CalBoard_Controller(self.rig.port(name)))
+		elif name == 'mfc1':
+			return(MFC_Controller_One(self.app, self.rig.port(name), self.rig.mfc_serial(name)))
+		elif name == 'mfc2':
+			return(MFC_Controller_Two(self.app, self.rig.port(name), self.rig.mfc_serial(name)))
+		raise ValueError("Unknown device: " + str(name))
+
+	# returns the shared controller, (re)opening the port if it was never opened or has since failed
+	def get(self, name):
+		with self.locks[name]:
+			controller = self.controllers.get(name)
+			if controller is not None and controller.is_connected():
+				return(controller)
+			if controller is not None:
+				logger.warn("Lost connection to " + name + ", reconnecting.")
+			controller = self.create(name)
+			self.controllers[name] = controller
+			return(controller)
+
+	def bath(self):
+		return(self.get('bath'))
+
+	def valve(self):
+		return(self.get('valve'))
+
+	def pump(self):
+		return(self.get('pump'))
+
+	def calboard(self):
+		return(self.get('calboard'))
+
+	def mfc1(self):
+		return(self.get('mfc1'))
+
+	def mfc2(self):
+		return(self.get('mfc2'))
+
+	def is_open(self, name):
+		controller = self.controllers.get(name)
+		return(controller is not None and controller.is_connected())
+
+	# the shared controller if its port is open, never opens one
+	def peek(self, name):
+		controller = self.controllers.get(name)
+		if controller is not None and controller.is_connected():
+			return(controller)
+		return(None)
+
+	def disconnect(self, name):
+		with self.locks[name]:
+			controller = self.controllers.pop(name, None)
+		if controller is not None:
+			try:
+				controller.disconnect()
+			except Exception as e:
+				template = str(type(e).__name__) + " occured. Arguments:" + str(e.args)
+				logger.error(template)
+
+	# finds the ports of the devices that aren't open with port_discovery, for rigs that ask for it.
+		# returns the devices that had to be probed for
+	def discover_ports(self):
+		if not self.rig.discover:
+			return([])
+		closed = [name for name in self.device_names if not self.is_open(name)]
+		if not closed:
+			return([])
+		busy = [self.rig.port(name) for name in self.device_names if self.is_open(name)]
+		ports, probed = port_discovery.discover(self.rig, closed, busy, port_map_path)
+		for name in closed:
+			if ports[name] != self.rig.port(name):
+				logger.info("Found the " + self.device_labels[name] + " on " + ports[name] + ".")
+		self.rig = self.rig.with_ports(ports)
+		return(probed)
+
+	# drops what port_discovery cached for devices that failed the health check
+	def forget_ports(self, names):
+		if self.rig.discover and names:
+			port_discovery.forget(self.rig, names, port_map_path)
+
+	# close every open port, called when the application exits
+	def close_all(self):
+		for name in list(self.controllers.keys()):
+			self.disconnect(name)
+		logger.debug("Closed all serial connections.")
+
+#########################
+### Background Worker ###
+#########################
+
+# background thread that runs blocking device I/O off the Tk main thread. jobs run one at a time in
+	# the order they were submitted and each result is handed back through app.post, so callbacks
+	# always run on the Tk thread
+class Device_Worker(threading.Thread):
+	def __init__(self, app):
+		threading.Thread.__init__(self, name="Device_Worker")
+		self.daemon = True
+		self.app = app
+		self.jobs = Queue.Queue()
+
+	def submit(self, func, args=(), callback=None):
+		self.jobs.put((func, args, callback))
+
+	def stop(self):
+		self.jobs.put((None, (), None))
+
+	def run(self):
+		while True:
+			func, args, callback = self.jobs.get()
+			if func is None:
+				break
+			try:
+				result = func(*args)
+			except Exception as e:
+				logger.error(str(type(e).__name__) + " occured. Arguments:" + str(e.args))
+				self.app.post(worker_job_failed, self.app, e)
+				continue
+			if callback is not None:
+				self.app.post(callback, result)
+
+# runs on the Tk thread in place of the callback of a worker job that raised. a calibration can't carry
+	# on from a tick that failed half way (its next tick is only scheduled by the callback), so it is
+	# stopped and the rig is made safe
+def worker_job_failed(app, error):
+	app.set_error(str(type(error).__name__) + " occured. Arguments:" + str(error.args))
+	if app.calibrating:
+		app.calibrating 		= False
+		app.paused 				= False
+		app.currently_sampling 	= False
+		app.refilling_fr 		= False
+		app.set_status("Calibration stopped after a device error.")
+		logger.error("Calibration stopped after a device error, shutting down the bath and pump.")
+		data_logger.info("Calibration stopped after a device error.")
+		app.worker.submit(safe_shutdown, (app.devices,))
+
+#########################
+### Telemetry Sampler ###
+#########################
+
+# fixed size buffer of the most recent telemetry samples, the oldest sample is overwritten once full
+class Ring_Buffer(object):
+	def __init__(self, capacity):
+		self.capacity 	= capacity
+		self.samples 	= [None] * capacity
+		self.count 		= 0 # total samples ever added
+		self.lock 		= threading.Lock()
+
+	def append(self, sample):
+		with self.lock:
+			self.samples[self.count % self.capacity] = sample
+			self.count += 1
+
+	def latest(self):
+		with self.lock:
+			if self.count == 0:
+				return(None)
+			return(self.samples[(self.count - 1) % self.capacity])
+
+	# samples in the order they were taken, optionally only those newer than since (device clock)
+	def history(self, since=None):
+		with self.lock:
+			start = max(0, self.count - self.capacity)
+			samples = [self.samples[i % self.capacity] for i in range(start, self.count)]
+		if since is not None:
+			samples = [sample for sample in samples if sample[0] > since]
+		return(samples)
+
+# background thread that polls the calboard pressures and HPLC pump pressure every period seconds and the
+	# bath temperature every temp_period seconds into a ring buffer, shows the latest values in the GUI,
+	# and writes the mean of every decimation samples to disk. only ports that are already open are
+	# polled, and a device that is busy with a calibrate_slave command is skipped for that round instead
+	# of queueing behind it. the bath readings are what the GUI temp readout and check_temp are served
+	# from (see Bath_Controller.latest_temp). temp_period is rounded to a whole number of periods, the
+	# default of 2 s sends the bath 0.5 R T1 a second, and check_temp only adds its own read on the
+	# rare tick where the sampler's poll was skipped (before, the readout and check_temp took about 0.4
+	# a second on top of a poll every second)
+class Telemetry_Sampler(threading.Thread):
+	channels = ['timestamp', 'high_press', 'low_press', 'high_low_press', 'hplc_pressure', 'bath_temp']
+
+	def __init__(self, app, path, period=1.0, capacity=3600, decimation=10, temp_period=2.0):
+		threading.Thread.__init__(self, name=threading.current_thread().name + "/Telemetry_Sampler")
+		self.daemon 		= True
+		self.app 			= app
+		self.period 		= period
+		self.decimation 	= decimation
+		self.temp_every 	= max(1, int(round(temp_period / period))) # rounds between bath polls
+		self.rounds 		= 0
+		self.buffer 		= Ring_Buffer(capacity)
+		self.recorder 		= data_recorder.Data_Recorder(path)
+		self.skipped 		= 0 # polls skipped because the device was busy
+		self.stopped 		= threading.Event()
+
+	def stop(self):
+		self.stopped.set()
+
+	# runs read(controller) if the device is open and not in the middle of another command
+	def poll(self, name, read):
+		controller = self.app.devices.peek(name)
+		if controller is None:
+			return(None)
+		if not controller.lock.acquire(False):
+			self.skipped += 1
+			return(None)
+		try:
+			return(read(controller))
+		except Exception as e:
+			logger.debug("Telemetry read from " + name + " failed: " + str(type(e).__name__) + str(e.args))
+			return(None)
+		finally:
+			controller.lock.release()
+
+	def sample(self):
+		nan = float('nan')
+		pressures = self.poll('calboard', lambda cc: cc.read_press()) or [nan, nan, nan]
+		hplc_pressure = self.poll('pump', lambda pc: pc.parse_pressure(pc.read_pressure()))
+		bath_temp = None
+		if self.rounds % self.temp_every == 0:
+			bath_temp = self.poll('bath', lambda bc: bc.read_temp())
+			if bath_temp == -999: # read_temp's failed read value
+				bath_temp = None
+			if bath_temp is not None:
+				self.app.update_temp(bath_temp)
+		self.rounds += 1
+		return((clock(), pressures[0], pressures[1], pressures[2],
+			nan if hplc_pressure is None else hplc_pressure, nan if bath_temp is None else bath_temp))
+
+	# writes the mean of each channel over samples, ignoring channels that weren't read
+	def record_mean(self, samples):
+		values = {}
+		for index, channel in enumerate(self.channels):
+			readings = [sample[index] for sample in samples if not math.isnan(sample[index])]
+			values[channel] = sum(readings) / len(readings) if readings else None
+		self.recorder.record(data_recorder.EVENT_TELEMETRY, **values)
+
+	def run(self):
+		pending = []
+		next_poll = clock()
+		while not self.stopped.is_set():
+			sample = self.sample()
+			self.buffer.append(sample)
+			self.app.update_pressures(sample[1], sample[2], sample[4])
+			pending.append(sample)
+			if len(pending) >= self.decimation:
+				self.record_mean(pending)
+				pending = []
+			next_poll += self.period
+			if next_poll < clock():
+				next_poll = clock() # polling fell behind, don't try to catch up with a burst
+			self.stopped.wait((next_poll - clock()) / serial_framing.time_scale)
+		if pending:
+			self.record_mean(pending)
+		self.recorder.close()
+
+###################
+### Status Sink ###
+###################
+
+# what calibrate_master, calibrate_slave, and the health and setup checks report their progress to. the
+	# Tk Application shows it in the GUI, calibrate_headless logs it. every method can be called from
+	# the device worker thread. it has no base class so it mixes into the old style Tk Application the
+	# same way whether or not Tk is installed
+class Status_Sink:
+	def set_status(self, msg):
+		pass
+
+	def set_details(self, msg):
+		pass
+
+	def set_error(self, msg):
+		pass
+
+	def update_valve(self, valve_number):
+		pass
+
+	def update_temp(self, current_temp):
+		pass
+
+	def update_goal_temp(self, the_set_temp):
+		pass
+
+	def update_pressures(self, high_press, low_press, hplc_pressure):
+		pass
+
 ################################
 ### Main tkinter Application ###
 ################################
 
+# the Application can only be created where Tk is installed, the rest of this module works without it
+class No_Tk_Frame:
+	def __init__(self, master=None, **options):
+		raise RuntimeError("Tkinter is not installed.")
+
+Frame = tk.Frame if tk is not None else No_Tk_Frame
+
 # this is the actual GUI code that is executed in the main() function to create the GUI
-class Application(tk.Frame):
+class Application(Frame, Status_Sink):
 	def __init__(self, master=None):
 		tk.Frame.__init__(self, master, padx=25, pady=25)
 		self.grid()
@@ -521,6 +1118,9 @@ class Application(tk.Frame):
 		self.time_string            = tk.IntVar()
 		self.temp_readout           = tk.DoubleVar()
 		self.goal_temp              = tk.DoubleVar()
+		self.high_press_readout 	= tk.DoubleVar()
+		self.low_press_readout 		= tk.DoubleVar()
+		self.hplc_press_readout 	= tk.DoubleVar()
 		self.set_valve              = tk.IntVar()
 		self.set_temp               = tk.DoubleVar()
 		self.in_manual              = False
@@ -529,6 +1129,24 @@ class Application(tk.Frame):
 		self.mfc1_flow 				= tk.IntVar()
 		self.mfc2_flow 				= tk.IntVar()
 		self.gas_outlet 			= tk.StringVar()
+		self.recipe_path 			= tk.StringVar()
+		self.recipe_path.set(calibration_recipe.DEFAULT_RECIPE)
+		self.predictive_bath 		= tk.BooleanVar()
+		self.predictive_bath.set(False)
+		# where this app's calibration is recorded, learned, and checkpointed
+		self.recorder 				= recorder
+		self.bath_model 			= learned_bath
+		self.checkpoint_path 		= checkpoint_path
+		self.devices 				= Device_Registry(self)
+
+		# device I/O for the calibration runs on the worker, which reports back through ui_queue
+		self.ui_queue 				= Queue.Queue()
+		self.worker 				= Device_Worker(self)
+		self.worker.start()
+		self.process_ui_queue()
+
+		# started once the health check has opened the devices
+		self.telemetry 				= Telemetry_Sampler(self, 'telemetry_' + showtime + '.isms')
 
 		self.createWidgets()
 
@@ -546,6 +1164,12 @@ class Application(tk.Frame):
 		ttk.Label(device_readouts, textvariable=self.goal_temp).grid(column=1, row=4)
 		ttk.Label(device_readouts, text="seconds elapsed").grid(column=2, row=5)
 		ttk.Label(device_readouts, textvariable=self.time_string).grid(column=1, row=5)
+		ttk.Label(device_readouts, text="high loop psi").grid(column=2, row=6)
+		ttk.Label(device_readouts, textvariable=self.high_press_readout).grid(column=1, row=6)
+		ttk.Label(device_readouts, text="low loop psi").grid(column=2, row=7)
+		ttk.Label(device_readouts, textvariable=self.low_press_readout).grid(column=1, row=7)
+		ttk.Label(device_readouts, text="HPLC psi").grid(column=2, row=8)
+		ttk.Label(device_readouts, textvariable=self.hplc_press_readout).grid(column=1, row=8)
 
 		status_readouts = tk.Frame(self, borderwidth=2, relief=tk.SUNKEN, pady=10, padx=10, bg="grey")
 		status_readouts.grid(column=2, row=2, sticky=tk.NW)
@@ -589,36 +1213,27 @@ class Application(tk.Frame):
 			child.grid_configure(padx=5, pady=5, sticky=tk.W)
 
 	def check_health(self):
-		if (system_health_check(self)):
+		self.details.set("Running through prechecks...")
+		self.worker.submit(system_health_check, (self,), self.health_check_done)
+
+	def health_check_done(self, healthy):
+		if (healthy):
 			self.system_healthy = True
+			if not self.telemetry.is_alive():
+				self.telemetry.start()
 		else:
 			self.system_healthy = False
 
 	def kill(self):
 		logger.info("Running through kill application safety procedures.\n\n")
+		self.worker.stop()
+		self.telemetry.stop()
 		self.quit()
 		if self.safe_to_kill:
 			self.quit()
 		else:
 			try:
-				bc = Bath_Controller(self)
-				bc.stop_bath()
-				bc.ser.close()
-				
-				pc = Pump_Controller()
-				pc.stop_pump()
-				pc.ser.close()
-
-				vc = Valve_Controller(self)
-				vc.set_valve(1) # setting to 0 psi state
-				vc.ser.close()
-
-				cc = CalBoard_Controller()
-				cc.release_press()
-				time.sleep(4)
-				cc.reset()
-				cc.ser.close()
-
+				safe_shutdown(self.devices)
 				self.safe_to_kill = True
 				self.quit()
 			except Exception as e:
@@ -626,6 +1241,7 @@ class Application(tk.Frame):
 				logger.error(template)
 				logger.warn("Not able to kill one or more serial devices.")
 				self.quit()
+			self.devices.close_all()
 
 	def quite_and_purge(self):
 		t = tk.Toplevel(self, padx=50, pady=50)
@@ -641,66 +1257,58 @@ class Application(tk.Frame):
 		for child in t.winfo_children():
 			child.grid_configure(padx=5, pady=5, sticky=tk.W)
 
-		bc = Bath_Controller(self)
+		bc = self.devices.bath()
 		bc.stop_bath()
-		bc.ser.close()
 
-		pc = Pump_Controller()
+		pc = self.devices.pump()
 		pc.stop_pump()
-		pc.ser.close()
 		
-		vc = Valve_Controller(self)
+		vc = self.devices.valve()
 		vc.set_valve(1) # setting to 0 psi state
-		vc.ser.close()
 
-		cc = CalBoard_Controller()
+		cc = self.devices.calboard()
 		cc.emptying_fr()
-		cc.ser.close()
 
 	def done_purging_seawater(self):
-		cc = CalBoard_Controller()
+		cc = self.devices.calboard()
 		cc.di_water_in()
 		cc.flush_on()
-		cc.ser.close()
 
 	def done_refilling_with_di(self):
 		# set up quick run through of all BPVs to clean them out
-		cc = CalBoard_Controller()
+		cc = self.devices.calboard()
 		cc.normal_operation("v9")
-		time.sleep(1)
-		vc = Valve_Controller(self)
+		device_sleep(1)
+		vc = self.devices.valve()
 		vc.set_valve(1) # setting to 0 psi state
-		pc = Pump_Controller()
+		pc = self.devices.pump()
 		pc.turn_on()
-		time.sleep(4)
+		device_sleep(4)
 		vc.set_valve(6) # setting to 1000 psi state
-		time.sleep(4)
+		device_sleep(4)
 		vc.set_valve(5) # setting to 2000 psi state
-		time.sleep(4)
+		device_sleep(4)
 		vc.set_valve(4) # setting to 3000 psi state
-		time.sleep(4)
+		device_sleep(4)
 		vc.set_valve(3) # setting to 4000 psi state
-		time.sleep(4)
+		device_sleep(4)
 		vc.set_valve(2) # setting to 5000 psi state
-		time.sleep(4)
+		device_sleep(4)
 
 		# release pressure on high press loop and turn off pump and valve controller
 		vc.set_valve(1)
 		pc.stop_pump()
-		vc.ser.close()
-		pc.ser.close()
 
 		# set calibration board to empty FR
 		cc.emptying_fr()
-		cc.ser.close()
 
 	def done_with_purge_quit(self):
 		# release pressure within low press loop and kill application
-		cc = CalBoard_Controller()
+		cc = self.devices.calboard()
 		cc.release_press()
-		time.sleep(4)
+		device_sleep(4)
 		cc.reset()
-		cc.ser.close()
+		self.devices.close_all()
 		self.safe_to_kill = True
 		self.quit()
 			
@@ -767,7 +1375,11 @@ class Application(tk.Frame):
 			ttk.Button(t, text='Stop Refilling', command= lambda: self.stop_refill_button(self.gas_outlet.get())).grid(column=2, row=8)
 			
 			done_button = ttk.Button(t, text='Begin Cooling + Pressurization', command=lambda : self.calibration_setup(t))
-			done_button.grid(column=2, row=9, rowspan=1)
+			ttk.Label(t, text="Calibration recipe file:").grid(column = 2, row = 9)
+			ttk.Entry(t, width=40, textvariable=self.recipe_path).grid(column=3, row=9)
+			ttk.Checkbutton(t, text="Predictive bath control (overshoot the setpoint using the learned bath model)",
+				variable=self.predictive_bath).grid(column=2, row=10, columnspan=2)
+			done_button.grid(column=2, row=11, rowspan=1)
 
 
 			# create padding for all items
@@ -777,73 +1389,53 @@ class Application(tk.Frame):
 			done_button.grid(sticky=tk.E)
 
 	def calibration_setup(self, setup_window):
-		# turning on the MFCs
-		mfc1 = MFC_Controller_One(self)
-		mfc1.set_setpoint(self.mfc1_flow.get())
-		mfc1.set_gas(8) 					#setting gas to Nitrogen
-		mfc1.ser.close()
-
-		mfc2 = MFC_Controller_Two(self)
-		mfc2.set_setpoint(self.mfc2_flow.get())
-		mfc2.set_gas(self.gas_selected) 	#setting gas to gas_selected
-		mfc2.ser.close()
-
-		data_logger.info("MFCs On.")
-
-		vc = Valve_Controller(self)
-		cc = CalBoard_Controller()
-
-		# get solenoid valves in correct state
-		cc.normal_operation(self.gas_outlet.get()) 	# put the calibration board into normal calibration operation state
-		vc.set_valve(1) 			# setting the valve to the zero pressure setting
-		time.sleep(1)				# wait for valco to get set
-		vc.ser.close()
-		print(cc.read_press())
-		cc.ser.close()
-
-		# turning on the HPLC pump
-		pc = Pump_Controller()
-		pc.set_pressure_limit(6000) # max press at 6000 psi
-		time.sleep(1)
-		pc.set_flow_rate(2000)		# 20ml/min
-		time.sleep(1)
-		pc.turn_on()				# setting to run state
-		data_logger.info("HPLC Pump On.")
-		pc.ser.close()
-
-		# send the bath to 2 degrees
-		bc = Bath_Controller(self)
-		# operationa value 
-		bc.change_temp(2)
-		# test value
-		#bc.change_temp(20.1)
-		bc.ser.close()
-
-		data_logger.info("Bath cooling to 2.")
+		settings = {'gas_index': self.gas_index, 'mfc1_setpoint': self.mfc1_flow.get(), 'mfc2_setpoint': self.mfc2_flow.get()}
 		self.status.set("Cooling + Pressurization Ongoing")
 		self.system_setup = True
-
-		counter = 0
-		self.wait_for_cooldown(counter)
+		# the devices are set up on the worker, setup is complete once the readings say so
+		self.worker.submit(calibration_setup, (self, self.gas_outlet.get(), settings, self.predictive_bath.get()),
+			lambda controllers: start_setup_checks(self, controllers, settings))
 
 		setup_window.destroy()
 
-	def wait_for_cooldown(self, counter):
-		if counter >= 120:
-			data_logger.info("Cooling + Pressurization Complete!")
-			logger.info("Cooling + Pressurization Complete!")
-			self.status.set("Calibration setup complete!")
-			self.details.set("Cooling down and pressure equilibration complete!")
-		else:
-			logger.info("Cooling + Pressurization Ongoing. " + str((120 - counter) * 30) + " seconds remain.")
-			counter += 1
-			self.after(30000, lambda: self.wait_for_cooldown(counter))
+	# Tk is not thread safe so background threads hand GUI work to the Tk thread through ui_queue
+	def post(self, func, *args):
+		self.ui_queue.put((func, args))
+
+	def process_ui_queue(self):
+		self.after(50, self.process_ui_queue)
+		while True:
+			try:
+				func, args = self.ui_queue.get_nowait()
+			except Queue.Empty:
+				break
+			func(*args)
+
+	# thread safe setters, usable from the device worker as well as the Tk thread
+	def set_status(self, msg):
+		self.post(self.status.set, msg)
+
+	def set_details(self, msg):
+		self.post(self.details.set, msg)
+
+	def set_error(self, msg):
+		self.post(self.errors.set, msg)
+
+	def update_valve(self, valve_number):
+		self.post(self.current_valve.set, valve_number)
 
 	def update_temp(self, current_temp):
-		self.temp_readout.set(current_temp)
+		self.post(self.temp_readout.set, current_temp)
 
 	def update_goal_temp(self, the_set_temp):
-		 self.goal_temp.set(the_set_temp)
+		self.post(self.goal_temp.set, the_set_temp)
+
+	# latest telemetry readings, NaN readings leave the last value shown
+	def update_pressures(self, high_press, low_press, hplc_pressure):
+		for readout, value in ((self.high_press_readout, high_press), (self.low_press_readout, low_press),
+				(self.hplc_press_readout, hplc_pressure)):
+			if not math.isnan(value):
+				self.post(readout.set, value)
 
 	def begin_timer(self, start_time):
 		self.time_string.set(math.floor(time.time() - start_time))
@@ -854,11 +1446,11 @@ class Application(tk.Frame):
 
 	def start_refill(self):
 		self.refilling_fr = True
-		cc = CalBoard_Controller()
+		cc = self.devices.calboard()
 		cc.refill_fr()
 
 	def stop_refill_button(self, gas_outlet):
-		cc = CalBoard_Controller()
+		cc = self.devices.calboard()
 		cc.stop_refill(gas_outlet)
 		self.refilling_fr = False
 
@@ -872,7 +1464,13 @@ class Application(tk.Frame):
 			self.errors.set(err_msg)
 			logger.warn(err_msg)
 		else:
-			calibrate_master(self)
+			# a calibration that didn't finish can be picked up from its last sample
+			checkpoint = calibration_checkpoint.load(self.checkpoint_path)
+			if checkpoint is not None and not tkMessageBox.askyesno("Resume calibration",
+					"A calibration was interrupted at " + calibration_checkpoint.describe(checkpoint) + ".\n\n" +
+					"Resume it? No starts the recipe over."):
+				checkpoint = None
+			calibrate_master(self, checkpoint=checkpoint)
 
 	def pause(self):
 		if self.calibrating:
@@ -896,32 +1494,30 @@ class Application(tk.Frame):
 			self.errors.set(err_msg)
 			logger.warn(err_msg)
 			return
-		bc = Bath_Controller(self)
 		input_temp = self.set_temp.get()
-		bc.change_temp(input_temp)
-		bc.turn_on()
 		self.details.set("Commanding temp to " + str(input_temp))
 		logger.info("Commanding temp to " + str(input_temp))
-		bc.check_temp()
-		bc.ser.close()
+		self.worker.submit(manual_change_temp, (self, input_temp))
 
 	def manual_set_valve(self):
 		if self.in_manual:
-			vc = Valve_Controller(self)
-			commanding = vc.set_valve(self.set_valve.get())
-			vc.ser.close()
-			if (commanding == True):
-				self.details.set("Commanding valve: " + str(self.set_valve.get()))
-				logger.info("Commanding valve to: " + str(self.set_valve.get()))
-			else:
-				err_msg = "Could not command to designated valve."
-				self.errors.set(err_msg)
-				logger.error(err_msg)
+			valve_number = self.set_valve.get()
+			self.worker.submit(manual_set_valve, (self, valve_number),
+				lambda commanding: self.manual_set_valve_done(valve_number, commanding))
 		else:
 				err_msg = "We're not in manual mode!"
 				self.errors.set(err_msg)
 				logger.warn(err_msg)
 
+	def manual_set_valve_done(self, valve_number, commanding):
+		if (commanding == True):
+			self.details.set("Commanding valve: " + str(valve_number))
+			logger.info("Commanding valve to: " + str(valve_number))
+		else:
+			err_msg = "Could not command to designated valve."
+			self.errors.set(err_msg)
+			logger.error(err_msg)
+
 	# triggered on change in gas drop down
 	def gas_selected(self, value):
 		"""
@@ -955,102 +1551,92 @@ class Application(tk.Frame):
 ### Utility Functions ###
 #########################
 
-def check_serial():
-	for index, serial_port in enumerate(serial_list):
+def check_serial(devices=None):
+	ports = (devices.rig if devices is not None else default_rig).port_list()
+	serial_check_list = [None] * len(ports)
+	def check_port(index):
+		serial_port = ports[index]
+		# ports already held open by the device registry are known good and can't be opened twice
+		if devices is not None and devices.is_open(Device_Registry.device_names[index]):
+			serial_check_list[index] = serial_port
+			return
 		try:
-			ser = serial.Serial(serial_port, timeout=2)		# open serial port
+			ser = open_port(serial_port, timeout=2)		# open serial port
 			serial_check_list[index] = ser.name     		# check which port was really used
 			ser.close()                             		# close port
 			logger.debug("Acquired serial connection.")
 		except Exception as e:
 			template = str(type(e).__name__) + " occured. Arguments:" + str(e.args)
 			logger.error(template)
+	run_concurrently(check_port, range(len(ports)))
 	return serial_check_list
 
+# runs on the device worker thread, where every command that moves the bath setpoint is sent from
+def manual_change_temp(app, input_temp):
+	bc = app.devices.bath()
+	bc.change_temp(input_temp)
+	bc.turn_on()
+	bc.check_temp()
+
+# runs on the device worker thread, set_valve waits up to the valve's move_deadline for the new position
+def manual_set_valve(app, valve_number):
+	return(app.devices.valve().set_valve(valve_number))
+
+# stops the bath and the HPLC pump and releases the pressure in both loops
+def safe_shutdown(devices):
+	bc = devices.bath()
+	bc.stop_bath()
+	
+	pc = devices.pump()
+	pc.stop_pump()
+
+	vc = devices.valve()
+	vc.set_valve(1) # setting to 0 psi state
+
+	cc = devices.calboard()
+	cc.release_press()
+	device_sleep(4)
+	cc.reset()
+
+# probes a single device for system_health_check, returns (healthy, seconds taken, status)
+def check_device(app, name):
+	start = time.time()
+	try:
+		healthy = app.devices.get(name).is_healthy()
+		status = "OK" if healthy else "bad reply"
+	except Exception as e:
+		healthy = False
+		status = str(type(e).__name__)
+		logger.error(str(type(e).__name__) + " occured. Arguments:" + str(e.args))
+	if not healthy:
+		# drop the connection so the next precheck starts from a freshly opened port
+		app.devices.disconnect(name)
+	return((healthy, time.time() - start, status))
+
+# devices that must be healthy to pass the precheck, the valve is probed and reported but its
+	# check has been disabled so it doesn't fail the precheck
+required_devices = ['bath', 'pump', 'calboard', 'mfc1', 'mfc2']
+
+# runs on the device worker thread, checks every device at once with one thread per port and reports
+	# a status and latency table back to the GUI
 def system_health_check(app):
-	app.details.set("Running through prechecks...")
+	app.set_details("Running through prechecks...")
 	logger.info("Running through prechecks...")
+	start = time.time()
+
+	# find the devices that aren't open yet, from the ports cached from the last run or by probing
+	probed = app.devices.discover_ports()
+	if probed:
+		logger.info("Probed the serial ports for " + ", ".join(probed) + " in " + str(round(time.time() - start, 2)) + " s.")
 
 	# check that everything is attached to serial ports
-	if not any(check_serial()):
-		app.errors.set("ERROR: Serial connection issue.")
+	if not any(check_serial(app.devices)):
+		app.set_error("ERROR: Serial connection issue.")
 		return(False)
 
 	# test health of controllers
-	
-	bc = Bath_Controller(app)
-	if (bc.is_healthy() == True):
-		# bath controller is healthy and can continue
-		logger.debug("Bath Controller is healthy, moving forward.\n\n")
-		bc.ser.close()
-	else:
-		# something is wrong and need to trip a pause and alarm and wait for user input
-		err_msg = "Bath Controller is unhealthy, stopping calibration.\n\n"
-		app.errors.set(err_msg)
-		logger.error(err_msg)
-		return(False)
-        """
-	vc = Valve_Controller(app)
-	if (vc.is_healthy() == True):
-		# valve controller is healthy and can continue
-		logger.debug("Valve Controller is healthy, moving forward.\n\n")
-		vc.ser.close()
-	else:
-		# something is wrong and need to trip a pause and alarm and wait for user input
-		err_msg = "Valve Controller is unhealthy, stopping calibration.\n\n"
-		app.errors.set(err_msg)
-		logger.error(err_msg)
-		return(False)
-        """
-        
-	pc = Pump_Controller()
-	if (pc.is_healthy() == True):
-		# pump controller is healthy and can continue
-		logger.debug("HPLC Pump Controller is healthy, moving forward.\n\n")
-		pc.ser.close()
-	else:
-		# something is wrong and need to trip a pause and alarm and wait for user input
-		err_msg = "HPLC Pump is unhealthy, stopping calibration.\n\n"
-		app.errors.set(err_msg)
-		logger.error(err_msg)
-		return(False)
-
-	cc = CalBoard_Controller()
-	if (cc.is_healthy() == True):
-		# calboard controller is healthy and can continue
-		logger.debug("Calboard Controller is healthy, moving forward.\n\n")
-		cc.ser.close()
-	else:
-		# something is wrong and need to trip a pause and alarm and wait for user input
-		err_msg = "Calboard is unhealthy, stopping calibration.\n\n"
-		app.errors.set(err_msg)
-		logger.error(err_msg)
-		return(False)
-
-	# MFCs controllers
-	mfc1 = MFC_Controller_One(app)
-	if (mfc1.is_healthy() == True):
-		# MFC controller is healthy and can continue
-		logger.debug("MFC Controller One is healthy, moving forward.\n\n")
-		mfc1.ser.close()
-	else:
-		# something is wrong and need to trip a pause and alarm and wait for user input
-		err_msg = "MFC One is unhealthy, stopping calibration.\n\n"
-		logger.error(err_msg)
-		mfc1.ser.close()
-		return(False)
-	
-	mfc2 = MFC_Controller_Two(app)
-	if (mfc2.is_healthy() == True):
-		# MFC controller is healthy and can continue
-		mfc2.ser.close()
-		logger.debug("MFC Controller Two is healthy, moving forward.\n\n")
-	else:
-		# something is wrong and need to trip a pause and alarm and wait for user input
-		err_msg = "MFC Two is unhealthy, stopping calibration.\n\n"
-		logger.error(err_msg)
-		mfc2.ser.close()
-		return(False)
+	names = Device_Registry.device_names
+	results = run_concurrently(lambda name: check_device(app, name), names)
 
 	# RGA controller
 
@@ -1058,165 +1644,528 @@ def system_health_check(app):
 
 	# GC controller
 
-	app.details.set("Precheck complete! System healthy.")
+	report = []
+	errors = []
+	for name, (healthy, latency, status) in zip(names, results):
+		label = Device_Registry.device_labels[name]
+		report.append("%-18s %-10s %.2f s" % (label, status, latency))
+		if healthy:
+			logger.debug(label + " is healthy, moving forward.")
+		elif name in required_devices:
+			# something is wrong and need to trip a pause and alarm and wait for user input
+			err_msg = label + " is unhealthy, stopping calibration."
+			errors.append(err_msg)
+			logger.error(err_msg)
+		else:
+			logger.warn(label + " is unhealthy.")
+	report = "\n".join(report)
+	logger.info("Precheck results (" + str(round(time.time() - start, 2)) + " s):\n" + report)
+	# a device that doesn't answer where it was cached is probed for again on the next precheck
+	app.devices.forget_ports([name for name, (healthy, latency, status) in zip(names, results) if not healthy])
+
+	if errors:
+		app.set_error("\n".join(errors))
+		app.set_details("Precheck failed.\n" + report)
+		return(False)
+
+	app.set_details("Precheck complete! System healthy.\n" + report)
 	logger.debug("Precheck complete! System healthy.")
 	return(True)
 
+#######################
+### setup readiness ###
+#######################
+
+SETUP_TEMP 				= 2.0 		# C, every calibration starts from the bath at this temp
+SETUP_TEMP_TOLERANCE 	= 0.1 		# C
+SETUP_CHECK_INTERVAL 	= 10000 	# ms between readiness checks
+SETUP_TIMEOUT_S 		= 7200.0 	# setup stops waiting for the readings after this long
+# an MFC is at setpoint within this fraction of the setpoint, or MFC_FLOW_MIN_TOLERANCE for small setpoints
+MFC_FLOW_TOLERANCE 		= 0.02
+MFC_FLOW_MIN_TOLERANCE 	= 0.5
+# loops that need to be flat before calibrating, watched with the same detector as equilibration
+SETUP_STABILITY_CHANNELS = ['hplc_pressure', 'high_press']
+
+# what the readiness checks carry from one check to the next
+class Setup_State(object):
+	def __init__(self, mfc_setpoints, timeout_s=SETUP_TIMEOUT_S):
+		self.mfc_setpoints 	= mfc_setpoints # [mfc1, mfc2] flows set by calibration_setup
+		self.timeout_s 		= timeout_s
+		self.detector 		= stability_detector.Stability_Detector()
+		self.start_time 	= clock()
+		self.outcome 		= None 			# 'ready', 'timed out', or 'calibrating' once the checks are over
+
+# runs on the device worker thread, turns on the MFCs and the HPLC pump and sends the bath to SETUP_TEMP
+def calibration_setup(app, gas_outlet, settings, predictive_bath=False):
+	# turning on the MFCs
+	mfc1 = app.devices.mfc1()
+	mfc1.set_setpoint_and_gas(settings['mfc1_setpoint'], 8) 					#setting gas to Nitrogen
+
+	mfc2 = app.devices.mfc2()
+	mfc2.set_setpoint_and_gas(settings['mfc2_setpoint'], settings['gas_index']) 	#setting gas to the selected gas
+
+	data_logger.info("MFCs On.")
+
+	vc = app.devices.valve()
+	cc = app.devices.calboard()
+
+	# get solenoid valves in correct state
+	cc.normal_operation(gas_outlet) 	# put the calibration board into normal calibration operation state
+	vc.set_valve(1) 			# setting the valve to the zero pressure setting, returns once it is set
+	logger.info("Pressure is: " + str(cc.read_press()))
+
+	# turning on the HPLC pump
+	pc = app.devices.pump()
+	# max press at 6000 psi, 20ml/min, then setting to run state
+	if pc.start_flow(6000, 2000):
+		data_logger.info("HPLC Pump On.")
+	else:
+		app.set_error("HPLC pump did not start, see the log for the command it refused.")
+
+	# send the bath to 2 degrees
+	bc = app.devices.bath()
+	bc.set_predictive(predictive_bath)
+	# operationa value 
+	bc.change_temp(SETUP_TEMP)
+	# test value
+	#bc.change_temp(20.1)
+
+	data_logger.info("Bath cooling to 2.")
+	return((bc, pc, cc))
+
+# starts polling the readiness of the devices calibration_setup returned, the returned Setup_State has
+	# the outcome once the checks are over
+def start_setup_checks(app, controllers, settings):
+	state = Setup_State([settings['mfc1_setpoint'], settings['mfc2_setpoint']])
+	schedule_setup_check(app, controllers, state)
+	return(state)
+
+# runs on the Tk thread, hands the next readiness check to the device worker
+def schedule_setup_check(app, controllers, state):
+	app.worker.submit(check_setup_ready, (app, controllers, state),
+		lambda done: setup_check_done(app, controllers, state, done))
+
+def setup_check_done(app, controllers, state, done):
+	if not done:
+		app.after(SETUP_CHECK_INTERVAL, lambda: schedule_setup_check(app, controllers, state))
+
+# seconds until the bath and the stability windows could be ready, a lower bound as an unsettled
+	# loop can take any time to flatten out
+def estimate_setup_time(bc, state, bath_ready):
+	remaining = [0.0]
+	if not bath_ready and bc.current_temp != -999 and bc.command_temp is not None:
+		direction = 1.0 if SETUP_TEMP > bc.current_temp else -1.0
+		bath_time = bc.model.time_to_reach(bc.current_temp, SETUP_TEMP - direction * SETUP_TEMP_TOLERANCE, bc.command_temp)
+		if bath_time is not None:
+			remaining.append(bath_time)
+	for channel in SETUP_STABILITY_CHANNELS:
+		window = state.detector.windows[channel]
+		if not window.is_full():
+			remaining.append(window.window_s * stability_detector.FULL_FRACTION - window.span())
+	return(max(remaining))
+
+# runs on the device worker thread. setup is ready once the bath is within tolerance of SETUP_TEMP, the
+	# HPLC and high pressure loop are flat, and both MFCs flow at their setpoints. returns True once
+	# the checks are over: ready, timed out, or overtaken by the calibration starting
+def check_setup_ready(app, controllers, state):
+	bc, pc, cc = controllers
+	elapsed = clock() - state.start_time
+	if app.calibrating:
+		data_logger.info("Calibration started before setup was ready, after " + str(round(elapsed / 60.0, 1)) + " minutes of setup.")
+		logger.info("Calibration started, readiness checks stopped.")
+		state.outcome = "calibrating"
+		return(True)
+	try:
+		bath_ready = bc.check_temp(SETUP_TEMP_TOLERANCE)
+		high_press, low_press, high_low_press = cc.read_press()
+		hplc_pressure = pc.parse_pressure(pc.read_pressure())
+		flows = [app.devices.mfc1().read_flow(), app.devices.mfc2().read_flow()]
+	except (serial.SerialException, IndexError, ValueError) as e:
+		# an empty or garbled reply, or a port the registry reopens on the next check
+		logger.warn("Readiness check failed, retrying: " + str(type(e).__name__) + " " + str(e))
+		return(False)
+	state.detector.add(clock(), hplc_pressure=hplc_pressure, high_press=high_press)
+	report = state.detector.check()[1]
+	report = dict((channel, report[channel]) for channel in SETUP_STABILITY_CHANNELS)
+	loops_ready = all(report[channel]['state'] == "flat" for channel in SETUP_STABILITY_CHANNELS)
+
+	flows_ready = True
+	flow_report = []
+	for label, flow, setpoint in zip(["MFC One", "MFC Two"], flows, state.mfc_setpoints):
+		if flow is None:
+			# an MFC that doesn't report its flow can't hold up the setup
+			flow_report.append(label + " flow unknown")
+			continue
+		at_setpoint = abs(flow - setpoint) <= max(setpoint * MFC_FLOW_TOLERANCE, MFC_FLOW_MIN_TOLERANCE)
+		flows_ready = flows_ready and at_setpoint
+		flow_report.append("%s %.2f of %.2f" % (label, flow, setpoint))
+
+	details = ("Bath " + str(bc.current_temp) + " C of " + str(SETUP_TEMP) + " C. " +
+		stability_detector.format_report(report) + ". " + ", ".join(flow_report) + ".")
+	if bath_ready and loops_ready and flows_ready:
+		msg = "Cooling + Pressurization Complete! Setup took " + str(round(elapsed / 60.0, 1)) + " minutes."
+		data_logger.info(msg)
+		logger.info(msg)
+		app.set_status("Calibration setup complete!")
+		app.set_details("Cooling down and pressure equilibration complete!")
+		state.outcome = "ready"
+		return(True)
+	if elapsed >= state.timeout_s:
+		msg = "Setup not ready after " + str(round(elapsed / 60.0, 1)) + " minutes, stopped waiting. " + details
+		data_logger.info(msg)
+		logger.warn(msg)
+		app.set_status("Calibration setup timed out.")
+		app.set_error(msg)
+		state.outcome = "timed out"
+		return(True)
+	remaining = estimate_setup_time(bc, state, bath_ready)
+	if remaining > 0:
+		app.set_status("Cooling + Pressurization Ongoing, at least " + str(int(math.ceil(remaining / 60.0))) + " minutes remain.")
+	else:
+		app.set_status("Cooling + Pressurization Ongoing, waiting for the readings to settle.")
+	app.set_details(details)
+	logger.info("Cooling + Pressurization Ongoing. " + details)
+	return(False)
+
 #######################
 ### calibration app ###
 #######################
 
-# this is the main calibration function that is called and sets the system into its startup state
-def calibrate_master(app):
-	app.status.set("Calibration initiated.")
+# all of the state calibrate_slave carries from one tick to the next, kept together so a tick can be
+	# handed to the device worker thread and its result handed back to the GUI
+class Calibration_State(object):
+	def __init__(self, plan, interval, settings=None):
+		self.plan 					= plan 		# Calibration_Plan compiled from the recipe
+		self.settings 				= settings or {} # what the calibration was started with, kept for its checkpoints
+		self.step_index 			= 0 		# index of the plan step being run
+		self.current_valve 			= None 		# valve port the last pressure change set
+		self.interval 				= interval 	# interval for calibration app in milliseconds
+
+		# equilibration counter, needs to equal the step's hold_s * 1000 ms / interval ms with fixed equilibration
+		self.equilibration_counter 	= 0
+		# with adaptive equilibration, when the bath first reached tolerance and the detector watching the signals
+		self.equilibration_start 	= None
+		self.detector 				= None
+
+		# Boolean flags to inform calibrate_slave() about its proper state
+		self.ready_for_pres_change 	= True  # this starts True, and is reset True after last temp and sampling
+		self.ready_for_temp_change 	= False # this is set after pres change and after sampling
+		self.waiting_for_temp 		= False # this is set true when waiting for temp
+		self.waiting_for_sample 	= False # this is set true after temp reached and before sampling is done
+
+		# ticks are scheduled against a fixed timeline so time spent on device I/O doesn't make them drift
+		self.start_time 			= clock()
+		self.next_tick 				= self.start_time
+
+	def current_step(self):
+		return(self.plan[self.step_index])
+
+# the bath temp a plan starts from, None if the bath hasn't been read yet. the temp readout can't tell as
+	# it starts at 0.0, which is also a valid reading
+def bath_start_temp(app):
+	bc = app.devices.peek('bath')
+	if bc is None or bc.current_temp is None or bc.current_temp == -999:
+		return(None)
+	return(bc.current_temp)
+
+# saved after every sample, a failed save is only warned about as it shouldn't stop the calibration
+def save_checkpoint(app, state):
+	try:
+		calibration_checkpoint.save(calibration_checkpoint.checkpoint_from_state(state.plan, state.step_index, state.settings),
+			app.checkpoint_path)
+	except (IOError, OSError) as e:
+		logger.warn("Could not save the calibration checkpoint: " + str(e))
+
+def clear_checkpoint(app):
+	try:
+		calibration_checkpoint.clear(app.checkpoint_path)
+	except (IOError, OSError) as e:
+		logger.warn("Could not remove the calibration checkpoint: " + str(e))
+
+# this is the main calibration function that is called and sets the system into its startup state. the
+	# steps come from the recipe in app.recipe_path (recipes/full_matrix.json for the full calibration,
+	# recipes/quick_test.json for testing) unless a compiled plan is passed in. a checkpoint (from
+	# calibration_checkpoint.load) resumes an interrupted calibration at the step it hadn't sampled yet
+	# with the settings it was started with. returns False if the recipe can't be loaded
+def calibrate_master(app, plan=None, checkpoint=None):
+	settings = {'gas_index': app.gas_index, 'mfc1_setpoint': app.mfc1_flow.get(), 'mfc2_setpoint': app.mfc2_flow.get(),
+		'gas_outlet': app.gas_outlet.get(), 'predictive_bath': app.predictive_bath.get(), 'recipe_path': app.recipe_path.get()}
+	try:
+		if checkpoint is not None:
+			plan = calibration_checkpoint.resume_plan(checkpoint)
+			settings.update(checkpoint['settings'])
+		elif plan is None:
+			plan = calibration_recipe.load_plan(app.recipe_path.get())
+		# recipes with "order": "optimized" are reordered starting from the bath's current temp
+		plan, predicted_time = calibration_planner.prepare_plan(plan, bath_start_temp(app))
+	except (IOError, ValueError, KeyError, TypeError) as e:
+		if checkpoint is not None:
+			err_msg = "Could not resume the calibration from its checkpoint: " + str(e)
+		else:
+			err_msg = "Could not load recipe " + str(settings['recipe_path']) + ": " + str(e)
+		app.set_error(err_msg)
+		logger.error(err_msg)
+		return(False)
+	app.set_status("Calibration initiated, predicted run time %.1f hours." % (predicted_time / 3600.0))
+	if checkpoint is not None:
+		logger.info("Calibration resumed from the checkpoint at " + calibration_checkpoint.describe(checkpoint) + ".")
+		data_logger.info("Calibration resumed from the checkpoint at " + calibration_checkpoint.describe(checkpoint) + ".")
 	logger.info("Calibration initiated.")
+	logger.info("Calibration recipe " + plan.summary())
+	logger.info("Predicted calibration time: " + str(math.floor(predicted_time)) + " s")
+	logger.info("Calibration order: " + ", ".join("%d@%s" % (step.valve, step.temp) for step in plan.steps))
 	data_logger.info("Calibration initiated.")
+	data_logger.info("Calibration recipe " + plan.summary())
+	data_logger.info("Predicted calibration time: " + str(math.floor(predicted_time)) + " s")
 	app.calibrating = True
 	app.begin_timer(time.time())
-	# start things up in here
 
-	bc = Bath_Controller(app)
-	vc = Valve_Controller(app)
-	pc = Pump_Controller()
-	cc = CalBoard_Controller()
-	#sc = Sampling_Controller()
+	state = Calibration_State(plan, 5000, settings)
+	save_checkpoint(app, state)
 
-	time.sleep(2) # allow controller startup time
+	app.currently_sampling  = False # this is a temp solution until the real Sampling Controller is designed
+	app.refilling_fr        = False # flag that is changed to True when FR refill button is pushed 
+	app.paused				= False # the app starts out unpaused and ready to roll
 
+	# the startup procedure talks to the devices so it runs on the device worker, the calibration loop
+		# is started once it returns the controllers
+	startup_settings = dict((field, settings[field]) for field in ['gas_index', 'mfc1_setpoint', 'mfc2_setpoint'])
+	app.worker.submit(calibration_startup, (app, settings['gas_outlet'], startup_settings, settings['predictive_bath']),
+		lambda controllers: schedule_calibrate_slave(app, controllers, state))
+	return(True)
+
+# runs on the device worker thread, puts the devices into their startup state
+def calibration_startup(app, gas_outlet, settings, predictive_bath=False):
+	# shared controllers from the device registry, ports are only opened here if not already open
+	bc = app.devices.bath()
+	bc.set_predictive(predictive_bath)
+	vc = app.devices.valve()
+	pc = app.devices.pump()
+	cc = app.devices.calboard()
+	#sc = Sampling_Controller()
 
 	### Startup Procedure
 
 	# get solenoid valves in correct state
-	cc.normal_operation(app.gas_outlet.get()) 	# put the calibration board into normal calibration operation state
-	vc.set_valve(1) 			# setting the valve to the zero pressure setting
-	time.sleep(1)				# wait for valco to get set
+	cc.normal_operation(gas_outlet) 	# put the calibration board into normal calibration operation state
+	vc.set_valve(1) 			# setting the valve to the zero pressure setting, returns once it is set
 
 	# turning on the HPLC pump
-	pc.set_pressure_limit(6000) # max press at 6000 psi
-	time.sleep(1)
-	pc.set_flow_rate(2000)		# 20ml/min
-	time.sleep(1)
-	pc.turn_on()				# setting to run state
-	data_logger.info("HPLC Pump On.")
-
-	# operational values for queues
-	valve_queue    = deque([1, 6, 5, 4, 3, 2])
-	temp_queue         = deque([6, 4, 2])
-
-	# testing values for queues
-	#valve_queue     = deque([1, 6, 5])
-	#temp_queue      = deque([20.1, 20.2])
-
-	# equilibration counter, needs to equal 600000 ms / interval ms
-	equilibration_counter = 0
-	interval = 5000 # interval for calibration app in milliseconds
-
-
-	# Boolean flags to inform calibrate_slave() about its proper state
-	ready_for_pres_change   = True  # this starts True, and is reset True after last temp and sampling
-	ready_for_temp_change   = False # this is set after pres change and after sampling
-	waiting_for_temp        = False # this is set true when waiting for temp
-	waiting_for_sample      = False # this is set true after temp reached and before sampling is done
-	app.currently_sampling  = False # this is a temp solution until the real Sampling Controller is designed
-	app.refilling_fr        = False # flag that is changed to True when FR refill button is pushed 
-	app.paused				= False # the app starts out unpaused and ready to roll
+	# max press at 6000 psi, 20ml/min, then setting to run state
+	if pc.start_flow(6000, 2000):
+		data_logger.info("HPLC Pump On.")
+	else:
+		app.set_error("HPLC pump did not start, see the log for the command it refused.")
 
 	data_logger.info("Calibration algorithm beginning.")
-	calibrate_slave(app, bc, vc, pc, cc, valve_queue, temp_queue, ready_for_pres_change, ready_for_temp_change, 
-		waiting_for_temp, waiting_for_sample, equilibration_counter, interval)
-
-# calibration slave function that is repeatedly called after 5 seconds everytime it complete
-	# this delay allows the GUI to remain functional
-def calibrate_slave(app, bc, vc, pc, cc, valve_queue, temp_queue, ready_for_pres_change, ready_for_temp_change, 
-	waiting_for_temp, waiting_for_sample, equilibration_counter, interval):
+	app.recorder.record(data_recorder.EVENT_CALIBRATION_START, valve_port=1, **settings)
+	app.recorder.sync()
+	return((bc, vc, pc, cc))
+
+# adaptive equilibration, runs every tick while waiting for temp. from the first tick the bath is in
+	# tolerance the detector is fed the bath temp and pressures, and equilibration ends once they are flat
+	# (but no sooner than min_hold_s) or after max_hold_s regardless
+def check_equilibration(app, bc, state, step, in_tolerance, pressures):
+	now = clock()
+	if state.equilibration_start is None:
+		if not in_tolerance:
+			return
+		logger.debug("Temperature reached. Waiting for equilibration.")
+		data_logger.info("Temp reached setpoint. Waiting for equilibration.")
+		app.recorder.record(data_recorder.EVENT_TEMP_REACHED, bath_temp=bc.current_temp)
+		state.equilibration_start = now
+		state.detector = state.plan.new_detector()
+	high_press, low_press, high_low_press = pressures
+	# a failed read (read_temp's -999) is left out like a missing one, the detector skips None readings
+	bath_temp = None if bc.current_temp == -999 else bc.current_temp
+	state.detector.add(now, bath_temp=bath_temp, high_press=high_press, low_press=low_press)
+	state.equilibration_counter += 1
+	held = now - state.equilibration_start
+	stable, report = state.detector.check()
+	logger.debug("Equilibrating for " + str(math.floor(held)) + " s: " + stability_detector.format_report(report))
+	if stable and in_tolerance and held >= step.min_hold_s:
+		if held < step.hold_s:
+			decision = "signals flat, ended " + str(math.floor(step.hold_s - held)) + " s before the " + str(step.hold_s) + " s hold"
+		else:
+			decision = "signals flat, extended " + str(math.floor(held - step.hold_s)) + " s past the " + str(step.hold_s) + " s hold"
+	elif held >= step.max_hold_s:
+		decision = "not flat after the " + str(step.max_hold_s) + " s maximum hold, sampling anyway"
+		logger.warn("Equilibration timed out: " + stability_detector.format_report(report))
+	else:
+		return
+	finish_equilibration(app, bc, state, decision + " after " + str(math.floor(held)) + " s; " + stability_detector.format_report(report))
+
+def finish_equilibration(app, bc, state, decision):
+	save_bath_model(app.bath_model)
+	logger.info("Temperature reached. Equilibration done! (" + decision + ")")
+	data_logger.info("Temp reached setpoint. Equilibration done! (" + decision + ")")
+	app.recorder.record(data_recorder.EVENT_EQUILIBRATED, bath_temp=bc.current_temp)
+	state.equilibration_counter = 0
+	state.equilibration_start = None
+	state.detector = None
+	state.waiting_for_temp = False
+	state.waiting_for_sample = True
+	app.currently_sampling = True
+
+def save_bath_model(model=None):
+	if model is None:
+		model = learned_bath
+	try:
+		model.save()
+		logger.debug("Bath model saved, cooling tau %.0f s, heating tau %.0f s" % (model.tau('cooling'), model.tau('heating')))
+	except (IOError, OSError) as e:
+		logger.warn("Could not save the bath model: " + str(e))
+
+# sets the gas and MFC flows a recipe step asks for, steps that don't give them keep the current ones
+def apply_step_flows(app, step):
+	if step.mfc1_flow is not None:
+		app.devices.mfc1().set_setpoint(step.mfc1_flow)
+		data_logger.info("MFC One setpoint set to " + str(step.mfc1_flow))
+	if step.gas_index is not None:
+		app.devices.mfc2().set_gas(step.gas_index)
+		data_logger.info("MFC Two gas set to " + str(step.gas_index))
+	if step.mfc2_flow is not None:
+		app.devices.mfc2().set_setpoint(step.mfc2_flow)
+		data_logger.info("MFC Two setpoint set to " + str(step.mfc2_flow))
+
+# runs on the Tk thread, hands the next calibrate_slave tick to the device worker so the GUI (including
+	# the pause button) stays responsive while the tick is waiting on serial devices
+def schedule_calibrate_slave(app, controllers, state):
+	bc, vc, pc, cc = controllers
+	app.worker.submit(calibrate_slave, (app, bc, vc, pc, cc, state),
+		lambda keep_going: calibrate_slave_done(app, controllers, state, keep_going))
+
+# runs on the Tk thread once a tick has finished, and schedules the next one on the tick timeline
+def calibrate_slave_done(app, controllers, state, keep_going):
+	if not keep_going:
+		return
+	state.next_tick += state.interval / 1000.0
+	delay = int((state.next_tick - clock()) * 1000)
+	if delay < 0:
+		# the tick overran its interval, skip ahead rather than firing a burst of late ticks
+		state.next_tick = clock()
+		delay = 0
+	app.after(delay, lambda: schedule_calibrate_slave(app, controllers, state))
+
+# calibration slave function that is repeatedly called every interval ms on the device worker thread,
+	# the GUI is only updated through the app's thread safe setters. returns False once calibration is done
+def calibrate_slave(app, bc, vc, pc, cc, state):
 	if app.paused:
 		logger.debug("Calibration paused.")
-		app.details.set("Calibration paused.")
+		app.set_details("Calibration paused.")
+		# check_temp isn't called while paused, so an overshoot would carry the bath up to 4 C past its target
+		if bc.command_temp != bc.set_temp and bc.end_overshoot():
+			logger.info("Calibration paused, ending bath overshoot at " + str(bc.set_temp) + ".")
 	else:
-		app.details.set("Calibration ongoing.")
+		app.set_details("Calibration ongoing.")
 		logger.debug("Calibration ongoing.")
-		logger.debug("Pressure is: " + str(cc.read_press()))
-		if ready_for_pres_change:
+		pressures = cc.read_press() # the tick's reading, also what adaptive equilibration watches
+		logger.debug("Pressure is: " + str(pressures))
+		if state.ready_for_pres_change:
 			logger.debug("Ready for pressure change.")
-			valve_port = valve_queue.popleft()
+			valve_port = state.current_step().valve
+			state.current_valve = valve_port
 			vc.set_valve(valve_port)
 			data_logger.info("Pressure set to BPV " + str(valve_port))
-			high_press, low_press, high_low_press = cc.read_press()
+			(high_press, low_press, high_low_press), counts = cc.read_press_with_counts()
 			logger.info("Pressure is: " + str(high_press) + '/' + str(high_low_press) + ', ' + str(low_press))
-                        hplc_pressure = str(pc.read_pressure())
+			hplc_pressure = str(pc.read_pressure())
 			logger.info("HPLC Pressure is: " + hplc_pressure)
 			data_logger.info("Pressure is: " + str(high_press) + '/' + str(high_low_press) + ', ' + str(low_press))
 			data_logger.info("HPLC Pressure is: " + hplc_pressure)
-			ready_for_pres_change = False
-			ready_for_temp_change = True
-		if ready_for_temp_change:
+			app.recorder.record(data_recorder.EVENT_PRESSURE_SET, valve_port=valve_port, hplc_pressure=pc.parse_pressure(hplc_pressure),
+				high_press=high_press, low_press=low_press, high_low_press=high_low_press,
+				**dict(zip(pressure_conversion.COUNT_FIELDS, counts)))
+			state.ready_for_pres_change = False
+			state.ready_for_temp_change = True
+		if state.ready_for_temp_change:
 			logger.debug("Ready for temp change.")
-			temp_setting = temp_queue.popleft()
+			step = state.current_step()
+			apply_step_flows(app, step)
+			temp_setting = step.temp
 			bc.change_temp(temp_setting)
 			data_logger.info("Temp set to " + str(temp_setting))
-			ready_for_temp_change = False
-			waiting_for_temp = True
-		if waiting_for_temp:
+			app.recorder.record(data_recorder.EVENT_TEMP_SET, bath_setpoint=temp_setting, gas_index=step.gas_index,
+				mfc1_setpoint=step.mfc1_flow, mfc2_setpoint=step.mfc2_flow)
+			state.ready_for_temp_change = False
+			state.waiting_for_temp = True
+		if state.waiting_for_temp:
 			logger.debug("Waiting for temp equilibration.")
-			if(bc.check_temp()): # returns True if bath is at set_temp is met
-				# counting down from 600 seconds every time temp is reached
-				if equilibration_counter <= (600000 / interval):
-					logger.debug("Temperature reached. Waiting for equilibration.")
-					data_logger.info("Temp reached setpoint. Waiting for equilibration.")
-					equilibration_counter += 1
-					print("equilibration counter")
-					print(equilibration_counter)
-				else:
-					logger.debug("Temperature reached. Equilibration done!")
-					data_logger.info("Temp reached setpoint. Equilibration done!")
-					equilibration_counter = 0
-					waiting_for_temp = False
-					waiting_for_sample = True
-					app.currently_sampling = True
-		if waiting_for_sample:
+			step = state.current_step()
+			in_tolerance = bc.check_temp(step.temp_tolerance) # returns True if bath is at set_temp is met
+			if state.plan.equilibration == 'fixed':
+				if in_tolerance:
+					# counting down from the step's hold time (600 seconds by default) every time temp is reached
+					if state.equilibration_counter <= (step.hold_s * 1000 / state.interval):
+						logger.debug("Temperature reached. Waiting for equilibration.")
+						data_logger.info("Temp reached setpoint. Waiting for equilibration.")
+						if state.equilibration_counter == 0:
+							app.recorder.record(data_recorder.EVENT_TEMP_REACHED, bath_temp=bc.current_temp)
+						state.equilibration_counter += 1
+						logger.debug("Equilibration counter: " + str(state.equilibration_counter))
+					else:
+						finish_equilibration(app, bc, state, "held " + str(step.hold_s) + " s")
+			else:
+				check_equilibration(app, bc, state, step, in_tolerance, pressures)
+		if state.waiting_for_sample:
 			logger.debug("Waiting for sample.")
-			app.details.set("Waiting for sample.")
+			app.set_details("Waiting for sample.")
 			if app.refilling_fr:
 				logger.info("Refilling FR.")
-				app.details.set("Refilling FR.")
+				app.set_details("Refilling FR.")
 			if not app.currently_sampling:
 				logger.info("Done sampling.")
-				app.details.set("Done sampling.")
+				app.set_details("Done sampling.")
 				data_logger.info("Sample taken.")
-				high_press, low_press, high_low_press = cc.read_press()
+				(high_press, low_press, high_low_press), counts = cc.read_press_with_counts()
 				hplc_press = str(pc.read_pressure())
+				bath_temp = bc.read_temp()
 				data_logger.info("Sample Data: Temp, HPLC Pressure, High Pressure Loop, High Pressure Loop with low end accuracy, Low Pressure Loop ")
-				data_logger.info("Sample Data: " + str(bc.read_temp()) + ", " + hplc_press + "," + str(high_press) + ', ' + str(high_low_press) + ', ' + str(low_press))
-				waiting_for_sample = False 
-			if not waiting_for_sample:
-				logger.debug("Checking remaining temp and valve queues.")
-				if temp_queue: # if there are temps left in the temp queue keep running through at same pres
-					logger.debug("Temp queue still exists.")
-					ready_for_temp_change = True
-				elif valve_queue: # if there are pressures left refill temp queue and move on to next pres
-					logger.debug("Valve queue still exists.")
-					# operational values
-					temp_queue = deque([6, 4, 2])
-					# test values
-					#temp_queue = deque([20.1, 20.2])
-					logger.debug("Refilled temp queue")
-					ready_for_pres_change = True
-				else: # if there are not temps and no pressures left the calibration is complete
-					app.status.set("Calibration complete!")
+				data_logger.info("Sample Data: " + str(bath_temp) + ", " + hplc_press + "," + str(high_press) + ', ' + str(high_low_press) + ', ' + str(low_press))
+				app.recorder.record(data_recorder.EVENT_SAMPLE, bath_temp=bath_temp, hplc_pressure=pc.parse_pressure(hplc_press),
+					high_press=high_press, low_press=low_press, high_low_press=high_low_press,
+					**dict(zip(pressure_conversion.COUNT_FIELDS, counts)))
+				app.recorder.sync() # samples are the boundaries every record up to now is forced to disk at
+				state.waiting_for_sample = False 
+			if not state.waiting_for_sample:
+				logger.debug("Checking remaining plan steps.")
+				state.step_index += 1
+				if state.step_index < len(state.plan):
+					save_checkpoint(app, state)
+					step = state.current_step()
+					logger.debug("Next step " + str(state.step_index + 1) + " of " + str(len(state.plan)) + ": valve " + str(step.valve) + ", temp " + str(step.temp))
+					if step.valve != state.current_valve: # a new pressure is set before the step's temp
+						state.ready_for_pres_change = True
+					else: # same pressure, only the temp changes
+						state.ready_for_temp_change = True
+				else: # if there are no steps left the calibration is complete
+					app.set_status("Calibration complete!")
 					data_logger.info("Calibration complete.")
+					app.recorder.record(data_recorder.EVENT_CALIBRATION_COMPLETE)
+					app.recorder.sync()
+					clear_checkpoint(app)
 					logger.info("Calibration complete!")
-					logger.info("Approx calibration time was: " + str(app.time_string.get()))
+					logger.info("Approx calibration time was: " + str(math.floor(clock() - state.start_time)))
 					app.calibrating = False
-					return 
+					return(False)
 
-	# check state every interval milli seconds and take necessary next action if not waiting
-	app.after(interval, lambda: calibrate_slave(app, bc, vc, pc, cc, valve_queue, temp_queue, ready_for_pres_change, 
-		ready_for_temp_change, waiting_for_temp, waiting_for_sample, equilibration_counter, interval))
+	# check state again after interval milli seconds and take necessary next action if not waiting
+	return(True)
 
 
 def main():
+	if tk is None:
+		raise SystemExit("Tkinter is not installed, run calibrate_headless.py to calibrate without the GUI.")
 	app = Application()         
-	app.mainloop()    
+	try:
+		app.mainloop()    
+	finally:
+		app.telemetry.stop()
+		if app.telemetry.is_alive():
+			app.telemetry.join(10)
+		app.devices.close_all()
+		recorder.close()
+		save_bath_model()
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,203 @@
+'''
+
+@description: 	runs the calibrations of several rigs from one process, so one operator station can
+				calibrate several ISMS units at once. every rig in the config (see rig_config.py) gets
+				its own thread running the same health check, setup, and calibration as
+				calibrate_headless, with its own devices, calibration and data logs, recording,
+				telemetry, bath model, and checkpoint, all named after the rig
+
+				usage: python calibrate_rigs.py rigs.json [--skip-setup] [--sample-time 300]
+					[--predictive-bath] [--resume]
+
+				the operator types "<rig> sample" once a rig's sample is taken (or it finishes by itself
+				after --sample-time seconds), "<rig> pause" to pause or resume a rig, and "status" to
+				list them. Ctrl-C stops every rig and makes it safe
+
+'''
+
+import argparse
+import logging
+import os
+import sys
+import threading
+
+import bath_model
+import calibrate_headless
+import calibrate_isms
+import calibration_checkpoint
+import calibration_recipe
+import data_recorder
+import rig_config
+from calibrate_isms import logger, data_logger
+
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# passes the records logged by a rig's thread and the threads it started (named after it, see
+	# run_concurrently), so every rig's log only holds its own calibration
+class Rig_Filter(logging.Filter):
+	def __init__(self, thread_name):
+		logging.Filter.__init__(self)
+		self.thread_name = thread_name
+
+	def filter(self, record):
+		return(record.threadName == self.thread_name or record.threadName.startswith(self.thread_name + "/"))
+
+# one rig's app and the thread its calibration runs on
+class Rig_Run(object):
+	def __init__(self, rig, sample_time=None, predictive_bath=False, checkpoint=None):
+		self.rig 			= rig
+		self.checkpoint 	= checkpoint
+		self.completed 		= False
+		self.thread 		= threading.Thread(target=self.run, name="Rig_" + rig.name)
+		self.handlers 		= []
+		tag = rig.name + '_' + calibrate_isms.showtime
+
+		learned = bath_model.Bath_Model(os.path.join(MODULE_DIR, 'bath_model_' + rig.name + '.json'))
+		try:
+			learned.load()
+		except (IOError, ValueError) as e:
+			logger.warn(rig.name + ": could not load the bath model, starting from the defaults: " + str(e))
+		self.app = calibrate_headless.Headless_App(rig.gas_outlet, sample_time, rig,
+			data_recorder.Data_Recorder('data_calibration_' + tag + '.isms'), learned,
+			os.path.join(MODULE_DIR, 'calibration_checkpoint_' + rig.name + '.json'), 'telemetry_' + tag + '.isms')
+		self.app.sample_prompt = rig.name + ": take the sample, then type '" + rig.name + " sample' to carry on."
+		calibration = rig.calibration
+		if checkpoint is not None:
+			calibration = dict(calibration, recipe=checkpoint['settings']['recipe_path'],
+				gas_index=checkpoint['settings']['gas_index'], mfc1_flow=checkpoint['settings']['mfc1_setpoint'],
+				mfc2_flow=checkpoint['settings']['mfc2_setpoint'])
+			predictive_bath = checkpoint['settings']['predictive_bath']
+		self.app.recipe_path.set(calibration.get('recipe', calibration_recipe.DEFAULT_RECIPE))
+		self.app.gas_index = calibration.get('gas_index', 8)
+		self.app.mfc1_flow.set(calibration['mfc1_flow'])
+		self.app.mfc2_flow.set(calibration['mfc2_flow'])
+		self.app.predictive_bath.set(predictive_bath)
+
+	# the rig's own copies of the calibration and data logs
+	def open_logs(self):
+		for log, path in [(logger, '_calibration_'), (data_logger, 'data_calibration_')]:
+			handler = logging.FileHandler(path + self.rig.name + '_' + calibrate_isms.showtime + '.log')
+			handler.setFormatter(calibrate_isms.formatter)
+			handler.addFilter(Rig_Filter(self.thread.name))
+			log.addHandler(handler)
+			self.handlers.append((log, handler))
+
+	def close_logs(self):
+		for log, handler in self.handlers:
+			log.removeHandler(handler)
+			handler.close()
+
+	def start(self, skip_setup=False):
+		self.skip_setup = skip_setup
+		self.open_logs()
+		self.thread.start()
+
+	# runs on the rig's thread, a rig that fails or is stopped is made safe the same way calibrate_headless
+		# does on Ctrl-C
+	def run(self):
+		app = self.app
+		interrupted = True
+		try:
+			self.completed = calibrate_headless.run_headless(app, self.skip_setup, self.checkpoint)
+			interrupted = app.stopping
+		except Exception as e:
+			logger.error(str(type(e).__name__) + " occured. Arguments:" + str(e.args))
+		finally:
+			if interrupted:
+				logger.warn(self.rig.name + ": calibration interrupted, shutting down the bath and pump.")
+				try:
+					calibrate_isms.safe_shutdown(app.devices)
+				except Exception as e:
+					logger.error(str(type(e).__name__) + " occured. Arguments:" + str(e.args))
+					logger.warn(self.rig.name + ": not able to kill one or more serial devices.")
+			if app.telemetry is not None:
+				app.telemetry.stop()
+				app.telemetry.join(10)
+			app.devices.close_all()
+			app.recorder.close()
+			calibrate_isms.save_bath_model(app.bath_model)
+			logger.info(self.rig.name + ": " + ("calibration complete." if self.completed else "calibration did not complete."))
+
+	def status(self):
+		state = "running" if self.thread.is_alive() else ("complete" if self.completed else "stopped")
+		return("%-12s %-9s %s" % (self.rig.name, state, self.app.status.get()))
+
+# reads the operator's commands until every rig has finished
+def operator_console(runs):
+	by_name = dict((run.rig.name, run) for run in runs)
+	while any(run.thread.is_alive() for run in runs):
+		line = sys.stdin.readline()
+		if not line:
+			# no console (e.g. started in the background), wait for the rigs instead
+			for run in runs:
+				while run.thread.is_alive():
+					run.thread.join(1.0)
+			break
+		words = line.split()
+		if words == ['status']:
+			for run in runs:
+				print(run.status())
+		elif len(words) == 2 and words[0] in by_name and words[1] in ['sample', 'pause']:
+			app = by_name[words[0]].app
+			if words[1] == 'sample':
+				app.sample_complete()
+			else:
+				app.toggle_pause()
+		elif words:
+			print("Commands: '<rig> sample', '<rig> pause', 'status'. Rigs: " + ", ".join(sorted(by_name)))
+
+def main():
+	parser = argparse.ArgumentParser(description="Runs the calibrations of several rigs at once without the GUI.")
+	parser.add_argument('config', help="rig config, see rig_config.py")
+	parser.add_argument('--skip-setup', action='store_true', help="calibrate right away, the rigs are already cooled and pressurized")
+	parser.add_argument('--sample-time', type=float, default=None,
+		help="seconds after which a sample finishes by itself instead of waiting for the operator")
+	parser.add_argument('--predictive-bath', action='store_true', help="overshoot the bath setpoints using each rig's learned bath model")
+	parser.add_argument('--resume', action='store_true', help="resume the rigs with an interrupted calibration")
+	args = parser.parse_args()
+
+	# every rig's config and recipe is checked before any device is touched
+	try:
+		rigs = rig_config.load_rigs(args.config)
+	except (IOError, ValueError) as e:
+		raise SystemExit("Could not load rig config " + args.config + ": " + str(e))
+	runs = []
+	for rig in rigs:
+		checkpoint = None
+		if args.resume:
+			checkpoint = calibration_checkpoint.load(os.path.join(MODULE_DIR, 'calibration_checkpoint_' + rig.name + '.json'))
+		if checkpoint is None:
+			missing = [field for field in ['mfc1_flow', 'mfc2_flow'] if field not in rig.calibration]
+			if missing:
+				raise SystemExit("Rig " + rig.name + " has no " + " or ".join(missing) + " in its calibration settings.")
+			try:
+				calibration_recipe.load_plan(rig.calibration.get('recipe', calibration_recipe.DEFAULT_RECIPE))
+			except (IOError, ValueError) as e:
+				raise SystemExit("Could not load the recipe of rig " + rig.name + ": " + str(e))
+		runs.append(Rig_Run(rig, args.sample_time, args.predictive_bath, checkpoint))
+
+	# the shared logs say which rig every line is from
+	rig_formatter = logging.Formatter('%(asctime)s [%(threadName)s] %(levelname)s:\t%(message)s')
+	for handler in [calibrate_isms.handler, calibrate_isms.handler2, calibrate_isms.data_handler]:
+		handler.setFormatter(rig_formatter)
+
+	for run in runs:
+		logger.info("Starting " + run.rig.name + ": " + str(run.app.recipe_path.get()) +
+			(", resuming at " + calibration_checkpoint.describe(run.checkpoint) if run.checkpoint is not None else ""))
+		run.start(args.skip_setup)
+	try:
+		operator_console(runs)
+	except KeyboardInterrupt:
+		logger.warn("Stopping every rig.")
+		for run in runs:
+			run.app.stop()
+		for run in runs:
+			while run.thread.is_alive():
+				run.thread.join(1.0)
+	finally:
+		for run in runs:
+			run.close_logs()
+	sys.exit(0 if all(run.completed for run in runs) else 1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,96 @@
+'''
+
+@description: 	checkpoints of a running calibration, written to calibration_checkpoint.json when it starts
+				and after every sample so a calibration interrupted by a crash or a closed window can be
+				resumed from the last sampled point instead of starting over. the checkpoint
+				holds the plan as it was run (after any reordering), the index of the first step that
+				has not been sampled yet, and the settings the calibration was started with
+
+				a resumed calibration starts that step over from its pressure change, since the bath
+				and loops can't be trusted to have held their state while the app was down
+
+'''
+
+import json
+import os
+import time
+
+import calibration_recipe
+
+CHECKPOINT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calibration_checkpoint.json')
+
+CHECKPOINT_VERSION = 1
+
+# settings a calibration is started with that it needs again to resume
+SETTING_FIELDS = ['gas_index', 'mfc1_setpoint', 'mfc2_setpoint', 'gas_outlet', 'predictive_bath', 'recipe_path']
+
+def checkpoint_from_state(plan, step_index, settings):
+	return({
+		'version': 		CHECKPOINT_VERSION,
+		'saved': 		time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
+		'plan': {
+			'name': 			plan.name,
+			'steps': 			[step.to_dict() for step in plan.steps],
+			'order': 			plan.order,
+			'cost_model': 		plan.cost_model,
+			'equilibration': 	plan.equilibration,
+			'stability': 		plan.stability,
+		},
+		'step_index': 	step_index,
+		'settings': 	dict((field, settings.get(field)) for field in SETTING_FIELDS),
+	})
+
+# written to a temporary file first so a crash never leaves a half written checkpoint. a path of None
+	# turns checkpointing off (e.g. for simulated runs)
+def save(checkpoint, path=CHECKPOINT_PATH):
+	if path is None:
+		return
+	temporary = path + ".tmp"
+	with open(temporary, 'w') as checkpoint_file:
+		json.dump(checkpoint, checkpoint_file, indent=2, sort_keys=True)
+		checkpoint_file.flush()
+		os.fsync(checkpoint_file.fileno())
+	if os.name == 'nt' and os.path.exists(path):
+		os.remove(path) # os.rename doesn't replace files on Windows
+	os.rename(temporary, path)
+
+# the saved checkpoint, or None if there is none or it can't be read
+def load(path=CHECKPOINT_PATH):
+	if path is None or not os.path.exists(path):
+		return(None)
+	try:
+		with open(path) as checkpoint_file:
+			checkpoint = json.load(checkpoint_file)
+	except (IOError, ValueError):
+		return(None)
+	if checkpoint.get('version') != CHECKPOINT_VERSION:
+		return(None)
+	# json gives back unicode, which the serial commands built from the settings (e.g. the gas outlet) can't mix with
+	checkpoint['settings'] = dict((str(field), str(value) if isinstance(value, unicode) else value)
+		for field, value in checkpoint.get('settings', {}).items())
+	return(checkpoint)
+
+def clear(path=CHECKPOINT_PATH):
+	if path is not None and os.path.exists(path):
+		os.remove(path)
+
+# the steps the checkpoint's calibration hadn't finished, with the gas and MFC settings of the steps
+	# already run carried into the first of them as they are only given by the step that changes them.
+	# the steps are kept in the order they were being run in rather than planned again
+def resume_plan(checkpoint):
+	saved = checkpoint['plan']
+	steps = [calibration_recipe.Recipe_Step(**step) for step in saved['steps']]
+	step_index = checkpoint['step_index']
+	if step_index >= len(steps):
+		raise ValueError("Checkpoint of " + saved['name'] + " has no steps left to run.")
+	remaining = steps[step_index:]
+	for field in ['gas_index', 'mfc1_flow', 'mfc2_flow']:
+		given = [getattr(step, field) for step in steps[:step_index + 1] if getattr(step, field) is not None]
+		if given:
+			setattr(remaining[0], field, given[-1])
+	return(calibration_recipe.Calibration_Plan(saved['name'], remaining, 'as_listed', saved['cost_model'],
+		saved['equilibration'], saved['stability']))
+
+def describe(checkpoint):
+	return("step " + str(checkpoint['step_index'] + 1) + " of " + str(len(checkpoint['plan']['steps'])) + " of " +
+		checkpoint['plan']['name'] + ", saved " + checkpoint['saved'] + " UTC")
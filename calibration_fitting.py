@@ -0,0 +1,191 @@
+'''
+
+@description: 	post-run fitting of the ISMS response models. every sample point recorded by
+				data_recorder (data_calibration_*.isms) is given the dissolved gas concentration the
+				calibration board should have produced, and each gas's mass spec signal is fit against
+				it by least squares over all the runs given, e.g. a whole cruise's worth
+
+				usage: python calibration_fitting.py --signals isms_signals.csv data_calibration_*.isms
+					[--output calibration_fits.json] [--window 60]
+
+				expected concentrations come from Henry's law with a van 't Hoff temperature dependence,
+				C = kH(T) * x * P, where x is the gas's mole fraction in the MFC mix (MFC one is always
+				nitrogen, MFC two gives the recorded gas_index) and P is the absolute pressure of the
+				low pressure loop the gas is equilibrated in. concentrations are in mmol/L (mol/m3)
+
+				the mass spec signals are a CSV written by the ISMS with a header row, a "timestamp"
+				column in seconds since the epoch (the same clock as the recordings) and one column per
+				ion, e.g. "mz44". each sample's signal is the mean over the window seconds before it was
+				taken, and each gas is fit as
+
+					signal = a0 + C * (a1 + a2 * (T - 25 C) + a3 * P)
+
+				so the sensitivity may drift with the temperature and pressure across the matrix
+
+'''
+
+import argparse
+import json
+import math
+
+import data_recorder
+
+# Henry's law constants at 298.15 K in mol/(m3 Pa) and their van 't Hoff temperature dependence
+	# d(ln kH)/d(1/T) in K (Sander 2015), with the ion each gas is measured on. keyed by MFC gas index,
+	# see Application.gas_selected
+GASES = {
+	3: 	{'name': 'CO2', 	'kh': 3.3e-4, 	'van_t_hoff': 2400.0, 	'ion': 'mz44'},
+	6: 	{'name': 'H2', 		'kh': 7.8e-6, 	'van_t_hoff': 530.0, 	'ion': 'mz2'},
+	7: 	{'name': 'CH4', 	'kh': 1.4e-5, 	'van_t_hoff': 1600.0, 	'ion': 'mz15'},
+	8: 	{'name': 'N2', 		'kh': 6.4e-6, 	'van_t_hoff': 1300.0, 	'ion': 'mz28'},
+	10: {'name': 'O2', 		'kh': 1.3e-5, 	'van_t_hoff': 1500.0, 	'ion': 'mz32'},
+}
+NITROGEN = 8 # MFC one's gas
+
+REFERENCE_TEMP_K = 298.15
+KELVIN = 273.15
+PSI_TO_PA = 6894.757
+ATMOSPHERE_PSI = 14.696 # the calboard transducers read gauge pressure
+
+COEFFICIENT_NAMES = ['offset', 'sensitivity', 'sensitivity_per_c', 'sensitivity_per_psi']
+
+# the dissolved concentration in mmol/L of a gas at bath_temp C under partial_psi of absolute partial
+	# pressure, works on floats and NumPy arrays alike
+def henry_concentration(gas_index, bath_temp, partial_psi):
+	gas = GASES[gas_index]
+	kh = gas['kh'] * math.e ** (gas['van_t_hoff'] * (1.0 / (bath_temp + KELVIN) - 1.0 / REFERENCE_TEMP_K))
+	return(kh * partial_psi * PSI_TO_PA)
+
+# the sample records of one or more runs as a dict of NumPy arrays, with the run each sample came from
+def load_samples(paths):
+	import numpy as np
+
+	fields = ['timestamp', 'valve_port', 'gas_index', 'bath_temp', 'low_press', 'high_press', 'mfc1_setpoint', 'mfc2_setpoint']
+	samples = dict((field, []) for field in fields + ['run'])
+	for run_index, path in enumerate(paths):
+		run = data_recorder.load_run(path)
+		is_sample = run['event'] == data_recorder.EVENT_SAMPLE
+		for field in fields:
+			samples[field].append(run[field][is_sample].astype(np.float64))
+		samples['run'].append(np.repeat(run_index, is_sample.sum()))
+	return(dict((field, np.concatenate(values)) for field, values in samples.items()))
+
+# the mole fraction of gas_index in every sample's MFC mix
+def mole_fractions(samples, gas_index):
+	import numpy as np
+
+	mfc1 = np.nan_to_num(samples['mfc1_setpoint'])
+	mfc2 = np.where(samples['gas_index'] == gas_index, np.nan_to_num(samples['mfc2_setpoint']), 0.0)
+	if gas_index == NITROGEN:
+		mfc2 = mfc2 + mfc1
+	total = mfc1 + np.nan_to_num(samples['mfc2_setpoint'])
+	return(np.where(total > 0, mfc2 / np.where(total > 0, total, 1.0), 0.0))
+
+# the expected concentration of gas_index in every sample, 0 where the gas wasn't in the mix
+def expected_concentrations(samples, gas_index):
+	absolute_psi = samples['low_press'] + ATMOSPHERE_PSI
+	return(henry_concentration(gas_index, samples['bath_temp'], mole_fractions(samples, gas_index) * absolute_psi))
+
+# the mass spec signals as a timestamp array and a dict of ion arrays, sorted by time
+def load_signals(paths):
+	import numpy as np
+
+	tables = [np.genfromtxt(path, delimiter=',', names=True) for path in paths]
+	ions = set(tables[0].dtype.names)
+	for table in tables[1:]:
+		ions &= set(table.dtype.names)
+	if 'timestamp' not in ions:
+		raise ValueError("The mass spec signals need a timestamp column.")
+	ions.discard('timestamp')
+	timestamps = np.concatenate([np.atleast_1d(table['timestamp']) for table in tables])
+	order = np.argsort(timestamps, kind='mergesort')
+	signals = dict((ion, np.concatenate([np.atleast_1d(table[ion]) for table in tables])[order]) for ion in ions)
+	return((timestamps[order], signals))
+
+# the mean of signal over the window seconds up to each of the sample times, NaN where there is no reading
+	# in the window. running sums make this one pass over the signal however many samples there are
+def window_means(timestamps, signal, sample_times, window):
+	import numpy as np
+
+	valid = ~np.isnan(signal)
+	sums = np.concatenate([[0.0], np.cumsum(np.where(valid, signal, 0.0))])
+	counts = np.concatenate([[0], np.cumsum(valid)])
+	start = np.searchsorted(timestamps, sample_times - window, side='left')
+	end = np.searchsorted(timestamps, sample_times, side='right')
+	count = counts[end] - counts[start]
+	return(np.where(count > 0, (sums[end] - sums[start]) / np.maximum(count, 1), np.nan))
+
+# least squares fit of one gas's response, returns None if there are fewer points than coefficients
+def fit_response(concentration, bath_temp, absolute_psi, signal):
+	import numpy as np
+
+	design = np.column_stack([np.ones_like(concentration), concentration, concentration * (bath_temp - 25.0),
+		concentration * absolute_psi])
+	if len(signal) < design.shape[1]:
+		return(None)
+	coefficients, _, rank, _ = np.linalg.lstsq(design, signal, rcond=None)
+	residuals = signal - design.dot(coefficients)
+	spread = np.sum((signal - signal.mean()) ** 2)
+	return({
+		'coefficients': 		dict(zip(COEFFICIENT_NAMES, coefficients.tolist())),
+		'points': 				len(signal),
+		'rank': 				int(rank),
+		'rms_residual': 		float(np.sqrt(np.mean(residuals ** 2))),
+		'max_abs_residual': 	float(np.max(np.abs(residuals))),
+		'r_squared': 			float(1.0 - np.sum(residuals ** 2) / spread) if spread > 0 else None,
+		'residuals': 			residuals.tolist(),
+	})
+
+# fits every gas that has samples and a signal column, returns the fits and the sample points they used
+def fit_runs(run_paths, signal_paths, window=60.0):
+	import numpy as np
+
+	samples = load_samples(run_paths)
+	timestamps, signals = load_signals(signal_paths)
+	absolute_psi = samples['low_press'] + ATMOSPHERE_PSI
+	fits = {}
+	for gas_index in sorted(GASES):
+		gas = GASES[gas_index]
+		if gas['ion'] not in signals:
+			continue
+		concentration = expected_concentrations(samples, gas_index)
+		signal = window_means(timestamps, signals[gas['ion']], samples['timestamp'], window)
+		used = (concentration > 0) & ~np.isnan(concentration) & ~np.isnan(signal)
+		fit = fit_response(concentration[used], samples['bath_temp'][used], absolute_psi[used], signal[used])
+		if fit is None:
+			continue
+		fit.update({
+			'ion': 				gas['ion'],
+			'sample_runs': 		samples['run'][used].astype(int).tolist(),
+			'sample_times': 	samples['timestamp'][used].tolist(),
+			'concentrations': 	concentration[used].tolist(),
+		})
+		fits[gas['name']] = fit
+	return({'runs': list(run_paths), 'signals': list(signal_paths), 'window_s': window,
+		'concentration_units': "mmol/L", 'samples': len(samples['timestamp']), 'fits': fits})
+
+def main():
+	parser = argparse.ArgumentParser(description="Fits the ISMS response to the expected gas concentrations of recorded calibration runs.")
+	parser.add_argument('runs', nargs='+', help="data_calibration_*.isms recordings")
+	parser.add_argument('--signals', action='append', required=True,
+		help="mass spec signal CSV covering the runs, repeat for more than one")
+	parser.add_argument('--window', type=float, default=60.0, help="seconds of signal averaged before each sample (default 60)")
+	parser.add_argument('--output', default="calibration_fits.json", help="file the JSON fits are written to")
+	args = parser.parse_args()
+
+	results = fit_runs(args.runs, args.signals, args.window)
+	with open(args.output, 'w') as output:
+		json.dump(results, output, indent=2, sort_keys=True)
+
+	print("%d samples from %d runs" % (results['samples'], len(args.runs)))
+	for name, fit in sorted(results['fits'].items()):
+		r_squared = "n/a" if fit['r_squared'] is None else "%.4f" % fit['r_squared']
+		print("  %s on %s: %d points, sensitivity %.4g, rms residual %.4g, r2 %s" % (name, fit['ion'], fit['points'],
+			fit['coefficients']['sensitivity'], fit['rms_residual'], r_squared))
+		if fit['rank'] < len(COEFFICIENT_NAMES):
+			print("    rank %d of %d, the samples don't vary the temp and pressure enough to separate every term" % (fit['rank'],
+				len(COEFFICIENT_NAMES)))
+	print("Fits written to " + args.output)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,165 @@
+'''
+
+@description: 	orders the (valve, temp) steps of a calibration plan to minimize the estimated time spent
+				moving between them, and predicts how long a plan will take to run. the bath is by far
+				the slowest device (heating back up is slower still), so running every valve at one temp
+				before moving on beats cycling the bath through every temp at every valve
+
+				a recipe opts in with "order": "optimized" and can override any of the Cost_Model
+				defaults with "cost_model": {"bath_heating_rate": 0.05, ...}
+
+				usage: python calibration_planner.py [recipe.json] [start temp C]
+
+'''
+
+import sys
+
+import calibration_recipe
+
+# estimated seconds for each part of a calibration, transitions between steps run the valve and the bath
+	# at the same time so the slower of the two counts
+class Cost_Model(object):
+	def __init__(self, bath_cooling_rate=0.1, bath_heating_rate=0.07, bath_settle_s=600.0, valve_move_s=2.0,
+			pressure_settle_s=60.0, sample_s=300.0):
+		self.bath_cooling_rate 	= bath_cooling_rate 	# C per minute
+		self.bath_heating_rate 	= bath_heating_rate 	# C per minute
+		self.bath_settle_s 		= bath_settle_s 		# from the end of a ramp until within tolerance
+		self.valve_move_s 		= valve_move_s
+		self.pressure_settle_s 	= pressure_settle_s 	# high pressure loop after a valve move
+		self.sample_s 			= sample_s 				# operator time to take a sample
+
+	def bath_time(self, from_temp, to_temp):
+		if from_temp is None or from_temp == to_temp:
+			return(0.0)
+		rate = self.bath_cooling_rate if to_temp < from_temp else self.bath_heating_rate
+		return(abs(to_temp - from_temp) / rate * 60.0 + self.bath_settle_s)
+
+	def valve_time(self, from_valve, to_valve):
+		if from_valve == to_valve:
+			return(0.0)
+		return(self.valve_move_s + self.pressure_settle_s)
+
+	def transition_time(self, from_point, to_point):
+		return(max(self.bath_time(from_point[1], to_point[1]), self.valve_time(from_point[0], to_point[0])))
+
+def cost_model_from_plan(plan):
+	overrides = plan.cost_model
+	unknown = [name for name in overrides if not hasattr(Cost_Model(), name)]
+	if unknown:
+		raise ValueError("Recipe " + plan.name + ": unknown cost_model fields " + ", ".join(sorted(unknown)))
+	return(Cost_Model(**overrides))
+
+# predicted seconds to run steps starting from start (valve, temp), with the per step times
+def predict(steps, model, start=(1, None)):
+	times = []
+	point = start
+	for step in steps:
+		transition = model.transition_time(point, (step.valve, step.temp))
+		times.append(transition + step.hold_s + model.sample_s)
+		point = (step.valve, step.temp)
+	return((sum(times), times))
+
+def _order_cost(steps, model, start):
+	cost = 0.0
+	point = start
+	for step in steps:
+		cost += model.transition_time(point, (step.valve, step.temp))
+		point = (step.valve, step.temp)
+	return(cost)
+
+def _nearest_neighbour(steps, model, start):
+	remaining = list(steps)
+	order = []
+	point = start
+	while remaining:
+		step = min(remaining, key=lambda step: model.transition_time(point, (step.valve, step.temp)))
+		remaining.remove(step)
+		order.append(step)
+		point = (step.valve, step.temp)
+	return(order)
+
+# every valve at each temp in turn, visiting temps in the order given and reversing the valve order at
+	# every other temp so consecutive steps share a valve
+def _temperature_major(steps, temps):
+	order = []
+	for index, temp in enumerate(temps):
+		at_temp = [step for step in steps if step.temp == temp]
+		order += at_temp[::-1] if index % 2 else at_temp
+	return(order)
+
+# moves single steps to other positions while that lowers the cost, the grids are small (18 steps for the
+	# full matrix) so the O(n^3) passes are cheap
+def _improve(order, model, start):
+	best = _order_cost(order, model, start)
+	improved = True
+	while improved:
+		improved = False
+		for i in range(len(order)):
+			for j in range(len(order)):
+				if i == j:
+					continue
+				candidate = list(order)
+				candidate.insert(j, candidate.pop(i))
+				cost = _order_cost(candidate, model, start)
+				if cost < best - 1e-9:
+					order, best, improved = candidate, cost, True
+	return(order)
+
+# cheapest order found for one run of steps that share the same gas and MFC settings
+def _optimize_segment(steps, model, start):
+	temps = []
+	for step in steps:
+		if step.temp not in temps:
+			temps.append(step.temp)
+	candidates = [list(steps), _nearest_neighbour(steps, model, start),
+		_temperature_major(steps, sorted(temps, reverse=True)), _temperature_major(steps, sorted(temps))]
+	candidates = [_improve(candidate, model, start) for candidate in candidates]
+	return(min(candidates, key=lambda candidate: _order_cost(candidate, model, start)))
+
+# gas and MFC changes apply from the step that gives them onwards, so steps are only reordered within
+	# runs of the same settings and the changes move to whichever step of the run comes first
+def optimize_steps(steps, model, start=(1, None)):
+	segments = []
+	for step in steps:
+		if not segments or any(getattr(step, field) is not None for field in ['gas_index', 'mfc1_flow', 'mfc2_flow']):
+			segments.append([])
+		segments[-1].append(step)
+	order = []
+	point = start
+	for segment in segments:
+		flows = dict((field, getattr(segment[0], field)) for field in ['gas_index', 'mfc1_flow', 'mfc2_flow'])
+		segment = [calibration_recipe.Recipe_Step(**dict(step.to_dict(), gas_index=None, mfc1_flow=None, mfc2_flow=None))
+			for step in segment]
+		segment = _optimize_segment(segment, model, point)
+		for field, value in flows.items():
+			setattr(segment[0], field, value)
+		order += segment
+		point = (segment[-1].valve, segment[-1].temp)
+	return(order)
+
+# reorders the plan if its recipe asked for it, returns the plan to run and its predicted seconds
+def prepare_plan(plan, start_temp=None):
+	model = cost_model_from_plan(plan)
+	start = (1, start_temp) # calibration_startup always starts at valve 1
+	if plan.order == 'optimized':
+		plan = calibration_recipe.Calibration_Plan(plan.name, optimize_steps(plan.steps, model, start),
+			plan.order, plan.cost_model, plan.equilibration, plan.stability)
+	return((plan, predict(plan.steps, model, start)[0]))
+
+def main():
+	path = sys.argv[1] if len(sys.argv) > 1 else calibration_recipe.DEFAULT_RECIPE
+	start_temp = float(sys.argv[2]) if len(sys.argv) > 2 else None
+	plan = calibration_recipe.load_plan(path)
+	model = cost_model_from_plan(plan)
+	start = (1, start_temp)
+	listed = predict(plan.steps, model, start)[0]
+	optimized_steps = optimize_steps(plan.steps, model, start)
+	optimized = predict(optimized_steps, model, start)[0]
+	print(plan.summary())
+	print("As listed: %.2f h" % (listed / 3600.0))
+	print("Optimized: %.2f h" % (optimized / 3600.0))
+	for step in optimized_steps:
+		print("  valve %d, temp %s" % (step.valve, step.temp))
+
+if __name__ == '__main__':
+	main()
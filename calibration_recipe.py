@@ -0,0 +1,157 @@
+'''
+
+@description: 	calibration recipes, JSON (or YAML, if PyYAML is installed) descriptions of the ordered
+				pressure/temperature/gas/MFC steps of a calibration, compiled into the Calibration_Plan
+				that calibrate_slave works through. recipes/full_matrix.json is the standard 18 point
+				calibration
+
+				a recipe either lists its steps:
+				{
+					"name": "spot_check",
+					"defaults": {"hold_s": 600, "temp_tolerance": 0.05},
+					"steps": [
+						{"valve": 6, "temp": 4},
+						{"temp": 2, "hold_s": 300},
+						{"valve": 2, "temp": 2, "gas_index": 7, "mfc2_flow": 50}
+					]
+				}
+				or gives a matrix that is expanded pressure by pressure, every temp at every valve:
+				{"name": "full_matrix", "valves": [1, 6, 5, 4, 3, 2], "temps": [6, 4, 2]}
+
+				step fields: valve (Valco port 1-6), temp (bath setpoint in C), gas_index (MFC two gas),
+				mfc1_flow and mfc2_flow (setpoints), temp_tolerance (C), and the equilibration times.
+				a step without valve or temp keeps the previous one, gas and MFC fields are only changed
+				by steps that give them
+
+				"equilibration": "fixed" (the default) always holds the bath in tolerance for hold_s
+				seconds. "adaptive" samples once the stability_detector finds the bath temp and
+				pressures flat, no sooner than min_hold_s and no later than max_hold_s seconds after
+				the bath reached tolerance, hold_s is then only the planner's estimate. "stability"
+				overrides the detector thresholds, see stability_detector.py
+
+				"order": "optimized" lets calibration_planner reorder the steps to spend less time
+				waiting on the bath, see calibration_planner.py
+
+'''
+
+import json
+import os
+
+import stability_detector
+
+RECIPE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recipes')
+DEFAULT_RECIPE = os.path.join(RECIPE_DIR, 'full_matrix.json')
+
+STEP_FIELDS = ['valve', 'temp', 'gas_index', 'mfc1_flow', 'mfc2_flow', 'hold_s', 'temp_tolerance', 'min_hold_s',
+	'max_hold_s']
+# fields that only apply to the step that gives them, falling back to the recipe defaults
+CRITERIA_DEFAULTS = {'hold_s': 600.0, 'temp_tolerance': 0.05, 'min_hold_s': 120.0, 'max_hold_s': 1800.0}
+
+VALVE_PORTS = range(1, 7)
+
+# "as_listed" runs the steps in recipe order, "optimized" lets calibration_planner reorder them
+ORDERS = ['as_listed', 'optimized']
+
+# "adaptive" ends equilibration once the stability detector finds the signals flat, "fixed" always holds hold_s
+EQUILIBRATIONS = ['fixed', 'adaptive']
+
+# one fully resolved calibration point
+class Recipe_Step(object):
+	def __init__(self, valve, temp, gas_index=None, mfc1_flow=None, mfc2_flow=None, hold_s=600.0, temp_tolerance=0.05,
+			min_hold_s=120.0, max_hold_s=1800.0):
+		self.valve 			= valve
+		self.temp 			= temp
+		self.gas_index 		= gas_index
+		self.mfc1_flow 		= mfc1_flow
+		self.mfc2_flow 		= mfc2_flow
+		self.hold_s 		= hold_s
+		self.temp_tolerance = temp_tolerance
+		self.min_hold_s 	= min_hold_s
+		self.max_hold_s 	= max_hold_s
+
+	def to_dict(self):
+		return(dict((field, getattr(self, field)) for field in STEP_FIELDS))
+
+	def __repr__(self):
+		return("Recipe_Step(valve=%s, temp=%s)" % (self.valve, self.temp))
+
+# the ordered steps calibrate_slave runs through
+class Calibration_Plan(object):
+	def __init__(self, name, steps, order='as_listed', cost_model=None, equilibration='fixed', stability=None):
+		self.name 			= name
+		self.steps 			= steps
+		self.order 			= order 			# 'optimized' lets calibration_planner reorder the steps
+		self.cost_model 	= cost_model or {} 	# calibration_planner.Cost_Model overrides
+		self.equilibration 	= equilibration 	# 'fixed' or 'adaptive'
+		self.stability 		= stability or {} 	# stability_detector thresholds overrides
+
+	def new_detector(self):
+		return(stability_detector.detector_from_config(self.stability))
+
+	def __len__(self):
+		return(len(self.steps))
+
+	def __getitem__(self, index):
+		return(self.steps[index])
+
+	def summary(self):
+		return(self.name + ": " + str(len(self.steps)) + " steps over valves " +
+			", ".join(str(valve) for valve in sorted(set(step.valve for step in self.steps))))
+
+def _number(value, field, index):
+	if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+		raise ValueError("Recipe step " + str(index + 1) + ": " + field + " must be a number, got " + repr(value))
+	return(value)
+
+# checks a recipe and resolves every step's carried over and default values
+def compile_recipe(recipe):
+	name = recipe.get('name', "unnamed")
+	defaults = dict(CRITERIA_DEFAULTS)
+	defaults.update(recipe.get('defaults', {}))
+	if 'steps' in recipe:
+		raw_steps = recipe['steps']
+	elif 'valves' in recipe and 'temps' in recipe:
+		raw_steps = [{'valve': valve, 'temp': temp} for valve in recipe['valves'] for temp in recipe['temps']]
+	else:
+		raise ValueError("Recipe " + name + " needs either steps or valves and temps.")
+	if not raw_steps:
+		raise ValueError("Recipe " + name + " has no steps.")
+
+	order = recipe.get('order', 'as_listed')
+	if order not in ORDERS:
+		raise ValueError("Recipe " + name + ": order must be one of " + ", ".join(ORDERS) + ", got " + repr(order))
+	equilibration = recipe.get('equilibration', 'fixed')
+	if equilibration not in EQUILIBRATIONS:
+		raise ValueError("Recipe " + name + ": equilibration must be one of " + ", ".join(EQUILIBRATIONS) + ", got " + repr(equilibration))
+	stability_detector.detector_from_config(recipe.get('stability')) # raises on unknown channels
+
+	steps = []
+	valve = temp = None
+	for index, raw_step in enumerate(raw_steps):
+		unknown = [field for field in raw_step if field not in STEP_FIELDS]
+		if unknown:
+			raise ValueError("Recipe step " + str(index + 1) + ": unknown fields " + ", ".join(sorted(unknown)))
+		valve = raw_step.get('valve', valve)
+		temp = raw_step.get('temp', temp)
+		if valve not in VALVE_PORTS:
+			raise ValueError("Recipe step " + str(index + 1) + ": valve must be a port from 1 to 6, got " + repr(valve))
+		if temp is None:
+			raise ValueError("Recipe step " + str(index + 1) + ": no temp given.")
+		values = {'valve': valve, 'temp': _number(temp, 'temp', index)}
+		for field in ['gas_index', 'mfc1_flow', 'mfc2_flow']:
+			if raw_step.get(field) is not None:
+				values[field] = _number(raw_step[field], field, index)
+		for field in CRITERIA_DEFAULTS:
+			values[field] = _number(raw_step.get(field, defaults[field]), field, index)
+		steps.append(Recipe_Step(**values))
+	return(Calibration_Plan(name, steps, order, recipe.get('cost_model'), equilibration, recipe.get('stability')))
+
+def load_recipe(path):
+	with open(path) as recipe_file:
+		if path.endswith(('.yaml', '.yml')):
+			import yaml
+			return(yaml.safe_load(recipe_file))
+		return(json.load(recipe_file))
+
+def load_plan(path=DEFAULT_RECIPE):
+	return(compile_recipe(load_recipe(path)))
@@ -0,0 +1,145 @@
+'''
+
+@description: 	append-only recorder of typed calibration records. every record is a fixed width
+				little-endian struct so a whole run can be loaded straight into NumPy arrays instead
+				of regex-parsing the data_calibration log after every cruise
+
+				file layout: "ISMSREC1", a 2 byte header length, a JSON header describing the record
+				fields and event names, then the packed records back to back
+
+'''
+
+import json
+import os
+import struct
+
+from serial_framing import clock
+
+MAGIC = "ISMSREC1"
+
+# record fields as (name, struct code), unknown values are recorded as NaN (or -1 for integers)
+FIELDS = [
+	('timestamp', 		'd'), 	# seconds since the epoch on the device clock
+	('event', 			'B'), 	# index into EVENT_NAMES
+	('valve_port', 		'b'),
+	('gas_index', 		'b'), 	# MFC two gas index, see Application.gas_selected
+	('bath_setpoint', 	'f'), 	# degrees C
+	('bath_temp', 		'f'), 	# degrees C
+	('hplc_pressure', 	'f'), 	# psi
+	('high_press', 		'f'), 	# psi
+	('low_press', 		'f'), 	# psi
+	('high_low_press', 	'f'), 	# psi
+	('mfc1_setpoint', 	'f'),
+	('mfc2_setpoint', 	'f'),
+	('high_counts', 	'h'), 	# raw calboard ADC counts, see pressure_conversion
+	('low_counts', 		'h'),
+	('high_low_counts', 'h'),
+]
+FIELD_NAMES = [name for name, code in FIELDS]
+RECORD_FORMAT = "<" + "".join(code for name, code in FIELDS)
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+EVENT_NAMES = ['calibration_start', 'pressure_set', 'temp_set', 'temp_reached', 'equilibrated', 'sample',
+	'calibration_complete', 'telemetry']
+EVENT_CALIBRATION_START 	= 0
+EVENT_PRESSURE_SET 			= 1
+EVENT_TEMP_SET 				= 2
+EVENT_TEMP_REACHED 			= 3
+EVENT_EQUILIBRATED 			= 4
+EVENT_SAMPLE 				= 5
+EVENT_CALIBRATION_COMPLETE 	= 6
+EVENT_TELEMETRY 			= 7 	# decimated background readings, see Telemetry_Sampler
+
+# settings fields carry forward from one record to the next, measurements are only set on the
+	# record they were taken for
+SETTINGS = ['valve_port', 'gas_index', 'bath_setpoint', 'mfc1_setpoint', 'mfc2_setpoint']
+
+NUMPY_TYPES = {'d': '<f8', 'f': '<f4', 'B': 'u1', 'b': 'i1', 'h': '<i2'}
+
+def _header():
+	layout = json.dumps({'format': RECORD_FORMAT, 'fields': FIELDS, 'events': EVENT_NAMES}, sort_keys=True)
+	return(MAGIC + struct.pack("<H", len(layout)) + layout)
+
+def _read_header(data_file):
+	magic = data_file.read(len(MAGIC))
+	if magic != MAGIC:
+		raise ValueError("Not an ISMS data recording: " + repr(magic))
+	length = struct.unpack("<H", data_file.read(2))[0]
+	return(json.loads(data_file.read(length)))
+
+# buffers records in memory and writes them out at sample boundaries (or every flush_every records),
+	# calling fsync so a crash never loses a recorded sample
+class Data_Recorder(object):
+	def __init__(self, path, flush_every=64):
+		self.path 			= path
+		self.flush_every 	= flush_every
+		self.data_file 		= None
+		self.buffer 		= []
+		self.settings 		= dict((name, None) for name in SETTINGS)
+
+	# the file is only created once there is something to record
+	def open(self):
+		if self.data_file is None:
+			exists = os.path.exists(self.path) and os.path.getsize(self.path) > 0
+			if exists:
+				with open(self.path, 'rb') as data_file:
+					if _read_header(data_file)['format'] != RECORD_FORMAT:
+						raise ValueError("Existing recording " + self.path + " has a different record layout.")
+			self.data_file = open(self.path, 'ab')
+			if not exists:
+				self.data_file.write(_header())
+
+	def record(self, event, **values):
+		for name in SETTINGS:
+			if values.get(name) is not None:
+				self.settings[name] = values[name]
+		values.update(self.settings)
+		row = []
+		for name, code in FIELDS:
+			value = values.get(name)
+			if name == 'timestamp':
+				value = clock() if value is None else value
+			elif name == 'event':
+				value = event
+			elif value is None:
+				value = -1 if code in 'bh' else float('nan')
+			row.append(value)
+		self.buffer.append(struct.pack(RECORD_FORMAT, *row))
+		if len(self.buffer) >= self.flush_every:
+			self.flush()
+
+	def flush(self):
+		if self.buffer:
+			self.open()
+			self.data_file.write("".join(self.buffer))
+			self.buffer = []
+		if self.data_file is not None:
+			self.data_file.flush()
+
+	# writes everything buffered and forces it to disk, called at sample boundaries
+	def sync(self):
+		self.flush()
+		if self.data_file is not None:
+			os.fsync(self.data_file.fileno())
+
+	def close(self):
+		self.sync()
+		if self.data_file is not None:
+			self.data_file.close()
+			self.data_file = None
+
+# loads a whole recording into a dict of NumPy arrays keyed by field name, plus 'event_name'
+def load_run(path):
+	import numpy as np
+
+	with open(path, 'rb') as data_file:
+		header = _read_header(data_file)
+		data = data_file.read()
+	fields = [(str(name), NUMPY_TYPES[code]) for name, code in header['fields']]
+	dtype = np.dtype(fields)
+	# a record cut short by a crash is dropped
+	count = len(data) // dtype.itemsize
+	records = np.frombuffer(data[:count * dtype.itemsize], dtype=dtype)
+	run = dict((name, records[name].copy()) for name, code in fields)
+	run['event_name'] = np.array(header['events'])[records['event']]
+	return(run)
@@ -0,0 +1,353 @@
+'''
+
+@description: 	in-process simulators for the calibration board devices (bath, Valco valve, HPLC pump,
+				calboard Arduino, and the two SmartTrak MFCs) so calibrate_master and calibrate_slave
+				can be run without any hardware attached, optionally with compressed time
+
+'''
+
+import math
+import random
+import struct
+import sys
+import threading
+import time
+
+import serial
+
+import calibrate_isms
+import calibrate_headless
+import bath_model
+import serial_framing
+from calcCRC import calcCRC, frame_command
+from serial_framing import clock
+
+#########################
+### Simulated Physics ###
+#########################
+
+# the shared physical state of one calibration rig. every simulated device on the rig talks to the
+	# same Simulated_Rig, so e.g. moving the valve changes the pressure the pump and calboard report
+class Simulated_Rig(object):
+	# device kinds in the same order as serial_list
+	device_kinds = ['bath', 'valve', 'pump', 'calboard', 'mfc1', 'mfc2']
+
+	# back pressure valve on each valco port, in psi
+	valve_pressures = {1: 0.0, 6: 1000.0, 5: 2000.0, 4: 3000.0, 3: 4000.0, 2: 5000.0}
+
+	# serial number replies as recorded from the real MFCs (new SmartTrak 100, old SmartTrak 2)
+	mfc_serials = ['Srnm210704\x8c\x92\r', 'Srnm1380145\x93\r']
+
+	def __init__(self, ports, time_scale=1.0, ambient_temp=20.0, noise=0.0, seed=0, calboard_version=2):
+		self.ports 				= list(ports)
+		self.time_scale 		= time_scale
+		self.noise 				= noise 		# standard deviation of reading noise, in reading units
+		self.random 			= random.Random(seed)
+		self.lock 				= threading.RLock()
+		self.opened 			= []
+		self.last_update 		= None
+
+		# temperature bath, first order response towards the setpoint with a slower heating time constant
+		self.bath_temp 			= ambient_temp
+		self.bath_setpoint 		= ambient_temp
+		self.bath_running 		= False
+		self.bath_cooling_tau 	= 600.0 	# seconds
+		self.bath_heating_tau 	= 900.0 	# seconds
+
+		# valco valve, moves to a new port after valve_move_time
+		self.valve_port 		= 1
+		self.valve_target 		= 1
+		self.valve_arrival 		= 0.0
+		self.valve_move_time 	= 0.5 		# seconds
+
+		# HPLC pump, pressure follows the back pressure valve selected by the valco
+		self.pump_running 		= False
+		self.pump_flow 			= 0
+		self.pump_limit 		= 6000
+		self.pump_pressure 		= 0.0
+		self.pump_tau 			= 20.0 		# seconds
+
+		# calibration board, the low pressure gas loop fills while the MFCs are flowing in normal operation
+		self.calboard_state 	= "reset"
+		self.flushing 			= False
+		self.calboard_version 	= calboard_version 	# 1 is the original sketch without newlines or burst
+		self.gas_pressure 		= 0.0
+		self.gas_pressure_max 	= 30.0 		# psi
+		self.gas_tau 			= 60.0 		# seconds
+
+		# mass flow controllers
+		self.mfc_setpoints 		= [0.0, 0.0]
+		self.mfc_gas 			= [1, 1]
+
+	# opens the simulated device on port, used in place of serial.Serial once installed
+	def open(self, port, *args, **kwargs):
+		if port not in self.ports:
+			raise serial.SerialException("could not open port " + str(port) + ": not simulated")
+		kind = self.device_kinds[self.ports.index(port)]
+		ser = Simulated_Serial(self, port, kind, kwargs.get('timeout'))
+		self.opened.append(ser)
+		return(ser)
+
+	# brings the physical state up to the current device clock
+	def advance(self):
+		now = clock()
+		if self.last_update is None:
+			self.last_update = now
+		dt = max(now - self.last_update, 0.0)
+		self.last_update = now
+
+		if self.bath_running:
+			tau = self.bath_cooling_tau if self.bath_setpoint < self.bath_temp else self.bath_heating_tau
+			self.bath_temp = self.bath_setpoint + (self.bath_temp - self.bath_setpoint) * math.exp(-dt / tau)
+
+		if now >= self.valve_arrival:
+			self.valve_port = self.valve_target
+
+		target = min(self.valve_pressures[self.valve_port], self.pump_limit) if self.pump_running else 0.0
+		self.pump_pressure = target + (self.pump_pressure - target) * math.exp(-dt / self.pump_tau)
+
+		filling = self.calboard_state.startswith("normal_operation") and sum(self.mfc_setpoints) > 0
+		target = self.gas_pressure_max if filling else 0.0
+		self.gas_pressure = target + (self.gas_pressure - target) * math.exp(-dt / self.gas_tau)
+
+	def noisy(self, value):
+		if self.noise:
+			return(value + self.random.gauss(0.0, self.noise))
+		return(value)
+
+	# total bytes written to and read from all simulated ports
+	def bytes_transferred(self):
+		return(sum(ser.bytes_written + ser.bytes_read for ser in self.opened))
+
+	# command handlers, each takes the raw bytes written and returns the raw reply
+
+	def bath_reply(self, data):
+		cmd = data.strip()
+		if cmd == "W RR -1":
+			self.bath_running = False
+		elif cmd == "W GO 1":
+			self.bath_running = True
+		elif cmd.startswith("W SP "):
+			self.bath_setpoint = float(cmd.split(" ")[2])
+		elif cmd == "R T1":
+			return("$ %.2f\r\n" % self.noisy(self.bath_temp))
+		elif cmd == "R SP":
+			return("$ %.2f\r\n" % self.bath_setpoint)
+		else:
+			return("F001\r\n")
+		return("$\r\n")
+
+	def valve_reply(self, data):
+		cmd = data.strip().replace(" ", "")
+		if cmd == "VR":
+			return("I-PD-AMHX88RD1\r01/03/2008\r")
+		elif cmd == "CP":
+			return("Position is  = " + str(self.valve_port) + "\r")
+		elif cmd.startswith("GO") and cmd[2:].isdigit() and int(cmd[2:]) in self.valve_pressures:
+			if int(cmd[2:]) != self.valve_target:
+				self.valve_target = int(cmd[2:])
+				self.valve_arrival = clock() + self.valve_move_time
+			return("")
+		return("Bad command\r")
+
+	def pump_reply(self, data):
+		cmd = data.strip()
+		if cmd == "ID":
+			return("OK, 195016 Version 2.0.9/")
+		elif cmd == "RU":
+			self.pump_running = True
+		elif cmd == "ST":
+			self.pump_running = False
+		elif cmd.startswith("FI") and cmd[2:].isdigit():
+			self.pump_flow = int(cmd[2:])
+		elif cmd.startswith("UP") and cmd[2:].isdigit():
+			self.pump_limit = int(cmd[2:])
+		elif cmd == "CF":
+			pass
+		elif cmd == "PR":
+			return("OK,%04d/" % max(self.noisy(self.pump_pressure), 0))
+		else:
+			return("Er/")
+		return("OK/")
+
+	# calboard states from calboard_sketch.ino
+	calboard_states = ["normal_operation_v9", "normal_operation_v8", "seawater_in", "di_water_in",
+		"emptying_fr", "release_press", "reset"]
+
+	def calboard_reply(self, data):
+		cmd = data.strip()
+		if self.calboard_version < 2:
+			# the original sketch compares the whole string it read, newline included
+			if data != cmd or cmd.startswith("burst"):
+				return("F001\r\n")
+			elif cmd == "?":
+				return("1\r\n")
+		if cmd in self.calboard_states:
+			self.calboard_state = cmd
+		elif cmd == "flushOn":
+			self.flushing = True
+		elif cmd == "flushOff":
+			self.flushing = False
+		elif cmd == "press":
+			return(", ".join(str(raw) for raw in self.press_counts()) + "\r\n")
+		elif cmd.startswith("burst ") and cmd[6:].isdigit() and 1 <= int(cmd[6:]) <= 255:
+			return(self.burst_frame(int(cmd[6:])))
+		elif cmd == "?":
+			return("1 v%d\r\n" % self.calboard_version)
+		else:
+			return("F001\r\n")
+		return(cmd + "\r\n")
+
+	# raw 10 bit ADC counts for the high, low, and high-low transducers, the inverse of the conversion
+		# in CalBoard_Controller.read_press
+	def press_counts(self):
+		high = self.noisy(self.pump_pressure)
+		low = self.noisy(self.gas_pressure)
+		counts = [(high + 1000.0) / 10000.0, (low + 37.5) / 375.0, (high + 375.0) / 3750.0]
+		return([min(max(int(round(count * 1023.0)), 0), 1023) for count in counts])
+
+	# the binary frame the sketch sends for "burst <samples>", see CalBoard_Controller.read_press_burst
+	def burst_frame(self, samples):
+		readings = [self.press_counts() for sample in range(samples)]
+		payload = [samples]
+		for channel in zip(*readings):
+			payload += [sum(channel) * 16 // samples, min(channel), max(channel)]
+		frame = struct.pack("<B9H", *payload)
+		return("\xb5" + frame + chr(sum(bytearray(frame)) % 256))
+
+	def mfc_reply(self, index, data):
+		cmd, crc = data[:-3], data[-3:-1]
+		if not data.endswith("\r") or calcCRC(cmd) != crc:
+			# the MFCs ignore frames with a bad checksum
+			return("")
+		if cmd == "?Srnm":
+			return(self.mfc_serials[index])
+		elif cmd.startswith("!Sinv"):
+			self.mfc_setpoints[index] = float(cmd[5:])
+		elif cmd.startswith("!Gasi"):
+			self.mfc_gas[index] = int(cmd[5:])
+		elif cmd == "?Gasi":
+			return(frame_command("Gasi" + str(self.mfc_gas[index])))
+		elif cmd == "?Flow":
+			return(frame_command("Flow" + ('%.3f' % self.noisy(self.mfc_setpoints[index]))))
+		elif cmd == "?Strm" or cmd.startswith("!Strm"):
+			return(frame_command("StrmOff" if cmd == "?Strm" else cmd[1:]))
+		else:
+			return("")
+		return(frame_command(cmd[1:]))
+
+# file-like stand-in for serial.Serial that answers from a Simulated_Rig instead of a real device
+class Simulated_Serial(object):
+	def __init__(self, rig, port, kind, timeout=None):
+		self.rig 			= rig
+		self.name 			= port
+		self.port 			= port
+		self.kind 			= kind
+		self.timeout 		= timeout
+		self.is_open 		= True
+		self.buffer 		= ""
+		self.bytes_written 	= 0
+		self.bytes_read 	= 0
+
+	def isOpen(self):
+		return(self.is_open)
+
+	def close(self):
+		self.is_open = False
+
+	@property
+	def in_waiting(self):
+		return(len(self.buffer))
+
+	def reset_input_buffer(self):
+		self.buffer = ""
+
+	def write(self, data):
+		if not self.is_open:
+			raise serial.SerialException("Attempting to use a port that is not open")
+		self.bytes_written += len(data)
+		with self.rig.lock:
+			self.rig.advance()
+			if self.kind.startswith("mfc"):
+				reply = self.rig.mfc_reply(int(self.kind[3:]) - 1, data)
+			else:
+				reply = getattr(self.rig, self.kind + "_reply")(data)
+		self.buffer += reply
+		return(len(data))
+
+	# replies are available immediately so reads never wait on the timeout
+	def read(self, size=1):
+		if not self.is_open:
+			raise serial.SerialException("Attempting to use a port that is not open")
+		chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+		self.bytes_read += len(chunk)
+		return(chunk)
+
+	def readline(self):
+		end = self.buffer.find("\n") + 1 or len(self.buffer)
+		return(self.read(end))
+
+# routes every controller's serial port to the rig and compresses device time by the rig's time_scale
+def install(rig):
+	serial_framing.set_transport(rig.open)
+	serial_framing.set_time_scale(rig.time_scale)
+
+def uninstall():
+	serial_framing.set_transport(serial.Serial)
+	serial_framing.set_time_scale(1.0)
+
+#############################
+### Simulated Application ###
+#############################
+
+# the headless app with an operator that finishes each sample after sample_time seconds
+class Simulated_App(calibrate_headless.Headless_App):
+	def __init__(self, gas_outlet="v9", sample_time=60.0):
+		calibrate_headless.Headless_App.__init__(self, gas_outlet, sample_time)
+
+# runs a complete calibration against simulated devices and returns the app and rig afterwards. the
+	# MFCs are started first the same way Application.calibration_setup does. checkpoints are only
+	# written if a checkpoint_path is given, and a checkpoint resumes the calibration it was saved from
+def run_calibration(time_scale=10000.0, sample_time=60.0, mfc_flows=(100.0, 50.0), gas_index=8, recipe=None,
+		predictive_bath=False, checkpoint_path=None, checkpoint=None, **rig_options):
+	rig = Simulated_Rig(calibrate_isms.serial_list, time_scale, **rig_options)
+	install(rig)
+	# the simulated bath is learned in memory so it never overwrites the real bath's model
+	learned_bath = calibrate_isms.learned_bath
+	calibrate_isms.learned_bath = bath_model.Bath_Model(path=None)
+	saved_checkpoint_path = calibrate_isms.checkpoint_path
+	calibrate_isms.checkpoint_path = checkpoint_path
+	try:
+		app = Simulated_App(sample_time=sample_time)
+		if recipe is not None:
+			app.recipe_path.set(recipe)
+		app.predictive_bath.set(predictive_bath)
+		mfc1 = app.devices.mfc1()
+		mfc1.set_setpoint(mfc_flows[0])
+		mfc1.set_gas(8)
+		mfc2 = app.devices.mfc2()
+		mfc2.set_setpoint(mfc_flows[1])
+		mfc2.set_gas(gas_index)
+		app.mfc1_flow.set(mfc_flows[0])
+		app.mfc2_flow.set(mfc_flows[1])
+		app.gas_index = gas_index
+		calibrate_isms.calibrate_master(app, checkpoint=checkpoint)
+		app.run()
+		app.devices.close_all()
+	finally:
+		calibrate_isms.learned_bath = learned_bath
+		calibrate_isms.checkpoint_path = saved_checkpoint_path
+		uninstall()
+	return((app, rig))
+
+def main():
+	time_scale = float(sys.argv[1]) if len(sys.argv) > 1 else 10000.0
+	recipe = sys.argv[2] if len(sys.argv) > 2 else None
+	start = time.time()
+	start_clock = clock()
+	app, rig = run_calibration(time_scale, recipe=recipe)
+	print("Simulated calibration finished: " + str(app.status.get()))
+	print("Wall time: %.1f s, simulated time: %.2f h" % (time.time() - start, (rig.last_update - start_clock) / 3600.0))
+
+if __name__ == '__main__':
+	main()
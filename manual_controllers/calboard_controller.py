@@ -11,7 +11,7 @@ class CalBoard_Controller():
 		print("Connected over serial at " + str(self.ser.name))
 
 	def is_healthy(self):
-		if (self.cmd_controller("?") == '1\r\n'):
+		if (self.cmd_controller("?").startswith('1')): # "1 v<version>" from newer sketches
 			return(True)
 		else:
 			return(False)
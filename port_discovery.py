@@ -0,0 +1,152 @@
+'''
+
+@description: 	finds which serial port each device of a rig is on, so serial_list doesn't need editing
+				every time the USB adapters re-enumerate. every port is opened once and sent each
+				device's identity query (the same ones the health check uses) until one answers, with
+				all ports probed at once. the port map found is cached in port_map.json keyed by the
+				adapters' USB serial numbers (or VID:PID where they have none), so later startups find
+				the devices without probing as long as the same adapters are plugged in
+
+				the bath is identified by a temperature read ("R T1") rather than the health check's
+				"W RR -1", which stops the bath, so probing never disturbs a running bath or whatever
+				else answers on an unidentified port
+
+'''
+
+import json
+import os
+import re
+import threading
+
+import serial
+
+from calcCRC import frame_command
+from serial_framing import open_port, read_frame, device_sleep, run_concurrently, BATH_TERMINATOR, VALVE_TERMINATOR, PUMP_TERMINATOR, CALBOARD_TERMINATOR, MFC_TERMINATOR
+
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'port_map.json')
+
+# one discovery at a time, so two of them never probe the same port
+discovery_lock = threading.Lock()
+
+# the calboard Arduino resets when its port is opened and doesn't answer until it has booted
+OPEN_SETTLE_S = 1.0
+
+# a bath's reply to "R T1", e.g. "$ 20.50\r\n"
+BATH_TEMP_REPLY = re.compile(r"^\$ -?\d+(\.\d+)?\r\n$")
+
+# (device, query, terminator, reply count, timeout, test of the reply) in the order they are tried on a
+	# port, least disruptive first. the replies are the ones each controller's is_healthy checks for, the
+	# MFCs are told apart by the serial number in their ?Srnm reply and the bath by a numeric temp reading
+def identity_probes(rig):
+	probes = [
+		('calboard', 	"?\n", 			CALBOARD_TERMINATOR, 	1, 1.0, lambda rsp: rsp.startswith("1 v")),
+		('calboard', 	"?", 			CALBOARD_TERMINATOR, 	1, 2.0, lambda rsp: rsp == "1\r\n"), # version 1 sketches
+		('pump', 		"ID", 			PUMP_TERMINATOR, 		1, 1.0, lambda rsp: rsp.startswith("OK, 195016")),
+		('valve', 		"VR\r\n", 		VALVE_TERMINATOR, 		2, 1.0, lambda rsp: rsp.startswith("I-PD-AMHX88RD1")),
+	]
+	for mfc in ['mfc1', 'mfc2']:
+		serial_num = rig.mfc_serial(mfc)
+		probes.append((mfc, frame_command("?Srnm"), MFC_TERMINATOR, 1, 1.0, lambda rsp, serial_num=serial_num: serial_num in rsp))
+	probes.append(('bath', "R T1\r\n", BATH_TERMINATOR, 1, 1.0, lambda rsp: BATH_TEMP_REPLY.match(rsp) is not None))
+	return(probes)
+
+# what identifies a port's USB adapter across re-enumeration, None for ports that aren't USB
+def usb_key(port_info):
+	if port_info.serial_number:
+		return("SN:" + port_info.serial_number)
+	if port_info.vid is not None:
+		key = "%04X:%04X" % (port_info.vid, port_info.pid)
+		# adapters without serial numbers are told apart by the hub port they are plugged into
+		return(key + "@" + port_info.location if port_info.location else key)
+	return(None)
+
+# every serial port on the machine as (port, usb key), empty if pyserial can't list them
+def list_ports():
+	try:
+		from serial.tools import list_ports
+	except ImportError:
+		return([])
+	return([(port_info.device, usb_key(port_info)) for port_info in list_ports.comports()])
+
+# the device answering on port, None if none of the probes got the reply they test for
+def probe_port(port, probes):
+	try:
+		ser = open_port(port, 9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=1)
+	except (serial.SerialException, OSError, ValueError):
+		return(None)
+	try:
+		device_sleep(OPEN_SETTLE_S)
+		for device, query, terminator, count, timeout, matches in probes:
+			ser.reset_input_buffer()
+			ser.write(query)
+			if matches(read_frame(ser, terminator, count, timeout)):
+				return(device)
+	except (serial.SerialException, OSError):
+		return(None)
+	finally:
+		ser.close()
+	return(None)
+
+def load_cache(path=CACHE_PATH):
+	if path is None or not os.path.exists(path):
+		return({})
+	try:
+		with open(path) as cache_file:
+			return(json.load(cache_file))
+	except (IOError, ValueError):
+		return({})
+
+def save_cache(cache, path=CACHE_PATH):
+	if path is None:
+		return
+	with open(path, 'w') as cache_file:
+		json.dump(cache, cache_file, indent=2, sort_keys=True)
+
+# the ports of the rig's devices found from the cache, for the devices whose adapter is plugged in on
+	# exactly one port
+def cached_ports(rig, ports, cache):
+	found = {}
+	for device, key in cache.get(rig.name, {}).items():
+		matching = [port for port, port_key in ports if port_key == key]
+		if key is not None and len(matching) == 1:
+			found[str(device)] = matching[0]
+	return(found)
+
+# the rig's port map, from the cache where it still matches the plugged in adapters and by probing the
+	# other ports for the rest. only devices are looked for, and ports in busy_ports (e.g. held open by
+	# the Device_Registry) are left alone. devices that aren't found keep their configured port. returns
+	# the port map and the devices that were found by probing
+def discover(rig, devices=None, busy_ports=(), cache_path=CACHE_PATH):
+	devices = list(rig.ports) if devices is None else devices
+	with discovery_lock:
+		ports = [(port, key) for port, key in list_ports() if port not in busy_ports]
+		cache = load_cache(cache_path)
+		found = dict((device, port) for device, port in cached_ports(rig, ports, cache).items() if device in devices)
+		missing = [device for device in devices if device not in found]
+		probed = {}
+		if missing:
+			candidates = [port for port, key in ports if port not in found.values()]
+			probes = [probe for probe in identity_probes(rig) if probe[0] in missing]
+			for port, device in zip(candidates, run_concurrently(lambda port: probe_port(port, probes), candidates)):
+				if device is not None and device not in probed:
+					probed[device] = port
+			found.update(probed)
+			keys = dict(ports)
+			rig_cache = cache.setdefault(rig.name, {})
+			for device, port in probed.items():
+				if keys.get(port) is not None:
+					rig_cache[device] = keys[port]
+			if probed:
+				save_cache(cache, cache_path)
+		port_map = dict(rig.ports)
+		port_map.update(found)
+		return((port_map, sorted(probed)))
+
+# drops the cached ports of devices that failed the health check so the next discovery probes for them
+def forget(rig, devices, cache_path=CACHE_PATH):
+	cache = load_cache(cache_path)
+	rig_cache = cache.get(rig.name, {})
+	if any(device in rig_cache for device in devices):
+		for device in devices:
+			rig_cache.pop(device, None)
+		save_cache(cache, cache_path)
@@ -0,0 +1,109 @@
+'''
+
+@description: 	conversion of the calboard's raw ADC counts to pressures. each transducer has its own
+				calibration polynomial (in the sensor output voltage) loaded from a JSON config, e.g.
+				transducers.json, so a recalibrated transducer only needs new coefficients, and whole
+				runs of raw counts can be re-converted at once as NumPy arrays
+
+				config layout:
+				{
+					"adc_counts": 1023, "adc_volts": 5.0,
+					"transducers": [
+						{"name": "high_press", "coefficients": [-1000.0, 2000.0], "min_psi": 0.0},
+						...
+					]
+				}
+				coefficients are in increasing order of power of the voltage, so two coefficients are
+				a linear calibration: psi = coefficients[0] + coefficients[1] * volts
+
+'''
+
+import json
+
+# transducers in the order their counts are sent by the calboard "press" command
+TRANSDUCER_NAMES = ['high_press', 'low_press', 'high_low_press']
+
+# raw count fields in data_recorder records, in the same order
+COUNT_FIELDS = ['high_counts', 'low_counts', 'high_low_counts']
+
+# pressure = max pressure/(4.5V-.5V) * voltage - offset (max pressure/(4.5V-.5V)*.5V)
+DEFAULT_CONFIG = {
+	'adc_counts': 1023,
+	'adc_volts': 5.0,
+	'transducers': [
+		{'name': 'high_press', 		'coefficients': [-1000.0, 2000.0], 	'min_psi': 0.0}, 	# 0-8000 psi
+		{'name': 'low_press', 		'coefficients': [-37.5, 75.0], 		'min_psi': 0.0}, 	# 0-300 psi
+		{'name': 'high_low_press', 	'coefficients': [-375.0, 750.0], 	'min_psi': 0.0}, 	# 0-3000 psi
+	],
+}
+
+class Transducer(object):
+	def __init__(self, name, coefficients, min_psi=None):
+		self.name 			= name
+		self.coefficients 	= [float(c) for c in coefficients]
+		self.min_psi 		= min_psi
+
+	# evaluates the calibration polynomial with Horner's method, works on floats and NumPy arrays alike
+	def pressure(self, volts):
+		pressure = 0.0
+		for coefficient in reversed(self.coefficients):
+			pressure = pressure * volts + coefficient
+		return(pressure)
+
+class Pressure_Converter(object):
+	def __init__(self, transducers, adc_counts=1023, adc_volts=5.0):
+		self.transducers 	= transducers
+		self.volts_per_count = float(adc_volts) / adc_counts
+
+	# one reading of raw counts (one per transducer) to a list of pressures rounded to .01 psi
+	def convert(self, counts):
+		pressures = []
+		for transducer, count in zip(self.transducers, counts):
+			pressure = transducer.pressure(count * self.volts_per_count)
+			if transducer.min_psi is not None and pressure < transducer.min_psi:
+				pressure = transducer.min_psi
+			pressures.append(round(pressure, 2))
+		return(pressures)
+
+	# a batch of readings as an (n, transducers) array of counts to an array of pressures of the same shape,
+		# clamped the same way as convert but not rounded
+	def convert_array(self, counts):
+		import numpy as np
+
+		volts = np.asarray(counts, dtype=np.float64) * self.volts_per_count
+		pressures = np.empty_like(volts)
+		for column, transducer in enumerate(self.transducers):
+			pressures[..., column] = transducer.pressure(volts[..., column])
+			if transducer.min_psi is not None:
+				np.maximum(pressures[..., column], transducer.min_psi, out=pressures[..., column])
+		return(pressures)
+
+	# re-converts the raw counts of a run loaded by data_recorder.load_run in place, e.g. after a
+		# transducer is recalibrated. readings without counts (-1) are left as they were. burst readings
+		# are recorded with their mean counts rounded to whole counts, so for those the re-converted
+		# pressures are only exact to within one count (about 10 psi on the high loop)
+	def reconvert_run(self, run):
+		import numpy as np
+
+		counts = np.column_stack([run[field] for field in COUNT_FIELDS])
+		valid = (counts >= 0).all(axis=1)
+		pressures = self.convert_array(counts[valid])
+		for column, transducer in enumerate(self.transducers):
+			run[transducer.name][valid] = pressures[:, column]
+		return(run)
+
+def converter_from_config(config):
+	transducers = dict((entry['name'], Transducer(entry['name'], entry['coefficients'], entry.get('min_psi')))
+		for entry in config['transducers'])
+	missing = [name for name in TRANSDUCER_NAMES if name not in transducers]
+	if missing:
+		raise ValueError("Transducer config is missing " + ", ".join(missing))
+	return(Pressure_Converter([transducers[name] for name in TRANSDUCER_NAMES],
+		config.get('adc_counts', 1023), config.get('adc_volts', 5.0)))
+
+def load_converter(path):
+	with open(path) as config_file:
+		return(converter_from_config(json.load(config_file)))
+
+def default_converter():
+	return(converter_from_config(DEFAULT_CONFIG))
@@ -0,0 +1,88 @@
+'''
+
+@description: 	configuration of a calibration rig: the serial port of each of its devices, the serial
+				numbers its MFCs answer ?Srnm with, and the solenoid its gas goes out through. the
+				Device_Registry opens a rig's controllers from it, so one process can drive several rigs
+
+				config layout (e.g. rigs.json, see calibrate_rigs.py):
+				{
+					"rigs": [
+						{
+							"name": "rig_a",
+							"ports": {"bath": "COM29", "valve": "COM34", "pump": "COM33",
+								"calboard": "COM28", "mfc1": "COM32", "mfc2": "COM35"},
+							"mfc_serials": {"mfc1": "210704", "mfc2": "1380145"},
+							"gas_outlet": "v9",
+							"calibration": {"recipe": "recipes/full_matrix.json", "mfc1_flow": 100, "mfc2_flow": 50, "gas_index": 3}
+						},
+						...
+					]
+				}
+				"calibration" holds the settings calibrate_rigs.py starts the rig's calibration with
+
+'''
+
+import json
+
+# devices every rig has, in the order of calibrate_isms.serial_list
+DEVICE_NAMES = ['bath', 'valve', 'pump', 'calboard', 'mfc1', 'mfc2']
+MFC_NAMES = ['mfc1', 'mfc2']
+GAS_OUTLETS = ['v8', 'v9']
+
+class Rig(object):
+	def __init__(self, name, ports, mfc_serials, gas_outlet="v9", calibration=None, discover=False):
+		self.name 			= name
+		self.ports 			= ports 			# device name to serial port
+		self.mfc_serials 	= mfc_serials 		# MFC name to what its ?Srnm reply contains
+		self.gas_outlet 	= gas_outlet
+		self.calibration 	= calibration or {}
+		self.discover 		= discover 			# find the ports with port_discovery instead of trusting ports
+
+	def port(self, name):
+		return(self.ports[name])
+
+	def port_list(self):
+		return([self.ports[name] for name in DEVICE_NAMES])
+
+	def mfc_serial(self, name):
+		return(self.mfc_serials[name])
+
+	# the same rig on other ports, e.g. the ones port_discovery found
+	def with_ports(self, ports):
+		return(Rig(self.name, ports, self.mfc_serials, self.gas_outlet, self.calibration, self.discover))
+
+	def __repr__(self):
+		return("Rig(%s)" % self.name)
+
+# checks one rig's config, the MFC serial numbers are matched against the ?Srnm reply as "Srnm" + number
+def rig_from_config(config, index=0):
+	name = config.get('name', "rig_" + str(index + 1))
+	ports = config.get('ports', {})
+	missing = [device for device in DEVICE_NAMES if device not in ports]
+	if missing:
+		raise ValueError("Rig " + name + " has no port for " + ", ".join(missing) + ".")
+	serials = config.get('mfc_serials', {})
+	missing = [mfc for mfc in MFC_NAMES if mfc not in serials]
+	if missing:
+		raise ValueError("Rig " + name + " has no serial number for " + ", ".join(missing) + ".")
+	gas_outlet = config.get('gas_outlet', "v9")
+	if gas_outlet not in GAS_OUTLETS:
+		raise ValueError("Rig " + name + ": gas_outlet must be one of " + ", ".join(GAS_OUTLETS) + ", got " + repr(gas_outlet))
+	return(Rig(str(name), dict((str(device), str(ports[device])) for device in DEVICE_NAMES),
+		dict((mfc, "Srnm" + str(serials[mfc])) for mfc in MFC_NAMES), str(gas_outlet), config.get('calibration')))
+
+def load_rigs(path):
+	with open(path) as config_file:
+		config = json.load(config_file)
+	rigs = [rig_from_config(rig, index) for index, rig in enumerate(config.get('rigs', []))]
+	if not rigs:
+		raise ValueError("No rigs in " + path + ".")
+	names = [rig.name for rig in rigs]
+	duplicates = sorted(set(name for name in names if names.count(name) > 1))
+	if duplicates:
+		raise ValueError("Rig names must be unique, " + ", ".join(duplicates) + " repeated.")
+	ports = [port for rig in rigs for port in rig.port_list()]
+	shared = sorted(set(port for port in ports if ports.count(port) > 1))
+	if shared:
+		raise ValueError("Rigs can't share serial ports, " + ", ".join(shared) + " used more than once.")
+	return(rigs)
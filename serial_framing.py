@@ -0,0 +1,102 @@
+'''
+
+@description: 	serial transport, timing, terminator aware reads, and concurrent device probes shared
+				by the ISMS calibration device controllers
+
+'''
+
+import serial
+import threading
+import time
+
+# every controller opens its port through open_port, so the transport can be swapped for an
+	# in-process simulator (see isms_simulator.py) to run without any hardware attached
+transport_factory = serial.Serial
+
+def open_port(port, *args, **kwargs):
+	return(transport_factory(port, *args, **kwargs))
+
+def set_transport(factory):
+	global transport_factory
+	transport_factory = factory
+
+# device waits and deadlines go through clock() and device_sleep() so a simulated run can compress
+	# time by time_scale, e.g. a time_scale of 1000 turns a 600 second equilibration into 0.6 seconds
+time_scale = 1.0
+_clock_origin = (time.time(), time.time()) # (real time, device clock) when time_scale was last set
+
+def set_time_scale(scale):
+	global time_scale, _clock_origin
+	_clock_origin = (time.time(), clock())
+	time_scale = float(scale)
+
+# seconds on the (possibly compressed) device clock
+def clock():
+	real, device = _clock_origin
+	return(device + (time.time() - real) * time_scale)
+
+def device_sleep(seconds):
+	if seconds > 0:
+		time.sleep(seconds / time_scale)
+
+# every device ends its replies with a known terminator, so a read can return as soon as the reply is
+	# complete instead of always blocking for the full serial timeout waiting on bytes that never come
+BATH_TERMINATOR 	= "\r\n"
+VALVE_TERMINATOR 	= "\r"		# multi line replies (e.g. "VR") are counted as several terminators
+PUMP_TERMINATOR 	= "/"
+CALBOARD_TERMINATOR = "\r\n"
+MFC_TERMINATOR 		= "\r"		# the two crc bytes before it are never 0x0d, see calcCRC
+
+# reads from an open serial port until terminator has been seen count times. the timeout (defaulting
+	# to the port's own timeout) is only an upper bound on the whole read, whatever has arrived by then
+	# is returned so callers still see partial or empty replies exactly as before
+def read_frame(ser, terminator, count=1, timeout=None):
+	if timeout is None:
+		timeout = ser.timeout
+	deadline = time.time() + timeout
+	frame = ""
+	while frame.count(terminator) < count:
+		chunk = ser.read(1) # blocks at most ser.timeout for the next byte
+		if not chunk:
+			break
+		frame += chunk
+		# pick up the rest of a reply that has already arrived in one go
+		waiting = ser.in_waiting
+		if waiting:
+			frame += ser.read(waiting)
+		if time.time() > deadline:
+			break
+	return(frame)
+
+# reads a reply that is either a binary frame of size bytes starting with the sync byte, or (e.g. from
+	# firmware that doesn't know the command) a text reply up to terminator
+def read_binary_frame(ser, sync, size, terminator, timeout=None):
+	if timeout is None:
+		timeout = ser.timeout
+	deadline = time.time() + timeout
+	frame = ser.read(1)
+	if frame != sync:
+		if frame and not frame.endswith(terminator):
+			frame += read_frame(ser, terminator, 1, max(deadline - time.time(), 0))
+		return(frame)
+	while len(frame) < size and time.time() <= deadline:
+		chunk = ser.read(size - len(frame))
+		if not chunk:
+			break
+		frame += chunk
+	return(frame)
+
+# runs func(item) for every item on its own thread and returns the results in the same order, so
+	# device checks take as long as the slowest device instead of the sum of all of them
+def run_concurrently(func, items):
+	results = [None] * len(items)
+	def run_one(index, item):
+		results[index] = func(item)
+	# named after the thread that started them so calibrate_rigs can tell which rig they log for
+	parent = threading.current_thread().name
+	threads = [threading.Thread(target=run_one, args=(index, item), name=parent + "/" + str(index)) for index, item in enumerate(items)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return(results)
@@ -0,0 +1,133 @@
+'''
+
+@description: 	online stability detection for equilibration and setup. every channel (bath temp, high
+				and low loop pressures, HPLC pressure) keeps a sliding time window of readings with
+				running sums, so its mean, standard deviation, and least squares slope are updated in
+				O(1) per reading, and the signals count as equilibrated once every window is full and flat
+
+				thresholds can be overridden by a recipe's "stability" entry, e.g.
+				{"window_s": 180, "bath_temp": {"max_std": 0.01, "max_slope": 0.005}}
+				max_std is in the channel's units, max_slope in units per minute
+
+'''
+
+import math
+from collections import deque
+
+DEFAULT_WINDOW_S = 120.0
+
+DEFAULT_THRESHOLDS = {
+	'bath_temp': 	{'max_std': 0.02, 	'max_slope': 0.01}, 	# C, C/min
+	'high_press': 	{'max_std': 10.0, 	'max_slope': 5.0}, 		# psi, psi/min
+	'low_press': 	{'max_std': 0.5, 	'max_slope': 0.2}, 		# psi, psi/min
+	'hplc_pressure': {'max_std': 20.0, 	'max_slope': 10.0}, 	# psi, psi/min
+}
+
+# a window counts as full once its readings span this fraction of window_s, readings come on calibrate_slave
+	# ticks so the span is never exactly the window
+FULL_FRACTION = 0.9
+
+# readings of one channel over the last window_s seconds with the running sums for their statistics
+class Rolling_Window(object):
+	def __init__(self, window_s):
+		self.window_s 	= window_s
+		self.readings 	= deque()
+		self.origin 	= None 	# times are kept relative to the first reading to keep the sums well conditioned
+		self.sum_t = self.sum_x = self.sum_tt = self.sum_tx = self.sum_xx = 0.0
+
+	def _update(self, t, x, sign):
+		self.sum_t 	+= sign * t
+		self.sum_x 	+= sign * x
+		self.sum_tt += sign * t * t
+		self.sum_tx += sign * t * x
+		self.sum_xx += sign * x * x
+
+	def add(self, timestamp, value):
+		if value is None or math.isnan(value):
+			return
+		if self.origin is None:
+			self.origin = timestamp
+		t = timestamp - self.origin
+		self.readings.append((t, value))
+		self._update(t, value, 1.0)
+		while self.readings[0][0] < t - self.window_s:
+			old_t, old_value = self.readings.popleft()
+			self._update(old_t, old_value, -1.0)
+
+	def count(self):
+		return(len(self.readings))
+
+	def span(self):
+		if not self.readings:
+			return(0.0)
+		return(self.readings[-1][0] - self.readings[0][0])
+
+	def is_full(self):
+		return(self.span() >= self.window_s * FULL_FRACTION)
+
+	def mean(self):
+		return(self.sum_x / len(self.readings))
+
+	def std(self):
+		n = len(self.readings)
+		return(math.sqrt(max(n * self.sum_xx - self.sum_x * self.sum_x, 0.0)) / n)
+
+	# least squares slope in units per second, 0 until there are two readings at different times
+	def slope(self):
+		n = len(self.readings)
+		denominator = n * self.sum_tt - self.sum_t * self.sum_t
+		if n < 2 or denominator <= 0:
+			return(0.0)
+		return((n * self.sum_tx - self.sum_t * self.sum_x) / denominator)
+
+class Stability_Detector(object):
+	def __init__(self, window_s=DEFAULT_WINDOW_S, thresholds=None):
+		self.thresholds = dict((channel, dict(limits)) for channel, limits in DEFAULT_THRESHOLDS.items())
+		for channel, limits in (thresholds or {}).items():
+			self.thresholds.setdefault(channel, {}).update(limits)
+		self.windows = dict((channel, Rolling_Window(window_s)) for channel in self.thresholds)
+
+	def add(self, timestamp, **values):
+		for channel, value in values.items():
+			if channel in self.windows:
+				self.windows[channel].add(timestamp, value)
+
+	# (stable, report), stable once every channel that has readings has a full window within its limits.
+		# report has the mean, std, slope (per minute) and state of each channel for logging the decision
+	def check(self):
+		stable = True
+		report = {}
+		for channel, window in sorted(self.windows.items()):
+			if window.count() == 0:
+				report[channel] = {'state': "no readings"}
+				continue
+			limits = self.thresholds[channel]
+			std = window.std()
+			slope = window.slope() * 60.0
+			if not window.is_full():
+				state = "filling"
+			elif std > limits['max_std'] or abs(slope) > limits['max_slope']:
+				state = "unsettled"
+			else:
+				state = "flat"
+			stable = stable and state == "flat"
+			report[channel] = {'state': state, 'mean': window.mean(), 'std': std, 'slope_per_min': slope}
+		return((stable, report))
+
+def detector_from_config(config):
+	config = dict(config or {})
+	window_s = config.pop('window_s', DEFAULT_WINDOW_S)
+	unknown = [channel for channel in config if channel not in DEFAULT_THRESHOLDS]
+	if unknown:
+		raise ValueError("Unknown stability channels " + ", ".join(sorted(unknown)))
+	return(Stability_Detector(window_s, config))
+
+def format_report(report):
+	parts = []
+	for channel, stats in sorted(report.items()):
+		if 'std' in stats:
+			parts.append("%s %s (mean %.3f, std %.3f, slope %.3f/min)" % (channel, stats['state'], stats['mean'],
+				stats['std'], stats['slope_per_min']))
+		else:
+			parts.append(channel + " " + stats['state'])
+	return("; ".join(parts))